@@ -0,0 +1,92 @@
+# coding=utf-8
+u"""Parsed F5® LBaaSv2 agent configurations."""
+# Copyright 2017 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+
+from f5lbaasdriver.v2.bigip import cache
+from f5lbaasdriver.v2.bigip import constants_v2
+
+# Parsed configurations with their JSON text, by agent id, or by the
+# text itself for configurations of no particular agent. An agent
+# reporting new configurations replaces its own entry, so the cache holds
+# one entry per agent however often they report.
+_parsed_configurations = cache.TTLCache(
+    constants_v2.AGENT_CONFIG_CACHE_MAX_ENTRIES,
+    constants_v2.AGENT_CONFIG_CACHE_SECONDS)
+
+
+class AgentConfiguration(dict):
+    """Agent configurations dictionary with accessors for F5® settings.
+
+    Instances may be shared between callers and must not be modified.
+    """
+
+    @property
+    def environment_prefix(self):
+        return self.get('environment_prefix')
+
+    @property
+    def environment_group_number(self):
+        return self.get('environment_group_number')
+
+    @property
+    def environment_capacity_score(self):
+        return self.get('environment_capacity_score', 0.0)
+
+    @property
+    def common_networks(self):
+        return self.get('common_networks', {})
+
+    @property
+    def f5_common_external_networks(self):
+        return self.get('f5_common_external_networks', False)
+
+    @property
+    def tunnel_types(self):
+        return self.get('tunnel_types', [])
+
+    @property
+    def rpc_api_version(self):
+        return self.get('rpc_api_version',
+                        constants_v2.BASE_RPC_API_VERSION)
+
+
+def parse_agent_configurations(configurations, agent_id=None):
+    """Return agent configurations as an AgentConfiguration.
+
+    The configurations are either a dictionary or the JSON text stored
+    with the agent. JSON text is parsed once and then served from a
+    cache keyed by the agent id, or by the text itself without one,
+    until the agent reports different configurations.
+
+    :raises ValueError: if the configurations are not valid JSON.
+    """
+    if isinstance(configurations, AgentConfiguration):
+        return configurations
+    if isinstance(configurations, dict):
+        return AgentConfiguration(configurations)
+
+    key = configurations if agent_id is None else agent_id
+    cached = _parsed_configurations.get(key)
+    if cached is not None and cached[0] == configurations:
+        return cached[1]
+
+    parsed = json.loads(configurations)
+    if not isinstance(parsed, dict):
+        raise ValueError('No JSON object could be decoded')
+    agent_conf = AgentConfiguration(parsed)
+    _parsed_configurations.set(key, (configurations, agent_conf))
+    return agent_conf
@@ -15,16 +15,34 @@ u"""RPC Calls to Agents for F5® LBaaSv2."""
 # limitations under the License.
 #
 
-from oslo_log import helpers as log_helpers
+from oslo_config import cfg
 from oslo_log import log as logging
 import oslo_messaging as messaging
+from oslo_utils import versionutils
 
 from neutron.common import rpc
 
+from f5lbaasdriver.v2.bigip import agent_config
 from f5lbaasdriver.v2.bigip import constants_v2 as constants
+from f5lbaasdriver.v2.bigip import service_codec
+from f5lbaasdriver.v2.bigip import tracing
 
 LOG = logging.getLogger(__name__)
 
+OPTS = [
+    cfg.BoolOpt(
+        'f5_service_compression',
+        default=False,
+        help=('Send services to agents with only the port fields agents '
+              'use, as zlib compressed JSON (see service_codec). Only '
+              'agents reporting an rpc_api_version of 1.1 or later in '
+              'their configurations receive compressed services, at '
+              'RPC API version 1.1; other agents receive plain services.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
 
 class LBaaSv2AgentRPC(object):
 
@@ -51,8 +69,41 @@ class LBaaSv2AgentRPC(object):
             context, msg, rpc_method='call', **kwargs)
 
     def cast(self, context, msg, **kwargs):
+        host = kwargs.pop('host', None)
+        if (cfg.CONF.f5_service_compression and msg['args'].get('service')
+                and self._accepts_encoded_service(context, host)):
+            msg['args']['service'] = service_codec.encode_service(
+                msg['args']['service'])
+            kwargs['version'] = constants.ENCODED_SERVICE_RPC_API_VERSION
         self.__call_rpc_method(context, msg, rpc_method='cast', **kwargs)
 
+    def _accepts_encoded_service(self, context, host):
+        """Return whether the agents on a host decode encoded services.
+
+        Agents report the RPC API version they support as rpc_api_version
+        in their configurations. Agents that report none, or an older
+        version, only accept plain services.
+        """
+        if not host:
+            return False
+        agents = self.driver.plugin.db.get_lbaas_agents(
+            context, filters={'host': [host]})
+        if not agents:
+            return False
+        for agent in agents:
+            try:
+                agent_conf = agent_config.parse_agent_configurations(
+                    agent['configurations'], agent_id=agent.get('id'))
+                if not versionutils.is_compatible(
+                        constants.ENCODED_SERVICE_RPC_API_VERSION,
+                        agent_conf.rpc_api_version):
+                    return False
+            except (ValueError, TypeError, AttributeError) as e:
+                LOG.warning('Cannot read RPC API version of agent %s: %s' %
+                            (agent.get('id'), e.message))
+                return False
+        return True
+
     def fanout_cast(self, context, msg, **kwargs):
         kwargs['fanout'] = True
         self.__call_rpc_method(context, msg, rpc_method='cast', **kwargs)
@@ -74,7 +125,7 @@ class LBaaSv2AgentRPC(object):
         func = getattr(callee, kwargs['rpc_method'])
         return func(context, msg['method'], **msg['args'])
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def create_loadbalancer(self, context, loadbalancer, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -84,9 +135,9 @@ class LBaaSv2AgentRPC(object):
                 loadbalancer=loadbalancer,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update_loadbalancer(
             self,
             context,
@@ -104,9 +155,9 @@ class LBaaSv2AgentRPC(object):
                 loadbalancer=loadbalancer,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def delete_loadbalancer(self, context, loadbalancer, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -116,9 +167,9 @@ class LBaaSv2AgentRPC(object):
                 loadbalancer=loadbalancer,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update_loadbalancer_stats(
             self,
             context,
@@ -134,9 +185,9 @@ class LBaaSv2AgentRPC(object):
                 loadbalancer=loadbalancer,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def create_listener(self, context, listener, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -146,9 +197,9 @@ class LBaaSv2AgentRPC(object):
                 listener=listener,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update_listener(self, context, old_listener, listener, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -159,9 +210,9 @@ class LBaaSv2AgentRPC(object):
                 listener=listener,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def delete_listener(self, context, listener, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -171,9 +222,9 @@ class LBaaSv2AgentRPC(object):
                 listener=listener,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def create_pool(self, context, pool, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -183,9 +234,9 @@ class LBaaSv2AgentRPC(object):
                 pool=pool,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update_pool(self, context, old_pool, pool, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -196,9 +247,9 @@ class LBaaSv2AgentRPC(object):
                 pool=pool,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def delete_pool(self, context, pool, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -208,9 +259,9 @@ class LBaaSv2AgentRPC(object):
                 pool=pool,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def create_member(self, context, member, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -220,9 +271,9 @@ class LBaaSv2AgentRPC(object):
                 member=member,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update_member(self, context, old_member, member, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -233,9 +284,9 @@ class LBaaSv2AgentRPC(object):
                 member=member,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def delete_member(self, context, member, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -245,9 +296,9 @@ class LBaaSv2AgentRPC(object):
                 member=member,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def create_health_monitor(self, context, health_monitor, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -257,9 +308,9 @@ class LBaaSv2AgentRPC(object):
                 health_monitor=health_monitor,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update_health_monitor(
             self,
             context,
@@ -277,9 +328,9 @@ class LBaaSv2AgentRPC(object):
                 health_monitor=health_monitor,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def delete_health_monitor(self, context, health_monitor, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -289,9 +340,9 @@ class LBaaSv2AgentRPC(object):
                 health_monitor=health_monitor,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def create_l7policy(self, context, l7policy, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -301,9 +352,9 @@ class LBaaSv2AgentRPC(object):
                 l7policy=l7policy,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update_l7policy(self, context, old_l7policy, l7policy, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -314,9 +365,9 @@ class LBaaSv2AgentRPC(object):
                 l7policy=l7policy,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def delete_l7policy(self, context, l7policy, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -326,9 +377,9 @@ class LBaaSv2AgentRPC(object):
                 l7policy=l7policy,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def create_l7rule(self, context, l7rule, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -338,9 +389,9 @@ class LBaaSv2AgentRPC(object):
                 l7rule=l7rule,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update_l7rule(self, context, old_l7rule, l7rule, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -351,9 +402,9 @@ class LBaaSv2AgentRPC(object):
                 l7rule=l7rule,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def delete_l7rule(self, context, l7rule, service, host):
         topic = '%s.%s' % (self.topic, host)
         return self.cast(
@@ -363,4 +414,4 @@ class LBaaSv2AgentRPC(object):
                 l7rule=l7rule,
                 service=service
             ),
-            topic=topic)
+            topic=topic, host=host)
@@ -15,16 +15,36 @@
 #   limitations under the License.
 
 from collections import defaultdict
-import json
 import random
 
+from oslo_config import cfg
 from oslo_log import log as logging
+from sqlalchemy import func
 
 from neutron_lbaas import agent_scheduler
+from neutron_lbaas.db.loadbalancer import models
 from neutron_lbaas.extensions import lbaas_agentschedulerv2
 
+from f5lbaasdriver.v2.bigip import agent_config
+from f5lbaasdriver.v2.bigip import cache
+from f5lbaasdriver.v2.bigip import constants_v2
+
 LOG = logging.getLogger(__name__)
 
+OPTS = [
+    cfg.IntOpt(
+        'f5_scheduler_load_cache_seconds',
+        default=30,
+        help=('Seconds CapacityWeightedScheduler keeps the loadbalancer '
+              'and member counts of an agent before counting them again. '
+              'Loadbalancers scheduled by the same neutron-server process '
+              'are added to the cached counts; those scheduled by other '
+              'processes are seen when the counts expire.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
 
 class TenantScheduler(agent_scheduler.ChanceScheduler):
     """Finds an available agent for the tenant/environment."""
@@ -54,7 +74,8 @@ class TenantScheduler(agent_scheduler.ChanceScheduler):
                     # find another agent in the same environment
                     # which environment group is the agent in
                     ac = self.deserialize_agent_configurations(
-                        lbaas_agent['agent']['configurations']
+                        lbaas_agent['agent']['configurations'],
+                        agent_id=lbaas_agent['agent'].get('id')
                     )
                     # get a environment group number for the bound agent
                     if 'environment_group_number' in ac:
@@ -81,21 +102,26 @@ class TenantScheduler(agent_scheduler.ChanceScheduler):
             return lbaas_agent
 
     def get_agents_in_env(
-            self, context, plugin, env, group=None, active=None):
+            self, context, plugin, env, group=None, active=None, host=None):
         """Get an active agents in the specified environment."""
         return_agents = []
 
         with context.session.begin(subtransactions=True):
             candidates = []
             try:
-                candidates = plugin.db.get_lbaas_agents(context, active=active)
+                if host:
+                    candidates = plugin.db.get_lbaas_agents(
+                        context, active=active, filters={'host': [host]})
+                else:
+                    candidates = plugin.db.get_lbaas_agents(
+                        context, active=active)
             except Exception as ex:
                 LOG.error("Exception retrieving agent candidates for "
                           "scheduling: {}".format(ex))
 
             for candidate in candidates:
                 ac = self.deserialize_agent_configurations(
-                    candidate['configurations'])
+                    candidate['configurations'], agent_id=candidate.get('id'))
                 if 'environment_prefix' in ac:
                     if ac['environment_prefix'] == env:
                         if group:
@@ -107,6 +133,25 @@ class TenantScheduler(agent_scheduler.ChanceScheduler):
 
         return return_agents
 
+    def get_tenant_agent_ids(self, context, tenant_id, agent_ids):
+        """Get the ids of the agents hosting loadbalancers of a tenant.
+
+        Only the agents in agent_ids are considered. The bindings are
+        read with one query, whatever the number of loadbalancers on the
+        agents.
+        """
+        if not agent_ids:
+            return set()
+
+        binding = agent_scheduler.LoadbalancerAgentBinding
+        query = context.session.query(binding.agent_id).distinct()
+        query = query.join(
+            models.LoadBalancer,
+            binding.loadbalancer_id == models.LoadBalancer.id)
+        query = query.filter(models.LoadBalancer.tenant_id == tenant_id)
+        query = query.filter(binding.agent_id.in_(agent_ids))
+        return set(agent_id for (agent_id,) in query)
+
     def get_capacity(self, configurations):
         """Get environment capacity."""
         if 'environment_capacity_score' in configurations:
@@ -114,16 +159,15 @@ class TenantScheduler(agent_scheduler.ChanceScheduler):
         else:
             return 0.0
 
-    def deserialize_agent_configurations(self, agent_conf):
+    def deserialize_agent_configurations(self, agent_conf, agent_id=None):
         """Return a dictionary for the agent configuration."""
-        if not isinstance(agent_conf, dict):
-            try:
-                agent_conf = json.loads(agent_conf)
-            except ValueError as ve:
-                LOG.error("Can't decode JSON %s : %s"
-                          % (agent_conf, ve.message))
-                return {}
-        return agent_conf
+        try:
+            return agent_config.parse_agent_configurations(
+                agent_conf, agent_id=agent_id)
+        except ValueError as ve:
+            LOG.error("Can't decode JSON %s : %s"
+                      % (agent_conf, ve.message))
+            return agent_config.AgentConfiguration()
 
     def schedule(self, plugin, context, loadbalancer_id, env=None):
         """Schedule the loadbalancer to an active loadbalancer agent.
@@ -166,77 +210,8 @@ class TenantScheduler(agent_scheduler.ChanceScheduler):
                     loadbalancer_id=loadbalancer.id)
 
             # We have active candidates to choose from.
-            # Qualify them by tenant affinity and then capacity.
-            chosen_agent = None
-            agents_by_group = defaultdict(list)
-            capacity_by_group = {}
-
-            for candidate in candidates:
-                # Organize agents by their environment group
-                # and collect each group's max capacity.
-                ac = self.deserialize_agent_configurations(
-                    candidate['configurations']
-                )
-                gn = 1
-                if 'environment_group_number' in ac:
-                    gn = ac['environment_group_number']
-                agents_by_group[gn].append(candidate)
-
-                # populate each group's capacity
-                group_capacity = self.get_capacity(ac)
-                if gn not in capacity_by_group:
-                    capacity_by_group[gn] = group_capacity
-                else:
-                    if group_capacity > capacity_by_group[gn]:
-                        capacity_by_group[gn] = group_capacity
-
-                # Do we already have this tenant assigned to this
-                # agent candidate? If we do and it has capacity
-                # then assign this loadbalancer to this agent.
-                assigned_lbs = plugin.db.list_loadbalancers_on_lbaas_agent(
-                    context, candidate['id'])
-                for assigned_lb in assigned_lbs:
-                    if loadbalancer.tenant_id == assigned_lb.tenant_id:
-                        chosen_agent = candidate
-                        break
-
-                if chosen_agent:
-                    # Does the agent which had tenants assigned
-                    # to it still have capacity?
-                    if group_capacity >= 1.0:
-                        chosen_agent = None
-                    else:
-                        break
-
-            # If we don't have an agent with capacity associated
-            # with our tenant_id, let's pick an agent based on
-            # the group with the lowest capacity score.
-            if not chosen_agent:
-                # lets get an agent from the group with the
-                # lowest capacity score
-                lowest_utilization = 1.0
-                selected_group = 1
-                for group, capacity in capacity_by_group.items():
-                    if capacity < lowest_utilization:
-                        lowest_utilization = capacity
-                        selected_group = group
-
-                LOG.debug('%s group %s scheduled with capacity %s'
-                          % (env, selected_group, lowest_utilization))
-                if lowest_utilization < 1.0:
-                    # Choose a agent in the env group for this
-                    # tenant at random.
-                    chosen_agent = random.choice(
-                        agents_by_group[selected_group]
-                    )
-
-            # If there are no agents with available capacity, raise exception
-            if not chosen_agent:
-                LOG.warn('No capacity left on any agents in env: %s' % env)
-                LOG.warn('Group capacity in environment %s were %s.'
-                         % (env, capacity_by_group))
-                raise lbaas_agentschedulerv2.NoEligibleLbaasAgent(
-                    loadbalancer_id=loadbalancer.id)
+            chosen_agent = self.choose_agent(
+                context, loadbalancer, candidates, env)
 
             binding = agent_scheduler.LoadbalancerAgentBinding()
             binding.agent = chosen_agent
@@ -248,3 +223,229 @@ class TenantScheduler(agent_scheduler.ChanceScheduler):
                       {'loadbalancer_id': loadbalancer.id,
                        'agent_id': chosen_agent['id']})
             return chosen_agent
+
+    def choose_agent(self, context, loadbalancer, candidates, env=None):
+        """Choose the agent to bind a loadbalancer to among candidates."""
+        # Qualify them by tenant affinity and then capacity.
+        chosen_agent = None
+        agents_by_group = defaultdict(list)
+        capacity_by_group = {}
+
+        # Agents already hosting a loadbalancer of this tenant.
+        tenant_agent_ids = self.get_tenant_agent_ids(
+            context,
+            loadbalancer.tenant_id,
+            [candidate['id'] for candidate in candidates]
+        )
+
+        for candidate in candidates:
+            # Organize agents by their environment group
+            # and collect each group's max capacity.
+            ac = self.deserialize_agent_configurations(
+                candidate['configurations'],
+                agent_id=candidate.get('id')
+            )
+            gn = 1
+            if 'environment_group_number' in ac:
+                gn = ac['environment_group_number']
+            agents_by_group[gn].append(candidate)
+
+            # populate each group's capacity
+            group_capacity = self.get_capacity(ac)
+            if gn not in capacity_by_group:
+                capacity_by_group[gn] = group_capacity
+            else:
+                if group_capacity > capacity_by_group[gn]:
+                    capacity_by_group[gn] = group_capacity
+
+            # Do we already have this tenant assigned to this
+            # agent candidate? If we do and it has capacity
+            # then assign this loadbalancer to this agent.
+            if candidate['id'] in tenant_agent_ids:
+                chosen_agent = candidate
+
+            if chosen_agent:
+                # Does the agent which had tenants assigned
+                # to it still have capacity?
+                if group_capacity >= 1.0:
+                    chosen_agent = None
+                else:
+                    break
+
+        # If we don't have an agent with capacity associated
+        # with our tenant_id, let's pick an agent based on
+        # the group with the lowest capacity score.
+        if not chosen_agent:
+            # lets get an agent from the group with the
+            # lowest capacity score
+            lowest_utilization = 1.0
+            selected_group = 1
+            for group, capacity in capacity_by_group.items():
+                if capacity < lowest_utilization:
+                    lowest_utilization = capacity
+                    selected_group = group
+
+            LOG.debug('%s group %s scheduled with capacity %s'
+                      % (env, selected_group, lowest_utilization))
+            if lowest_utilization < 1.0:
+                # Choose a agent in the env group for this
+                # tenant at random.
+                chosen_agent = random.choice(
+                    agents_by_group[selected_group]
+                )
+
+        # If there are no agents with available capacity, raise exception
+        if not chosen_agent:
+            LOG.warn('No capacity left on any agents in env: %s' % env)
+            LOG.warn('Group capacity in environment %s were %s.'
+                     % (env, capacity_by_group))
+            raise lbaas_agentschedulerv2.NoEligibleLbaasAgent(
+                loadbalancer_id=loadbalancer.id)
+
+        return chosen_agent
+
+
+class CapacityWeightedScheduler(TenantScheduler):
+    """Spreads loadbalancers over agent groups by their current load.
+
+    The agents of a group manage the same BIG-IP devices. Among the
+    groups with capacity left, the group with the lowest weighted load
+    of bound loadbalancers and members, combined with the highest
+    capacity score its agents report, is chosen, and within it the agent
+    carrying the least load. As with TenantScheduler, a tenant already
+    hosted on an agent with capacity left stays on that agent.
+    """
+
+    def __init__(self):
+        """Initialize with an empty agent load cache."""
+        super(CapacityWeightedScheduler, self).__init__()
+        self.agent_loads = cache.TTLCache(
+            constants_v2.SCHEDULER_LOAD_CACHE_MAX_ENTRIES,
+            cfg.CONF.f5_scheduler_load_cache_seconds)
+
+    def count_agent_loads(self, context, agent_ids):
+        """Count the loadbalancers and members bound to agents.
+
+        Returns [loadbalancers, members] by agent id, read with one
+        aggregated query. Agents without loadbalancers are left out.
+        """
+        binding = agent_scheduler.LoadbalancerAgentBinding
+        query = context.session.query(
+            binding.agent_id,
+            func.count(func.distinct(binding.loadbalancer_id)),
+            func.count(models.MemberV2.id))
+        query = query.outerjoin(
+            models.PoolV2,
+            models.PoolV2.loadbalancer_id == binding.loadbalancer_id)
+        query = query.outerjoin(
+            models.MemberV2,
+            models.MemberV2.pool_id == models.PoolV2.id)
+        query = query.filter(binding.agent_id.in_(agent_ids))
+        query = query.group_by(binding.agent_id)
+        return dict((agent_id, [loadbalancers, members])
+                    for agent_id, loadbalancers, members in query)
+
+    def get_agent_loads(self, context, agent_ids):
+        """Get the loadbalancer and member counts of agents.
+
+        Returns [loadbalancers, members] by agent id. Only the counts
+        missing from the cache are counted.
+        """
+        loads = {}
+        missing = []
+        for agent_id in agent_ids:
+            load = self.agent_loads.get(agent_id)
+            if load is None:
+                missing.append(agent_id)
+            else:
+                loads[agent_id] = load
+
+        if missing:
+            counts = self.count_agent_loads(context, missing)
+            for agent_id in missing:
+                load = counts.get(agent_id, [0, 0])
+                self.agent_loads.set(agent_id, load)
+                loads[agent_id] = load
+
+        return loads
+
+    def get_weighted_load(self, load):
+        """Get the weighted load of loadbalancer and member counts."""
+        loadbalancers, members = load
+        return (constants_v2.SCHEDULER_LOADBALANCER_WEIGHT * loadbalancers +
+                constants_v2.SCHEDULER_MEMBER_WEIGHT * members)
+
+    def choose_agent(self, context, loadbalancer, candidates, env=None):
+        """Choose the least loaded agent of the least loaded group."""
+        agents_by_group = defaultdict(list)
+        capacity_by_group = {}
+        group_by_agent = {}
+
+        for candidate in candidates:
+            ac = self.deserialize_agent_configurations(
+                candidate['configurations'], agent_id=candidate.get('id'))
+            gn = ac.environment_group_number or 1
+            agents_by_group[gn].append(candidate)
+            group_by_agent[candidate['id']] = gn
+            capacity_by_group[gn] = max(
+                self.get_capacity(ac), capacity_by_group.get(gn, 0.0))
+
+        eligible = [candidate for candidate in candidates
+                    if capacity_by_group[group_by_agent[candidate['id']]] <
+                    1.0]
+        if not eligible:
+            LOG.warn('No capacity left on any agents in env: %s' % env)
+            LOG.warn('Group capacity in environment %s were %s.'
+                     % (env, capacity_by_group))
+            raise lbaas_agentschedulerv2.NoEligibleLbaasAgent(
+                loadbalancer_id=loadbalancer.id)
+
+        agent_loads = self.get_agent_loads(
+            context, set(candidate['id'] for candidate in candidates))
+        load_by_agent = dict(
+            (agent_id, self.get_weighted_load(load))
+            for agent_id, load in agent_loads.items())
+
+        tenant_agent_ids = self.get_tenant_agent_ids(
+            context,
+            loadbalancer.tenant_id,
+            [candidate['id'] for candidate in eligible]
+        )
+        if tenant_agent_ids:
+            chosen_agent = self._least_loaded(
+                [candidate for candidate in eligible
+                 if candidate['id'] in tenant_agent_ids],
+                load_by_agent)
+        else:
+            load_by_group = defaultdict(float)
+            for candidate in eligible:
+                load_by_group[group_by_agent[candidate['id']]] += \
+                    load_by_agent[candidate['id']]
+            highest_load = max(load_by_group.values()) or 1.0
+
+            # Loads are relative to the most loaded group, so they weigh
+            # the same as capacity scores, which run from 0.0 to 1.0.
+            capacity_weight = constants_v2.SCHEDULER_CAPACITY_WEIGHT
+            weight_by_group = dict(
+                (group, (1.0 - capacity_weight) * load / highest_load +
+                 capacity_weight * capacity_by_group[group])
+                for group, load in load_by_group.items())
+            lowest_weight = min(weight_by_group.values())
+            selected_group = random.choice(
+                [group for group, weight in weight_by_group.items()
+                 if weight == lowest_weight])
+
+            LOG.debug('%s group %s scheduled with weight %s'
+                      % (env, selected_group, lowest_weight))
+            chosen_agent = self._least_loaded(
+                agents_by_group[selected_group], load_by_agent)
+
+        # Count the new loadbalancer until the counts are read again.
+        agent_loads[chosen_agent['id']][0] += 1
+        return chosen_agent
+
+    @staticmethod
+    def _least_loaded(agents, load_by_agent):
+        lowest_load = min(load_by_agent[agent['id']] for agent in agents)
+        return random.choice([agent for agent in agents
+                              if load_by_agent[agent['id']] == lowest_load])
@@ -0,0 +1,96 @@
+# coding=utf-8
+u"""Caches for F5® LBaaSv2 Driver."""
+# Copyright 2017 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from collections import OrderedDict
+import time
+
+
+class TTLCache(object):
+    """Size-bounded LRU cache with a time-to-live on every entry.
+
+    Entries expire ttl seconds after they are set. When the cache holds
+    more than max_size entries, the least recently used entry is evicted.
+    Hit, miss, expiration and eviction counters are kept for reporting.
+    """
+
+    def __init__(self, max_size, ttl, timer=time.time):
+        """Create an empty cache.
+
+        :param max_size: maximum number of entries kept in the cache.
+        :param ttl: default lifetime of an entry in seconds.
+        :param timer: callable returning the current time in seconds.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._timer = timer
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if absent/expired."""
+        try:
+            expires, value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expires <= self._timer():
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        # Re-insert to mark the entry as most recently used.
+        self._entries[key] = (expires, value)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Cache value under key, evicting the LRU entries if full."""
+        if ttl is None:
+            ttl = self.ttl
+        self._entries.pop(key, None)
+        self._entries[key] = (self._timer() + ttl, value)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """Remove key from the cache if present."""
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        self._entries.clear()
+
+    def stats(self):
+        """Return the cache counters as a dictionary."""
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expirations': self.expirations,
+                'evictions': self.evictions}
+
+    def __contains__(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] > self._timer()
+
+    def __len__(self):
+        return len(self._entries)
@@ -24,11 +24,33 @@ TOPIC_PROCESS_ON_HOST_V2 = 'f5-lbaasv2-process-on-controller'
 TOPIC_LOADBALANCER_AGENT_V2 = 'f5-lbaasv2-process-on-agent'
 
 BASE_RPC_API_VERSION = '1.0'
+# Agent messages carrying services encoded with service_codec
+ENCODED_SERVICE_RPC_API_VERSION = '1.1'
 RPC_API_NAMESPACE = None
 
 # service builder constants
 VIF_TYPE = 'f5'
 NET_CACHE_SECONDS = 1800
+NET_CACHE_MAX_ENTRIES = 4096
+SERVICE_CACHE_MAX_ENTRIES = 1024
+AGENT_CONFIG_CACHE_SECONDS = 3600
+AGENT_CONFIG_CACHE_MAX_ENTRIES = 16384
+
+# service codec constants
+SERVICE_COMPRESSION_LEVEL = 6
+SERVICE_PORT_FIELDS = frozenset([
+    'id', 'name', 'tenant_id', 'network_id', 'mac_address', 'fixed_ips',
+    'device_id', 'device_owner', 'admin_state_up', 'status',
+    'binding:host_id', 'binding:vif_type'])
+
+# CapacityWeightedScheduler constants
+SCHEDULER_LOAD_CACHE_MAX_ENTRIES = 4096
+SCHEDULER_LOADBALANCER_WEIGHT = 1.0
+SCHEDULER_MEMBER_WEIGHT = 0.1
+SCHEDULER_CAPACITY_WEIGHT = 0.5
+
+# Last known entity statuses kept by the plugin RPC callbacks
+STATUS_CACHE_MAX_ENTRIES = 65536
 
 # SUPPORTED PROVIDERNET TUNNEL NETWORK TYPES
 TUNNEL_TYPES = ['vxlan', 'gre']
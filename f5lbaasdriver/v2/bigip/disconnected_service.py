@@ -39,7 +39,32 @@ class DisconnectedService(object):
                 result[record.network_id].append(db._make_segment_dict(record))
             return result
 
-    def get_network_segment(self, context, agent_configuration, network):
+    def get_network_segments_by_network_ids(self, session, network_ids):
+        """Get the segments of several networks with a single query.
+
+        :returns: dict of segment lists in segment index order, by network
+        id. Networks without segments map to an empty list.
+        """
+        result = dict((network_id, []) for network_id in network_ids)
+        if not result:
+            return result
+
+        with session.begin(subtransactions=True):
+            query = (session.query(models.NetworkSegment).
+                     filter(models.NetworkSegment.network_id.in_(
+                         list(result))).
+                     order_by(models.NetworkSegment.segment_index))
+            for record in query:
+                result[record.network_id].append(db._make_segment_dict(record))
+        return result
+
+    def get_network_segment(self, context, agent_configuration, network,
+                            segments=None):
+        """Get the segment of a network matching the agent configuration.
+
+        The network's segments are looked up unless they are passed in,
+        e.g. from get_network_segments_by_network_ids.
+        """
         data = None
 
         network_segment_physical_network = \
@@ -50,8 +75,10 @@ class DisconnectedService(object):
             agent_configuration.get('tunnel_types', [])
         ]
         # look up segment details in the ml2_network_segments table
-        segments = db.get_network_segments(context.session, network['id'],
-                                           filter_dynamic=None)
+        if segments is None:
+            segments = db.get_network_segments(context.session,
+                                               network['id'],
+                                               filter_dynamic=None)
 
         for segment in segments:
             if ((network_segment_physical_network ==
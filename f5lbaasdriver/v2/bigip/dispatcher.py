@@ -0,0 +1,231 @@
+# coding=utf-8
+u"""Asynchronous service builds and agent messages for the F5® driver."""
+# Copyright 2017 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import eventlet
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from neutron import context as n_context
+from neutron.plugins.common import constants as plugin_constants
+
+from neutron_lbaas.db.loadbalancer import models
+from neutron_lbaas.extensions import lbaas_agentschedulerv2
+
+LOG = logging.getLogger(__name__)
+
+cfg.CONF.import_opt('f5_service_delta_mode',
+                    'f5lbaasdriver.v2.bigip.service_builder')
+
+OPTS = [
+    cfg.BoolOpt(
+        'f5_async_dispatch',
+        default=False,
+        help=('Schedule, build the service and send the agent message of '
+              'listener, pool, member, health monitor and L7 policy/rule '
+              'operations after the API request returns. Operations '
+              'queued for the same loadbalancer are sent with one '
+              'service build.')
+    ),
+    cfg.IntOpt(
+        'f5_async_dispatch_workers',
+        default=8,
+        help=('Loadbalancers whose queued operations are processed at '
+              'the same time. When every worker is busy, operations on '
+              'other loadbalancers are processed within the API request.')
+    ),
+    cfg.IntOpt(
+        'f5_async_dispatch_queue_size',
+        default=1000,
+        help=('Loadbalancers with queued operations above which new '
+              'operations are processed within the API request.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
+
+class EntityOperation(object):
+    """Operation sending an entity message to the agent.
+
+    The message is sent with the agent RPC method of the operation. The
+    entity dictionaries are the arguments of that method before the
+    service, e.g. the old and new member of update_member.
+    """
+
+    def __init__(self, agent_rpc, rpc_method, api_dicts,
+                 get_rpc_service=None):
+        self.agent_rpc = agent_rpc
+        self.rpc_method = rpc_method
+        self.api_dicts = api_dicts
+        self.get_rpc_service = get_rpc_service or (lambda service: service)
+
+    def __call__(self, context, agent_host, service):
+        rpc_callable = getattr(self.agent_rpc, self.rpc_method)
+        args = self.api_dicts + (self.get_rpc_service(service), agent_host)
+        rpc_callable(context, *args)
+        self.sent(context, service)
+
+    def sent(self, context, service):
+        """Act on the service after the message is sent."""
+        pass
+
+
+class ServiceDispatcher(object):
+    """Runs entity operations with a service built outside API requests.
+
+    An operation is a callable taking a context, the host of the agent
+    hosting the loadbalancer and the loadbalancer's service. Operations
+    are queued by loadbalancer. A worker schedules the loadbalancer,
+    builds its service once and runs every operation queued for it, in
+    order. Operations queued while a worker builds the service of the
+    same loadbalancer run after it, with a new build. When the queue or
+    the worker pool is full, operations run in the caller instead.
+
+    As the request has returned, failures can not be raised to the
+    plugin. The loadbalancer and the entities of the operations that
+    failed are set to ERROR instead.
+    """
+
+    def __init__(self, driver, workers=None, queue_size=None):
+        """Create the worker pool of the dispatcher."""
+        self.driver = driver
+        if workers is None:
+            workers = cfg.CONF.f5_async_dispatch_workers
+        if queue_size is None:
+            queue_size = cfg.CONF.f5_async_dispatch_queue_size
+        self.queue_size = queue_size
+        self.pool = eventlet.GreenPool(workers)
+
+        # Queued (operation, entity) pairs by loadbalancer id, and the
+        # loadbalancers a worker is processing.
+        self._pending = {}
+        self._running = set()
+
+        self.dispatched = 0
+        self.coalesced = 0
+        self.builds = 0
+        self.messages = 0
+
+    def dispatch(self, context, loadbalancer_id, operation, entity=None):
+        """Queue an operation on a loadbalancer's service.
+
+        :param entity: (model, id) of the entity the operation changes,
+                       set to ERROR if the operation fails.
+        """
+        self.dispatched += 1
+        queued = self._pending.get(loadbalancer_id)
+        if queued is not None:
+            queued.append((operation, entity))
+            self.coalesced += 1
+            return
+
+        if loadbalancer_id in self._running:
+            # the worker building the loadbalancer runs them next
+            self._pending[loadbalancer_id] = [(operation, entity)]
+            return
+
+        # Spawning on a full pool would block the request until a worker
+        # is free, so run the operation in the request instead.
+        if (len(self._pending) >= self.queue_size or
+                not self.pool.free()):
+            LOG.warning('%d loadbalancers have queued operations and %d '
+                        'workers are free; processing loadbalancer %s in '
+                        'the request.'
+                        % (len(self._pending), self.pool.free(),
+                           loadbalancer_id))
+            self.run_operations(context, loadbalancer_id, [operation],
+                                [entity])
+            return
+
+        self._pending[loadbalancer_id] = [(operation, entity)]
+        self._running.add(loadbalancer_id)
+        self.pool.spawn_n(self._process, loadbalancer_id)
+
+    def _process(self, loadbalancer_id):
+        try:
+            while loadbalancer_id in self._pending:
+                operations, entities = zip(
+                    *self._pending.pop(loadbalancer_id))
+                self.run_operations(
+                    n_context.get_admin_context(), loadbalancer_id,
+                    list(operations), list(entities))
+        finally:
+            self._running.discard(loadbalancer_id)
+
+    def run_operations(self, context, loadbalancer_id, operations,
+                       entities=None):
+        """Build a loadbalancer's service and run operations with it.
+
+        :param entities: (model, id) of the entity each operation changes,
+                         or None, set to ERROR when the operation fails.
+        """
+        entities = entities or [None] * len(operations)
+        driver = self.driver
+        try:
+            loadbalancer = driver.plugin.db.get_loadbalancer(
+                context, loadbalancer_id)
+            agent = driver.scheduler.schedule(
+                driver.plugin,
+                context,
+                loadbalancer_id,
+                driver.env
+            )
+            driver.service_builder.invalidate_service(loadbalancer_id)
+            if cfg.CONF.f5_service_delta_mode:
+                # the agent patches its stored service with the entity
+                service = {'loadbalancer': loadbalancer.to_api_dict()}
+            else:
+                service = driver.service_builder.build(
+                    context, loadbalancer, agent)
+            self.builds += 1
+        except (lbaas_agentschedulerv2.NoEligibleLbaasAgent,
+                lbaas_agentschedulerv2.NoActiveLbaasAgent) as e:
+            LOG.error("Exception: dispatch to loadbalancer %s: %s"
+                      % (loadbalancer_id, e))
+            self._set_error(context, loadbalancer_id, entities)
+            return
+        except Exception as e:
+            LOG.exception("Exception: dispatch to loadbalancer %s: %s"
+                          % (loadbalancer_id, e.message))
+            self._set_error(context, loadbalancer_id, entities)
+            return
+
+        for operation, entity in zip(operations, entities):
+            try:
+                operation(context, agent['host'], service)
+                self.messages += 1
+            except Exception as e:
+                LOG.exception("Exception: dispatch to loadbalancer %s: %s"
+                              % (loadbalancer_id, e.message))
+                self._set_error(context, loadbalancer_id, [entity])
+
+    def _set_error(self, context, loadbalancer_id, entities):
+        """Set failed entities and their loadbalancer to ERROR."""
+        failed = [entity for entity in entities if entity]
+        failed.append((models.LoadBalancer, loadbalancer_id))
+        for model, entity_id in failed:
+            try:
+                self.driver.plugin.db.update_status(
+                    context, model, entity_id, plugin_constants.ERROR)
+            except Exception as e:
+                LOG.error("Exception: dispatch to loadbalancer %s: "
+                          "setting %s %s to ERROR: %s"
+                          % (loadbalancer_id, model.NAME, entity_id,
+                             e.message))
+
+    def wait(self):
+        """Wait until every queued operation has run."""
+        self.pool.waitall()
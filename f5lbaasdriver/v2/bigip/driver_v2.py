@@ -19,7 +19,6 @@ import sys
 import uuid
 
 from oslo_config import cfg
-from oslo_log import helpers as log_helpers
 from oslo_log import log as logging
 from oslo_utils import importutils
 
@@ -34,12 +33,17 @@ from neutron_lbaas.db.loadbalancer import models
 from neutron_lbaas.extensions import lbaas_agentschedulerv2
 
 from f5lbaasdriver.v2.bigip import agent_rpc
+from f5lbaasdriver.v2.bigip import dispatcher
 from f5lbaasdriver.v2.bigip import exceptions as f5_exc
 from f5lbaasdriver.v2.bigip import neutron_client
 from f5lbaasdriver.v2.bigip import plugin_rpc
+from f5lbaasdriver.v2.bigip import tracing
 
 LOG = logging.getLogger(__name__)
 
+cfg.CONF.import_opt('f5_service_delta_mode',
+                    'f5lbaasdriver.v2.bigip.service_builder')
+
 OPTS = [
     cfg.StrOpt(
         'f5_loadbalancer_pool_scheduler_driver_v2',
@@ -47,7 +51,10 @@ OPTS = [
             'f5lbaasdriver.v2.bigip.agent_scheduler.TenantScheduler'
         ),
         help=('Driver to use for scheduling '
-              'pool to a default loadbalancer agent')
+              'pool to a default loadbalancer agent. '
+              'f5lbaasdriver.v2.bigip.agent_scheduler.'
+              'CapacityWeightedScheduler spreads loadbalancers by the '
+              'loadbalancers and members agents already carry.')
     ),
     cfg.StrOpt(
         'f5_loadbalancer_service_builder_v2',
@@ -55,6 +62,13 @@ OPTS = [
             'f5lbaasdriver.v2.bigip.service_builder.LBaaSv2ServiceBuilder'
         ),
         help=('Default class to use for building a service object.')
+    ),
+    cfg.BoolOpt(
+        'f5_agent_stats_push',
+        default=False,
+        help=('Agents report the statistics of their loadbalancers '
+              'periodically, so statistics requests are not sent to '
+              'them.')
     )
 ]
 
@@ -82,6 +96,9 @@ class F5DriverV2(object):
         self.plugin = plugin
         self.env = env
 
+        tracing.TRACER.configure()
+        cfg.CONF.register_mutate_hook(tracing.TRACER.mutate_config)
+
         self.loadbalancer = LoadBalancerManager(self)
         self.listener = ListenerManager(self)
         self.pool = PoolManager(self)
@@ -100,6 +117,10 @@ class F5DriverV2(object):
         self.agent_rpc = agent_rpc.LBaaSv2AgentRPC(self)
         self.plugin_rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(self)
 
+        self.dispatcher = None
+        if cfg.CONF.f5_async_dispatch:
+            self.dispatcher = dispatcher.ServiceDispatcher(self)
+
         self.q_client = \
             neutron_client.F5NetworksNeutronClient(self.plugin)
 
@@ -129,6 +150,9 @@ class F5DriverV2(object):
 class EntityManager(object):
     '''Parent for all managers defined in this module.'''
 
+    # neutron lbaas model of the managed entity
+    model = None
+
     def __init__(self, driver):
         self.driver = driver
         self.api_dict = None
@@ -138,9 +162,8 @@ class EntityManager(object):
         '''Perform operations common to create and delete for managers.'''
 
         try:
-            agent_host, service = self._setup_crud(context, entity)
-            rpc_callable = getattr(self.driver.agent_rpc, rpc_method)
-            rpc_callable(context, self.api_dict, service, agent_host)
+            self._run(context, entity,
+                      self._rpc_operation(rpc_method, self.api_dict))
         except (lbaas_agentschedulerv2.NoEligibleLbaasAgent,
                 lbaas_agentschedulerv2.NoActiveLbaasAgent) as e:
             LOG.error("Exception: %s: %s" % (rpc_method, e))
@@ -148,6 +171,46 @@ class EntityManager(object):
             LOG.error("Exception: %s: %s" % (rpc_method, e))
             raise e
 
+    def _run(self, context, entity, operation):
+        '''Run an operation with the service of the entity's loadbalancer.
+
+        With f5_async_dispatch the operation is queued to the driver's
+        dispatcher, which builds the service after the request returns.
+
+        :param context: auth context for performing CRUD operation
+        :param entity: neutron lbaas entity -- target of the CRUD operation
+        :param operation: callable taking the context, agent host and
+                          service
+        :raises: F5NoAttachedLoadbalancerException
+        '''
+
+        # the request changed the status of the entity and loadbalancer
+        self.driver.plugin_rpc.invalidate_status(entity.id)
+        if self.loadbalancer:
+            self.driver.plugin_rpc.invalidate_status(self.loadbalancer.id)
+
+        if cfg.CONF.f5_async_dispatch:
+            if not (entity.attached_to_loadbalancer() and self.loadbalancer):
+                raise F5NoAttachedLoadbalancerException()
+            self.driver.dispatcher.dispatch(
+                context, self.loadbalancer.id, operation,
+                entity=(self.model, entity.id))
+        else:
+            agent_host, service = self._setup_crud(context, entity)
+            operation(context, agent_host, service)
+
+    def _rpc_operation(self, rpc_method, *api_dicts):
+        '''Get an operation sending an entity message to the agent.
+
+        :param rpc_method: name of the LBaaSv2AgentRPC method to call
+        :param api_dicts: entity dictionaries to send with the service
+        :returns: dispatcher.EntityOperation
+        '''
+
+        return dispatcher.EntityOperation(
+            self.driver.agent_rpc, rpc_method, api_dicts,
+            self._get_rpc_service)
+
     def _setup_crud(self, context, entity):
         '''Setup CRUD operations for managers to make calls to agent.
 
@@ -158,13 +221,16 @@ class EntityManager(object):
         '''
 
         if entity.attached_to_loadbalancer() and self.loadbalancer:
-            return self._schedule_agent_create_service(context)
+            return self._schedule_agent_create_service(
+                context, entity_service=True)
         raise F5NoAttachedLoadbalancerException()
 
-    def _schedule_agent_create_service(self, context):
+    def _schedule_agent_create_service(self, context, entity_service=False):
         '''Schedule agent and build service--used for most managers.
 
         :param context: auth context for performing crud operation
+        :param entity_service: get the service of an entity message, which
+                               only holds the loadbalancer in delta mode
         :returns: tuple -- (agent object, service dict)
         '''
 
@@ -174,15 +240,50 @@ class EntityManager(object):
             self.loadbalancer.id,
             self.driver.env
         )
-        service = self.driver.service_builder.build(
-            context, self.loadbalancer, agent)
+        # the operation being sent changes the loadbalancer's service
+        self.driver.service_builder.invalidate_service(self.loadbalancer.id)
+        self.driver.plugin_rpc.invalidate_status(self.loadbalancer.id)
+        if entity_service and cfg.CONF.f5_service_delta_mode:
+            # the agent patches its stored service with the entity
+            service = {'loadbalancer': self.loadbalancer.to_api_dict()}
+        else:
+            service = self.driver.service_builder.build(
+                context, self.loadbalancer, agent)
         return agent['host'], service
 
+    def _get_rpc_service(self, service):
+        '''Get the service definition to send with an entity message.
+
+        In delta mode the service only holds the loadbalancer. The
+        message carries the service version it applies to and the version
+        after it. An agent whose stored service is at the base version
+        applies the entity in the message to it and stores the new
+        version; otherwise it requests the full service with
+        get_service_by_loadbalancer_id.
+
+        :param service: service of the entity message
+        :returns: dict -- service definition to send to the agent
+        '''
+
+        if not cfg.CONF.f5_service_delta_mode or not service:
+            return service
+        base_version, version = \
+            self.driver.service_builder.next_service_version(
+                service['loadbalancer']['id'])
+        return {
+            'loadbalancer': service['loadbalancer'],
+            'base_service_version': base_version,
+            'service_version': version,
+            'delta': True
+        }
+
 
 class LoadBalancerManager(EntityManager):
     """LoadBalancerManager class handles Neutron LBaaS CRUD."""
 
-    @log_helpers.log_method_call
+    model = models.LoadBalancer
+
+    @tracing.trace
     def create(self, context, loadbalancer):
         """Create a loadbalancer."""
         driver = self.driver
@@ -221,7 +322,7 @@ class LoadBalancerManager(EntityManager):
             LOG.error("Exception: loadbalancer create: %s" % e.message)
             raise e
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update(self, context, old_loadbalancer, loadbalancer):
         """Update a loadbalancer."""
         driver = self.driver
@@ -247,7 +348,7 @@ class LoadBalancerManager(EntityManager):
             LOG.error("Exception: loadbalancer update: %s" % e.message)
             raise e
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def delete(self, context, loadbalancer):
         """Delete a loadbalancer."""
         driver = self.driver
@@ -266,37 +367,47 @@ class LoadBalancerManager(EntityManager):
             LOG.error("Exception: loadbalancer delete: %s" % e)
             raise e
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def refresh(self, context, loadbalancer):
         """Refresh a loadbalancer."""
         pass
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def stats(self, context, loadbalancer):
+        """Request the statistics of a loadbalancer from its agent.
+
+        The agent hosting the loadbalancer is looked up from its binding
+        and sent only the loadbalancer and its listeners.
+        """
         driver = self.driver
+        if cfg.CONF.f5_agent_stats_push:
+            # The agents report statistics of their loadbalancers.
+            return
         try:
-            agent = driver.scheduler.schedule(
+            scheduler = driver.scheduler
+            lbaas_agent = scheduler.get_lbaas_agent_hosting_loadbalancer(
                 driver.plugin,
                 context,
                 loadbalancer.id,
                 driver.env
             )
-            service = driver.service_builder.build(context,
-                                                   loadbalancer,
-                                                   agent)
+            if not lbaas_agent:
+                LOG.warning("No agent hosts loadbalancer %s, not requesting "
+                            "its statistics" % loadbalancer.id)
+                return
+
+            loadbalancer_dict = loadbalancer.to_api_dict()
+            service = {
+                'loadbalancer': loadbalancer_dict,
+                'listeners': [listener.to_api_dict()
+                              for listener in loadbalancer.listeners]
+            }
             driver.agent_rpc.update_loadbalancer_stats(
                 context,
-                loadbalancer.to_api_dict(),
+                loadbalancer_dict,
                 service,
-                agent['host']
+                lbaas_agent['agent']['host']
             )
-        except (lbaas_agentschedulerv2.NoEligibleLbaasAgent,
-                lbaas_agentschedulerv2.NoActiveLbaasAgent) as e:
-            LOG.error("Exception: update_loadbalancer_stats: %s" % e.message)
-            driver._handle_driver_error(context,
-                                        models.LoadBalancer,
-                                        loadbalancer.id,
-                                        plugin_constants.ERROR)
         except Exception as e:
             LOG.error("Exception: update_loadbalancer_stats: %s" % e.message)
             raise e
@@ -305,7 +416,9 @@ class LoadBalancerManager(EntityManager):
 class ListenerManager(EntityManager):
     """ListenerManager class handles Neutron LBaaS listener CRUD."""
 
-    @log_helpers.log_method_call
+    model = models.Listener
+
+    @tracing.trace
     def create(self, context, listener):
         """Create a listener."""
 
@@ -314,27 +427,22 @@ class ListenerManager(EntityManager):
             loadbalancer=False, default_pool=False)
         self._call_rpc(context, listener, 'create_listener')
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update(self, context, old_listener, listener):
         """Update a listener."""
 
-        driver = self.driver
         self.loadbalancer = listener.loadbalancer
         try:
-            agent_host, service = self._setup_crud(context, listener)
-            driver.agent_rpc.update_listener(
-                context,
+            self._run(context, listener, self._rpc_operation(
+                'update_listener',
                 old_listener.to_dict(loadbalancer=False,
                                      default_pool=False),
-                listener.to_dict(loadbalancer=False, default_pool=False),
-                service,
-                agent_host
-            )
+                listener.to_dict(loadbalancer=False, default_pool=False)))
         except Exception as e:
             LOG.error("Exception: listener update: %s" % e.message)
             raise e
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def delete(self, context, listener):
         """Delete a listener."""
 
@@ -347,6 +455,8 @@ class ListenerManager(EntityManager):
 class PoolManager(EntityManager):
     """PoolManager class handles Neutron LBaaS pool CRUD."""
 
+    model = models.PoolV2
+
     def _get_pool_dict(self, pool):
         pool_dict = pool.to_dict(
             healthmonitor=False,
@@ -360,7 +470,7 @@ class PoolManager(EntityManager):
         pool_dict['operating_status'] = pool.operating_status
         return pool_dict
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def create(self, context, pool):
         """Create a pool."""
 
@@ -368,26 +478,21 @@ class PoolManager(EntityManager):
         self.api_dict = self._get_pool_dict(pool)
         self._call_rpc(context, pool, 'create_pool')
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update(self, context, old_pool, pool):
         """Update a pool."""
 
-        driver = self.driver
         self.loadbalancer = pool.loadbalancer
         try:
-            agent_host, service = self._setup_crud(context, pool)
-            driver.agent_rpc.update_pool(
-                context,
+            self._run(context, pool, self._rpc_operation(
+                'update_pool',
                 self._get_pool_dict(old_pool),
-                self._get_pool_dict(pool),
-                service,
-                agent_host
-            )
+                self._get_pool_dict(pool)))
         except Exception as e:
             LOG.error("Exception: pool update: %s" % e.message)
             raise e
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def delete(self, context, pool):
         """Delete a pool."""
 
@@ -399,7 +504,9 @@ class PoolManager(EntityManager):
 class MemberManager(EntityManager):
     """MemberManager class handles Neutron LBaaS pool member CRUD."""
 
-    @log_helpers.log_method_call
+    model = models.MemberV2
+
+    @tracing.trace
     def create(self, context, member):
         """Create a member."""
 
@@ -407,59 +514,72 @@ class MemberManager(EntityManager):
         self.api_dict = member.to_dict(pool=False)
         self._call_rpc(context, member, 'create_member')
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update(self, context, old_member, member):
         """Update a member."""
 
-        driver = self.driver
         self.loadbalancer = member.pool.loadbalancer
         try:
-            agent_host, service = self._setup_crud(context, member)
-            driver.agent_rpc.update_member(
-                context,
+            self._run(context, member, self._rpc_operation(
+                'update_member',
                 old_member.to_dict(pool=False),
-                member.to_dict(pool=False),
-                service,
-                agent_host
-            )
+                member.to_dict(pool=False)))
         except Exception as e:
             LOG.error("Exception: member update: %s" % e.message)
             raise e
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def delete(self, context, member):
         """Delete a member."""
         self.loadbalancer = member.pool.loadbalancer
-        member_port = None
-        driver = self.driver
         try:
-            agent_host, service = self._setup_crud(context, member)
+            self._run(context, member, MemberDeleteOperation(
+                self.driver, member, self._get_rpc_service))
+        except Exception as e:
+            LOG.error("Exception: member delete: %s" % e.message)
+            raise e
 
-            driver.agent_rpc.delete_member(
-                context, member.to_dict(pool=False), service, agent_host)
 
-            # Get port for member.
-            members = service.get("members", [])
-            for m in members:
-                if member.id == m['id']:
-                    member_port = m.get('port', None)
-                    break
+class MemberDeleteOperation(dispatcher.EntityOperation):
+    """Sends delete_member and deletes the member port the driver owns."""
 
-            if member_port:
-                if member_port['device_owner'] == 'network:f5lbaasv2':
-                    LOG.debug("Delete F5 Networks owned port")
-                    driver.q_client.delete_port(context,
-                                                port_id=member_port['id'])
+    def __init__(self, driver, member, get_rpc_service=None):
+        super(MemberDeleteOperation, self).__init__(
+            driver.agent_rpc, 'delete_member', (member.to_dict(pool=False),),
+            get_rpc_service)
+        self.driver = driver
+        self.member = member
 
-        except Exception as e:
-            LOG.error("Exception: member delete: %s" % e.message)
-            raise e
+    def sent(self, context, service):
+        # Get port for member.
+        member_port = None
+        if not cfg.CONF.f5_service_delta_mode:
+            for m in service.get("members", []):
+                if self.member.id == m['id']:
+                    member_port = m.get('port', None)
+                    break
+        else:
+            # a delta service does not list the members
+            filters = {'fixed_ips': {'subnet_id': [self.member.subnet_id],
+                                     'ip_address': [self.member.address]}}
+            ports = self.driver.plugin.db._core_plugin.get_ports(
+                context, filters)
+            if len(ports) == 1:
+                member_port = ports[0]
+
+        if member_port:
+            if member_port['device_owner'] == 'network:f5lbaasv2':
+                LOG.debug("Delete F5 Networks owned port")
+                self.driver.q_client.delete_port(context,
+                                                 port_id=member_port['id'])
 
 
 class HealthMonitorManager(EntityManager):
     """HealthMonitorManager class handles Neutron LBaaS monitor CRUD."""
 
-    @log_helpers.log_method_call
+    model = models.HealthMonitorV2
+
+    @tracing.trace
     def create(self, context, health_monitor):
         """Create a health monitor."""
 
@@ -467,26 +587,21 @@ class HealthMonitorManager(EntityManager):
         self.api_dict = health_monitor.to_dict(pool=False)
         self._call_rpc(context, health_monitor, 'create_health_monitor')
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update(self, context, old_health_monitor, health_monitor):
         """Update a health monitor."""
 
-        driver = self.driver
         self.loadbalancer = health_monitor.pool.loadbalancer
         try:
-            agent_host, service = self._setup_crud(context, health_monitor)
-            driver.agent_rpc.update_health_monitor(
-                context,
+            self._run(context, health_monitor, self._rpc_operation(
+                'update_health_monitor',
                 old_health_monitor.to_dict(pool=False),
-                health_monitor.to_dict(pool=False),
-                service,
-                agent_host
-            )
+                health_monitor.to_dict(pool=False)))
         except Exception as e:
             LOG.error("Exception: health monitor update: %s" % e.message)
             raise e
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def delete(self, context, health_monitor):
         """Delete a health monitor."""
 
@@ -498,7 +613,9 @@ class HealthMonitorManager(EntityManager):
 class L7PolicyManager(EntityManager):
     """L7PolicyManager class handles Neutron LBaaS L7 Policy CRUD."""
 
-    @log_helpers.log_method_call
+    model = models.L7Policy
+
+    @tracing.trace
     def create(self, context, policy):
         """Create an L7 policy."""
 
@@ -506,26 +623,21 @@ class L7PolicyManager(EntityManager):
         self.api_dict = policy.to_dict(listener=False, rules=False)
         self._call_rpc(context, policy, 'create_l7policy')
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update(self, context, old_policy, policy):
         """Update a policy."""
 
-        driver = self.driver
         self.loadbalancer = policy.listener.loadbalancer
         try:
-            agent_host, service = self._setup_crud(context, policy)
-            driver.agent_rpc.update_l7policy(
-                context,
+            self._run(context, policy, self._rpc_operation(
+                'update_l7policy',
                 old_policy.to_dict(listener=False),
-                policy.to_dict(listener=False),
-                service,
-                agent_host
-            )
+                policy.to_dict(listener=False)))
         except Exception as e:
             LOG.error("Exception: l7policy update: %s" % e.message)
             raise e
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def delete(self, context, policy):
         """Delete a policy."""
 
@@ -537,7 +649,9 @@ class L7PolicyManager(EntityManager):
 class L7RuleManager(EntityManager):
     """L7RuleManager class handles Neutron LBaaS L7 Rule CRUD."""
 
-    @log_helpers.log_method_call
+    model = models.L7Rule
+
+    @tracing.trace
     def create(self, context, rule):
         """Create an L7 rule."""
 
@@ -545,26 +659,21 @@ class L7RuleManager(EntityManager):
         self.api_dict = rule.to_dict(policy=False)
         self._call_rpc(context, rule, 'create_l7rule')
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update(self, context, old_rule, rule):
         """Update a rule."""
 
-        driver = self.driver
         self.loadbalancer = rule.policy.listener.loadbalancer
         try:
-            agent_host, service = self._setup_crud(context, rule)
-            driver.agent_rpc.update_l7rule(
-                context,
+            self._run(context, rule, self._rpc_operation(
+                'update_l7rule',
                 old_rule.to_dict(policy=False),
-                rule.to_dict(policy=False),
-                service,
-                agent_host
-            )
+                rule.to_dict(policy=False)))
         except Exception as e:
             LOG.error("Exception: l7rule update: %s" % e.message)
             raise e
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def delete(self, context, rule):
         """Delete a rule."""
 
@@ -14,9 +14,10 @@ u"""RPC Callbacks for F5® LBaaSv2 Plugins."""
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import collections
 import uuid
 
-from oslo_log import helpers as log_helpers
+from oslo_config import cfg
 from oslo_log import log as logging
 
 from neutron.api.v2 import attributes
@@ -25,12 +26,75 @@ from neutron.common import rpc as neutron_rpc
 from neutron.db import agents_db
 from neutron.extensions import portbindings
 from neutron.plugins.common import constants as plugin_constants
+from neutron_lbaas import agent_scheduler
 from neutron_lbaas.db.loadbalancer import models
+from neutron_lbaas.services.loadbalancer import constants as lb_const
+import sqlalchemy as sa
+from sqlalchemy import orm
 
+from f5lbaasdriver.v2.bigip import cache
 from f5lbaasdriver.v2.bigip import constants_v2 as constants
+from f5lbaasdriver.v2.bigip import tracing
 
 LOG = logging.getLogger(__name__)
 
+cfg.CONF.import_opt('f5_service_delta_mode',
+                    'f5lbaasdriver.v2.bigip.service_builder')
+
+OPTS = [
+    cfg.IntOpt(
+        'f5_status_cache_seconds',
+        default=0,
+        help=('Seconds to remember the last status set for an entity, so '
+              'that agent reports repeating its operating status are '
+              'dropped without reading the database. Reports with a '
+              'provisioning status always read the database, as API '
+              'requests in other neutron-server processes may have '
+              'changed it. With separate API and RPC workers this is the '
+              'longest an operating status set outside the agent reports '
+              'may be missed. 0 disables the cache; unchanged statuses are '
+              'still not written.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
+STATS_FIELDS = (lb_const.STATS_IN_BYTES, lb_const.STATS_OUT_BYTES,
+                lb_const.STATS_ACTIVE_CONNECTIONS,
+                lb_const.STATS_TOTAL_CONNECTIONS)
+
+# Entities whose status update_statuses sets, by entity type: the model,
+# the column of the id of their loadbalancer and the joins reaching it.
+STATUS_MODELS = {
+    models.LoadBalancer.NAME: (
+        models.LoadBalancer, models.LoadBalancer.id, ()),
+    models.Listener.NAME: (
+        models.Listener, models.Listener.loadbalancer_id, ()),
+    models.PoolV2.NAME: (
+        models.PoolV2, models.PoolV2.loadbalancer_id, ()),
+    models.MemberV2.NAME: (
+        models.MemberV2, models.PoolV2.loadbalancer_id,
+        ((models.PoolV2, models.MemberV2.pool_id == models.PoolV2.id),)),
+    models.HealthMonitorV2.NAME: (
+        models.HealthMonitorV2, models.PoolV2.loadbalancer_id,
+        ((models.PoolV2,
+          models.PoolV2.healthmonitor_id == models.HealthMonitorV2.id),)),
+    models.L7Policy.NAME: (
+        models.L7Policy, models.Listener.loadbalancer_id,
+        ((models.Listener,
+          models.L7Policy.listener_id == models.Listener.id),)),
+    models.L7Rule.NAME: (
+        models.L7Rule, models.Listener.loadbalancer_id,
+        ((models.L7Policy, models.L7Rule.l7policy_id == models.L7Policy.id),
+         (models.Listener,
+          models.L7Policy.listener_id == models.Listener.id)))
+}
+
+# Entity types whose status is left as is while they are pending delete.
+# The others keep PENDING_DELETE but take the operating status.
+PENDING_DELETE_SKIPPED = (models.PoolV2.NAME, models.MemberV2.NAME,
+                          models.HealthMonitorV2.NAME)
+
 
 class LBaaSv2PluginCallbacksRPC(object):
     """Agent to plugin RPC API."""
@@ -38,6 +102,9 @@ class LBaaSv2PluginCallbacksRPC(object):
     def __init__(self, driver=None):
         """LBaaSv2PluginCallbacksRPC constructor."""
         self.driver = driver
+        self.status_cache = cache.TTLCache(
+            constants.STATUS_CACHE_MAX_ENTRIES,
+            cfg.CONF.f5_status_cache_seconds)
 
     def create_rpc_listener(self):
         topic = constants.TOPIC_PROCESS_ON_HOST_V2
@@ -52,8 +119,82 @@ class LBaaSv2PluginCallbacksRPC(object):
             fanout=False)
         self.conn.consume_in_threads()
 
+    def _invalidate_service(self, entity):
+        """Drop the cached service of the loadbalancer owning entity."""
+        loadbalancer = entity.root_loadbalancer
+        if loadbalancer:
+            self.driver.service_builder.invalidate_service(loadbalancer.id)
+
+    @staticmethod
+    def _is_status_unchanged(current, provisioning_status,
+                             operating_status):
+        """Whether setting a status leaves the current status as is.
+
+        :param current: (provisioning status, operating status) tuple,
+                        with no operating status for entities without one.
+        """
+        current_provisioning, current_operating = current
+        return ((not provisioning_status or
+                 provisioning_status == current_provisioning) and
+                (not operating_status or current_operating is None or
+                 operating_status == current_operating))
+
+    def _is_status_cached(self, entity_id, provisioning_status,
+                          operating_status):
+        """Whether the last status set for an entity is the same.
+
+        Only operating status reports are answered from memory. API
+        requests set the provisioning status to PENDING_* in processes
+        which can not invalidate this cache, and dropping the agent's
+        report would leave the loadbalancer locked.
+        """
+        if not self.status_cache.ttl or provisioning_status:
+            return False
+        current = self.status_cache.get(entity_id)
+        return current is not None and self._is_status_unchanged(
+            current, provisioning_status, operating_status)
+
+    def _cache_status(self, entity_id, provisioning_status,
+                      operating_status):
+        if self.status_cache.ttl:
+            self.status_cache.set(entity_id,
+                                  (provisioning_status, operating_status))
+
+    def invalidate_status(self, entity_id):
+        """Forget the last status set for an entity."""
+        self.status_cache.invalidate(entity_id)
+
+    def _update_status(self, context, model, entity, provisioning_status,
+                       operating_status):
+        """Set the status of an entity unless it is unchanged.
+
+        :param entity: the entity as read from the database.
+        """
+        has_operating_status = hasattr(model, 'operating_status')
+        current = (entity.provisioning_status,
+                   entity.operating_status if has_operating_status else None)
+        if not self._is_status_unchanged(
+                current, provisioning_status, operating_status):
+            self.driver.plugin.db.update_status(
+                context,
+                model,
+                entity.id,
+                provisioning_status,
+                operating_status
+            )
+            self._invalidate_service(entity)
+            current = (provisioning_status or current[0],
+                       (operating_status or current[1])
+                       if has_operating_status else None)
+        self._cache_status(entity.id, *current)
+
+    def _invalidate_destroyed_service(self, get_entity, context, *args):
+        """Drop the cached service of an entity about to be deleted."""
+        if self.driver.service_builder.service_cache.ttl:
+            self._invalidate_service(get_entity(context, *args))
+
     # get a list of loadbalancer ids which are active on this agent host
-    @log_helpers.log_method_call
+    @tracing.trace
     def get_active_loadbalancers_for_agent(self, context, host=None):
         """Get a list of loadbalancers active on this host."""
         with context.session.begin(subtransactions=True):
@@ -85,7 +226,7 @@ class LBaaSv2PluginCallbacksRPC(object):
                 active_lb_ids.add(lb.id)
             return active_lb_ids
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def get_service_by_loadbalancer_id(
             self,
             context,
@@ -109,118 +250,171 @@ class LBaaSv2PluginCallbacksRPC(object):
                 # the preceeding get call returns a nested dict, unwind
                 # one level if necessary
                 agent = (agent['agent'] if 'agent' in agent else agent)
+                # Versioned before building: a message sent meanwhile
+                # may be missing from the service, and is applied again.
+                version = self.driver.service_builder.get_service_version(
+                    loadbalancer_id)
                 service = self.driver.service_builder.build(context,
                                                             lb,
                                                             agent)
+                if cfg.CONF.f5_service_delta_mode:
+                    # the builder may return a cached service, so version
+                    # a copy rather than the shared definition
+                    service = dict(service, service_version=version)
             except Exception as e:
                 LOG.error("Exception: get_service_by_loadbalancer_id: %s",
                           e.message)
 
             return service
 
-    @log_helpers.log_method_call
-    def get_all_loadbalancers(self, context, env, group=None, host=None):
-        """Get all loadbalancers for this group in this env."""
-        loadbalancers = []
-        plugin = self.driver.plugin
+    @tracing.trace
+    def get_services_by_loadbalancer_ids(
+            self,
+            context,
+            loadbalancer_ids=None,
+            host=None):
+        """Get the complete service definitions of several loadbalancers.
+
+        Returns a dictionary of services by loadbalancer id, built in one
+        transaction with the lookups shared between loadbalancers.
+        Loadbalancers which are not found, not bound to an agent, bound
+        to an agent on another host than the requesting one, or whose
+        service fails to build are left out.
+        """
+        services = {}
+        if not loadbalancer_ids:
+            return services
 
         with context.session.begin(subtransactions=True):
-            agents = self.driver.scheduler.get_agents_in_env(
-                context,
-                self.driver.plugin,
-                env,
-                group)
+            LOG.debug('Building service definition entries for %d '
+                      'loadbalancers' % len(loadbalancer_ids))
 
-            for agent in agents:
-                agent_lbs = plugin.db.list_loadbalancers_on_lbaas_agent(
+            try:
+                lbs = self.driver.plugin.db.get_loadbalancers(
                     context,
-                    agent.id
+                    filters={'id': loadbalancer_ids}
                 )
-                for lb in agent_lbs:
-                    loadbalancers.append(
-                        {
-                            'agent_host': agent['host'],
-                            'lb_id': lb.id,
-                            'tenant_id': lb.tenant_id
-                        }
-                    )
-        if host:
-            return [lb for lb in loadbalancers if lb['agent_host'] == host]
-        else:
-            return loadbalancers
+                agents = self._get_agents_hosting_loadbalancers(
+                    context,
+                    loadbalancer_ids
+                )
+                bound_lbs = []
+                for lb in lbs:
+                    if lb.id not in agents:
+                        LOG.warning('No agent bound to loadbalancer %s'
+                                    % lb.id)
+                    elif host and agents[lb.id]['host'] != host:
+                        LOG.warning('Loadbalancer %s is bound to an agent '
+                                    'on host %s, not %s'
+                                    % (lb.id, agents[lb.id]['host'], host))
+                    else:
+                        bound_lbs.append(lb)
+                versions = dict(
+                    (lb.id,
+                     self.driver.service_builder.get_service_version(lb.id))
+                    for lb in bound_lbs)
+                services = self.driver.service_builder.build_many(
+                    context, bound_lbs, agents)
+                if cfg.CONF.f5_service_delta_mode:
+                    for lb_id, service in services.items():
+                        services[lb_id] = dict(
+                            service, service_version=versions[lb_id])
+            except Exception as e:
+                LOG.error("Exception: get_services_by_loadbalancer_ids: %s",
+                          e.message)
 
-    @log_helpers.log_method_call
-    def get_active_loadbalancers(self, context, env, group=None, host=None):
-        """Get all loadbalancers for this group in this env."""
-        loadbalancers = []
-        plugin = self.driver.plugin
+            return services
 
-        with context.session.begin(subtransactions=True):
-            agents = self.driver.scheduler.get_agents_in_env(
-                context,
-                self.driver.plugin,
-                env,
-                group=group,
-                active=True
-            )
+    def _get_agents_hosting_loadbalancers(self, context, loadbalancer_ids):
+        """Get the agents bound to loadbalancers by loadbalancer id."""
+        query = context.session.query(
+            agent_scheduler.LoadbalancerAgentBinding)
+        query = query.options(orm.joinedload('agent'))
+        query = query.filter(
+            agent_scheduler.LoadbalancerAgentBinding.loadbalancer_id.in_(
+                loadbalancer_ids))
+        return dict(
+            (binding.loadbalancer_id,
+             self.driver.plugin.db._make_agent_dict(binding.agent))
+            for binding in query)
 
-            for agent in agents:
-                agent_lbs = plugin.db.list_loadbalancers_on_lbaas_agent(
-                    context,
-                    agent.id
-                )
-                for lb in agent_lbs:
-                    if lb.provisioning_status == plugin_constants.ACTIVE:
-
-                        loadbalancers.append(
-                            {
-                                'agent_host': agent['host'],
-                                'lb_id': lb.id,
-                                'tenant_id': lb.tenant_id
-                            }
-                        )
+    @tracing.trace
+    def get_all_loadbalancers(self, context, env, group=None, host=None):
+        """Get all loadbalancers for this group in this env."""
+        return self._get_loadbalancers_in_env(
+            context, env, group=group, host=host)
 
-        if host:
-            return [lb for lb in loadbalancers if lb['agent_host'] == host]
-        else:
-            return loadbalancers
+    @tracing.trace
+    def get_active_loadbalancers(self, context, env, group=None, host=None):
+        """Get all loadbalancers for this group in this env."""
+        return self._get_loadbalancers_in_env(
+            context, env, group=group, host=host, active=True,
+            statuses=[plugin_constants.ACTIVE])
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def get_pending_loadbalancers(self, context, env, group=None, host=None):
         """Get all loadbalancers for this group in this env."""
+        return self._get_loadbalancers_in_env(
+            context, env, group=group, host=host,
+            exclude_statuses=[plugin_constants.ACTIVE,
+                              plugin_constants.ERROR])
+
+    def _get_loadbalancers_in_env(self, context, env, group=None, host=None,
+                                  active=None, statuses=None,
+                                  exclude_statuses=None):
+        """Get the loadbalancers bound to the agents of an env.
+
+        The agents are selected by env, group and host, then all of their
+        loadbalancers are read with a single query joining the agent
+        bindings to the loadbalancers, filtered by provisioning status.
+
+        :returns: list of dicts with agent_host, lb_id and tenant_id.
+        """
         loadbalancers = []
-        plugin = self.driver.plugin
 
         with context.session.begin(subtransactions=True):
             agents = self.driver.scheduler.get_agents_in_env(
                 context,
                 self.driver.plugin,
                 env,
-                group)
+                group=group,
+                active=active,
+                host=host
+            )
+            agent_hosts = dict((agent['id'], agent['host'])
+                               for agent in agents)
+            if not agent_hosts:
+                return loadbalancers
 
-            for agent in agents:
-                agent_lbs = plugin.db.list_loadbalancers_on_lbaas_agent(
-                    context,
-                    agent.id
+            binding = agent_scheduler.LoadbalancerAgentBinding
+            query = context.session.query(
+                binding.agent_id,
+                models.LoadBalancer.id,
+                models.LoadBalancer.tenant_id)
+            query = query.join(
+                models.LoadBalancer,
+                binding.loadbalancer_id == models.LoadBalancer.id)
+            query = query.filter(binding.agent_id.in_(agent_hosts.keys()))
+            if statuses:
+                query = query.filter(
+                    models.LoadBalancer.provisioning_status.in_(statuses))
+            if exclude_statuses:
+                query = query.filter(
+                    ~models.LoadBalancer.provisioning_status.in_(
+                        exclude_statuses))
+
+            for agent_id, lb_id, tenant_id in query:
+                loadbalancers.append(
+                    {
+                        'agent_host': agent_hosts[agent_id],
+                        'lb_id': lb_id,
+                        'tenant_id': tenant_id
+                    }
                 )
-                for lb in agent_lbs:
-                    if (lb.provisioning_status != plugin_constants.ACTIVE and
-                            lb.provisioning_status != plugin_constants.ERROR):
-
-                        loadbalancers.append(
-                            {
-                                'agent_host': agent['host'],
-                                'lb_id': lb.id,
-                                'tenant_id': lb.tenant_id
-                            }
-                        )
 
-        if host:
-            return [lb for lb in loadbalancers if lb['agent_host'] == host]
-        else:
-            return loadbalancers
+        return loadbalancers
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update_loadbalancer_stats(self,
                                   context,
                                   loadbalancer_id=None,
@@ -237,12 +431,88 @@ class LBaaSv2PluginCallbacksRPC(object):
                 LOG.error('Exception: update_loadbalancer_stats: %s',
                           e.message)
 
-    @log_helpers.log_method_call
+    @tracing.trace
+    def update_loadbalancers_stats(self, context, stats=None):
+        """Update the stats of many loadbalancers in one transaction.
+
+        :param stats: dict mapping loadbalancer ids to their stats, as
+                      sent to update_loadbalancer_stats.
+        :returns: dict mapping the ids of the loadbalancers whose stats
+                  were not updated to the reason.
+        """
+        failures = {}
+        rows = {}
+        for loadbalancer_id, data in (stats or {}).items():
+            try:
+                rows[loadbalancer_id] = self._get_stats_row(
+                    loadbalancer_id, data)
+            except (TypeError, ValueError) as e:
+                failures[loadbalancer_id] = str(e)
+        if not rows:
+            return failures
+
+        table = models.LoadBalancerStatistics.__table__
+        try:
+            with context.session.begin(subtransactions=True):
+                query = context.session.query(models.LoadBalancer.id)
+                query = query.filter(models.LoadBalancer.id.in_(rows))
+                found = set(loadbalancer_id for (loadbalancer_id,) in query)
+                for loadbalancer_id in set(rows) - found:
+                    del rows[loadbalancer_id]
+                    failures[loadbalancer_id] = 'Loadbalancer not found'
+
+                query = context.session.query(
+                    models.LoadBalancerStatistics.loadbalancer_id)
+                query = query.filter(
+                    models.LoadBalancerStatistics.loadbalancer_id.in_(found))
+                existing = set(loadbalancer_id
+                               for (loadbalancer_id,) in query)
+
+                updates = [dict(('b_' + key, value)
+                                for key, value in row.items())
+                           for loadbalancer_id, row in rows.items()
+                           if loadbalancer_id in existing]
+                inserts = [row for loadbalancer_id, row in rows.items()
+                           if loadbalancer_id not in existing]
+                if updates:
+                    context.session.execute(
+                        table.update().where(
+                            table.c.loadbalancer_id ==
+                            sa.bindparam('b_loadbalancer_id')
+                        ).values(
+                            dict((field, sa.bindparam('b_' + field))
+                                 for field in STATS_FIELDS)),
+                        updates)
+                if inserts:
+                    context.session.execute(table.insert(), inserts)
+        except Exception as e:
+            LOG.error('Exception: update_loadbalancers_stats: %s',
+                      e.message)
+            for loadbalancer_id in rows:
+                failures[loadbalancer_id] = e.message
+
+        return failures
+
+    @staticmethod
+    def _get_stats_row(loadbalancer_id, data):
+        """Get the statistics table row of a loadbalancer's stats."""
+        row = {'loadbalancer_id': loadbalancer_id}
+        for field in STATS_FIELDS:
+            value = int((data or {}).get(field, 0))
+            if value < 0:
+                raise ValueError('The %s field can not have negative '
+                                 'value %d.' % (field, value))
+            row[field] = value
+        return row
+
+    @tracing.trace
     def update_loadbalancer_status(self, context,
                                    loadbalancer_id=None,
                                    status=None,
                                    operating_status=None):
         """Agent confirmation hook to update loadbalancer status."""
+        if self._is_status_cached(loadbalancer_id, status, operating_status):
+            return
         with context.session.begin(subtransactions=True):
             try:
                 lb_db = self.driver.plugin.db.get_loadbalancer(
@@ -253,10 +523,10 @@ class LBaaSv2PluginCallbacksRPC(object):
                         plugin_constants.PENDING_DELETE):
                     status = plugin_constants.PENDING_DELETE
 
-                self.driver.plugin.db.update_status(
+                self._update_status(
                     context,
                     models.LoadBalancer,
-                    loadbalancer_id,
+                    lb_db,
                     status,
                     operating_status
                 )
@@ -264,12 +534,13 @@ class LBaaSv2PluginCallbacksRPC(object):
                 LOG.error('Exception: update_loadbalancer_status: %s',
                           e.message)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def loadbalancer_destroyed(self, context, loadbalancer_id=None):
         """Agent confirmation hook that loadbalancer has been destroyed."""
+        self.driver.service_builder.drop_service(loadbalancer_id)
         self.driver.plugin.db.delete_loadbalancer(context, loadbalancer_id)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update_listener_status(
             self,
             context,
@@ -277,6 +548,9 @@ class LBaaSv2PluginCallbacksRPC(object):
             provisioning_status=plugin_constants.ERROR,
             operating_status=None):
         """Agent confirmation hook to update listener status."""
+        if self._is_status_cached(listener_id, provisioning_status,
+                                  operating_status):
+            return
         with context.session.begin(subtransactions=True):
             try:
                 listener_db = self.driver.plugin.db.get_listener(
@@ -286,10 +560,10 @@ class LBaaSv2PluginCallbacksRPC(object):
                 if (listener_db.provisioning_status ==
                         plugin_constants.PENDING_DELETE):
                     provisioning_status = plugin_constants.PENDING_DELETE
-                self.driver.plugin.db.update_status(
+                self._update_status(
                     context,
                     models.Listener,
-                    listener_id,
+                    listener_db,
                     provisioning_status,
                     operating_status
                 )
@@ -297,12 +571,14 @@ class LBaaSv2PluginCallbacksRPC(object):
                 LOG.error('Exception: update_listener_status: %s',
                           e.message)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def listener_destroyed(self, context, listener_id=None):
         """Agent confirmation hook that listener has been destroyed."""
+        self._invalidate_destroyed_service(
+            self.driver.plugin.db.get_listener, context, listener_id)
         self.driver.plugin.db.delete_listener(context, listener_id)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update_pool_status(
             self,
             context,
@@ -310,6 +586,9 @@ class LBaaSv2PluginCallbacksRPC(object):
             provisioning_status=plugin_constants.ERROR,
             operating_status=None):
         """Agent confirmations hook to update pool status."""
+        if self._is_status_cached(pool_id, provisioning_status,
+                                  operating_status):
+            return
         with context.session.begin(subtransactions=True):
             try:
                 pool = self.driver.plugin.db.get_pool(
@@ -318,10 +597,10 @@ class LBaaSv2PluginCallbacksRPC(object):
                 )
                 if (pool.provisioning_status !=
                         plugin_constants.PENDING_DELETE):
-                    self.driver.plugin.db.update_status(
+                    self._update_status(
                         context,
                         models.PoolV2,
-                        pool_id,
+                        pool,
                         provisioning_status,
                         operating_status
                     )
@@ -329,12 +608,14 @@ class LBaaSv2PluginCallbacksRPC(object):
                 LOG.error('Exception: update_pool_status: %s',
                           e.message)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def pool_destroyed(self, context, pool_id=None):
         """Agent confirmation hook that pool has been destroyed."""
+        self._invalidate_destroyed_service(
+            self.driver.plugin.db.get_pool, context, pool_id)
         self.driver.plugin.db.delete_pool(context, pool_id)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update_member_status(
             self,
             context,
@@ -342,6 +623,9 @@ class LBaaSv2PluginCallbacksRPC(object):
             provisioning_status=None,
             operating_status=None):
         """Agent confirmations hook to update member status."""
+        if self._is_status_cached(member_id, provisioning_status,
+                                  operating_status):
+            return
         with context.session.begin(subtransactions=True):
             try:
                 member = self.driver.plugin.db.get_pool_member(
@@ -350,10 +634,10 @@ class LBaaSv2PluginCallbacksRPC(object):
                 )
                 if (member.provisioning_status !=
                         plugin_constants.PENDING_DELETE):
-                    self.driver.plugin.db.update_status(
+                    self._update_status(
                         context,
                         models.MemberV2,
-                        member_id,
+                        member,
                         provisioning_status,
                         operating_status
                     )
@@ -361,12 +645,14 @@ class LBaaSv2PluginCallbacksRPC(object):
                 LOG.error('Exception: update_member_status: %s',
                           e.message)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def member_destroyed(self, context, member_id=None):
         """Agent confirmation hook that member has been destroyed."""
+        self._invalidate_destroyed_service(
+            self.driver.plugin.db.get_pool_member, context, member_id)
         self.driver.plugin.db.delete_member(context, member_id)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update_health_monitor_status(
             self,
             context,
@@ -374,6 +660,9 @@ class LBaaSv2PluginCallbacksRPC(object):
             provisioning_status=plugin_constants.ERROR,
             operating_status=None):
         """Agent confirmation hook to update health monitor status."""
+        if self._is_status_cached(health_monitor_id, provisioning_status,
+                                  operating_status):
+            return
         with context.session.begin(subtransactions=True):
             try:
                 health_monitor = self.driver.plugin.db.get_healthmonitor(
@@ -382,10 +671,10 @@ class LBaaSv2PluginCallbacksRPC(object):
                 )
                 if (health_monitor.provisioning_status !=
                         plugin_constants.PENDING_DELETE):
-                    self.driver.plugin.db.update_status(
+                    self._update_status(
                         context,
                         models.HealthMonitorV2,
-                        health_monitor_id,
+                        health_monitor,
                         provisioning_status,
                         operating_status
                     )
@@ -393,12 +682,14 @@ class LBaaSv2PluginCallbacksRPC(object):
                 LOG.error('Exception: update_health_monitor_status: %s',
                           e.message)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def healthmonitor_destroyed(self, context, healthmonitor_id=None):
         """Agent confirmation hook that health_monitor has been destroyed."""
+        self._invalidate_destroyed_service(
+            self.driver.plugin.db.get_healthmonitor, context, healthmonitor_id)
         self.driver.plugin.db.delete_healthmonitor(context, healthmonitor_id)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update_l7policy_status(
             self,
             context,
@@ -406,6 +697,9 @@ class LBaaSv2PluginCallbacksRPC(object):
             provisioning_status=plugin_constants.ERROR,
             operating_status=None):
         """Agent confirmation hook to update l7 policy status."""
+        if self._is_status_cached(l7policy_id, provisioning_status,
+                                  operating_status):
+            return
         with context.session.begin(subtransactions=True):
             try:
                 l7policy_db = self.driver.plugin.db.get_l7policy(
@@ -415,10 +709,10 @@ class LBaaSv2PluginCallbacksRPC(object):
                 if (l7policy_db.provisioning_status ==
                         plugin_constants.PENDING_DELETE):
                     provisioning_status = plugin_constants.PENDING_DELETE
-                self.driver.plugin.db.update_status(
+                self._update_status(
                     context,
                     models.L7Policy,
-                    l7policy_id,
+                    l7policy_db,
                     provisioning_status,
                     operating_status
                 )
@@ -426,13 +720,15 @@ class LBaaSv2PluginCallbacksRPC(object):
                 LOG.error('Exception: update_l7policy_status: %s',
                           e.message)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def l7policy_destroyed(self, context, l7policy_id=None):
         LOG.debug("l7policy_destroyed")
         """Agent confirmation hook that l7 policy has been destroyed."""
+        self._invalidate_destroyed_service(
+            self.driver.plugin.db.get_l7policy, context, l7policy_id)
         self.driver.plugin.db.delete_l7policy(context, l7policy_id)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def update_l7rule_status(
             self,
             context,
@@ -441,6 +737,9 @@ class LBaaSv2PluginCallbacksRPC(object):
             provisioning_status=plugin_constants.ERROR,
             operating_status=None):
         """Agent confirmation hook to update l7 policy status."""
+        if self._is_status_cached(l7rule_id, provisioning_status,
+                                  operating_status):
+            return
         with context.session.begin(subtransactions=True):
             try:
                 l7rule_db = self.driver.plugin.db.get_l7policy_rule(
@@ -451,10 +750,10 @@ class LBaaSv2PluginCallbacksRPC(object):
                 if (l7rule_db.provisioning_status ==
                         plugin_constants.PENDING_DELETE):
                     provisioning_status = plugin_constants.PENDING_DELETE
-                self.driver.plugin.db.update_status(
+                self._update_status(
                     context,
                     models.L7Rule,
-                    l7rule_id,
+                    l7rule_db,
                     provisioning_status,
                     operating_status
                 )
@@ -462,14 +761,138 @@ class LBaaSv2PluginCallbacksRPC(object):
                 LOG.error('Exception: update_l7rule_status: %s',
                           e.message)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def l7rule_destroyed(self, context, l7rule_id):
         """Agent confirmation hook that l7 policy has been destroyed."""
+        if self.driver.service_builder.service_cache.ttl:
+            # the agent does not send the policy id get_l7policy_rule needs
+            rules = self.driver.plugin.db.get_l7policy_rules(
+                context, None, filters={'id': [l7rule_id]})
+            for rule in rules:
+                self._invalidate_service(rule)
         self.driver.plugin.db.delete_l7policy_rule(context, l7rule_id)
 
+    @tracing.trace
+    def update_statuses(self, context, statuses=None):
+        """Agent confirmation hook to update the status of many entities.
+
+        :param statuses: list of (entity type, id, provisioning status,
+                         operating status) entries, where the entity type
+                         is loadbalancer, listener, pool, member,
+                         healthmonitor, l7policy or l7rule. Later entries
+                         for an entity replace earlier ones.
+        """
+        updates = collections.OrderedDict()
+        for entry in statuses or []:
+            try:
+                entity_type, entity_id, provisioning_status, \
+                    operating_status = entry
+            except (TypeError, ValueError):
+                LOG.error('Exception: update_statuses: invalid status %s',
+                          entry)
+                continue
+            if entity_type not in STATUS_MODELS:
+                LOG.error('Exception: update_statuses: unknown entity '
+                          'type %s', entity_type)
+                continue
+            updates.pop((entity_type, entity_id), None)
+            if self._is_status_cached(entity_id, provisioning_status,
+                                      operating_status):
+                continue
+            updates[(entity_type, entity_id)] = (provisioning_status,
+                                                 operating_status)
+        if not updates:
+            return
+
+        ids = collections.defaultdict(list)
+        for entity_type, entity_id in updates:
+            ids[entity_type].append(entity_id)
+
+        with context.session.begin(subtransactions=True):
+            try:
+                # Group the entities taking a new status by status, to
+                # set it with one UPDATE.
+                grouped = collections.OrderedDict()
+                loadbalancer_ids = set()
+                new_statuses = {}
+                for entity_type, entity_ids in ids.items():
+                    current = self._get_statuses(
+                        context, entity_type, entity_ids)
+                    for entity_id in entity_ids:
+                        if entity_id not in current:
+                            LOG.error('Exception: update_statuses: %s %s '
+                                      'not found', entity_type, entity_id)
+                            continue
+                        provisioning_status, operating_status = \
+                            updates[(entity_type, entity_id)]
+                        current_status, current_operating, \
+                            loadbalancer_id = current[entity_id]
+                        if (current_status ==
+                                plugin_constants.PENDING_DELETE):
+                            if entity_type in PENDING_DELETE_SKIPPED:
+                                continue
+                            provisioning_status = \
+                                plugin_constants.PENDING_DELETE
+                        if self._is_status_unchanged(
+                                (current_status, current_operating),
+                                provisioning_status, operating_status):
+                            self._cache_status(
+                                entity_id, current_status, current_operating)
+                            continue
+                        new_statuses[entity_id] = (
+                            provisioning_status or current_status,
+                            (operating_status or current_operating)
+                            if current_operating is not None else None)
+                        grouped.setdefault(
+                            (entity_type, provisioning_status,
+                             operating_status), []).append(entity_id)
+                        if loadbalancer_id:
+                            loadbalancer_ids.add(loadbalancer_id)
+
+                for (entity_type, provisioning_status,
+                     operating_status), entity_ids in grouped.items():
+                    model = STATUS_MODELS[entity_type][0]
+                    values = {}
+                    if provisioning_status:
+                        values['provisioning_status'] = provisioning_status
+                    if operating_status and hasattr(model,
+                                                    'operating_status'):
+                        values['operating_status'] = operating_status
+                    if values:
+                        query = context.session.query(model)
+                        query = query.filter(model.id.in_(entity_ids))
+                        query.update(values, synchronize_session=False)
+
+                for loadbalancer_id in loadbalancer_ids:
+                    self.driver.service_builder.invalidate_service(
+                        loadbalancer_id)
+                for entity_id, status in new_statuses.items():
+                    self._cache_status(entity_id, *status)
+            except Exception as e:
+                LOG.error('Exception: update_statuses: %s', e.message)
+
+    @staticmethod
+    def _get_statuses(context, entity_type, entity_ids):
+        """Get the statuses and loadbalancer id of entities.
+
+        :returns: dict mapping entity ids to (provisioning status,
+                  operating status, loadbalancer id) tuples, with no
+                  operating status for entities without one.
+        """
+        model, loadbalancer_column, joins = STATUS_MODELS[entity_type]
+        operating_column = getattr(model, 'operating_status',
+                                   sa.null().label('operating_status'))
+        query = context.session.query(
+            model.id, model.provisioning_status, operating_column,
+            loadbalancer_column)
+        for joined, onclause in joins:
+            query = query.outerjoin(joined, onclause)
+        query = query.filter(model.id.in_(entity_ids))
+        return dict((row[0], tuple(row[1:])) for row in query)
+
     # Neutron core plugin core object management
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def get_ports_for_mac_addresses(self, context, mac_addresses=None):
         """Get ports for mac addresses."""
         ports = []
@@ -487,7 +910,7 @@ class LBaaSv2PluginCallbacksRPC(object):
 
         return ports
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def get_ports_on_network(self, context, network_id=None):
         """Get ports for network."""
         ports = []
@@ -504,7 +927,7 @@ class LBaaSv2PluginCallbacksRPC(object):
 
         return ports
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def create_port_on_subnet(self, context, subnet_id=None,
                               mac_address=None, name=None,
                               fixed_address_count=1, host=None):
@@ -564,7 +987,7 @@ class LBaaSv2PluginCallbacksRPC(object):
 
             return port
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def create_port_on_subnet_with_specific_ip(self, context, subnet_id=None,
                                                mac_address=None, name=None,
                                                ip_address=None, host=None):
@@ -610,7 +1033,7 @@ class LBaaSv2PluginCallbacksRPC(object):
                 context, port['id'], {'port': update_data})
             return port
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def get_port_by_name(self, context, port_name=None):
         """Get port by name."""
         if port_name:
@@ -620,7 +1043,7 @@ class LBaaSv2PluginCallbacksRPC(object):
                 filters=filters
             )
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def delete_port(self, context, port_id=None, mac_address=None):
         """Delete port."""
         if port_id:
@@ -637,7 +1060,7 @@ class LBaaSv2PluginCallbacksRPC(object):
                     port['id']
                 )
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def delete_port_by_name(self, context, port_name=None):
         """Delete port by name."""
         if port_name:
@@ -655,7 +1078,7 @@ class LBaaSv2PluginCallbacksRPC(object):
             except Exception as e:
                 LOG.error("failed to delete port: %s", e.message)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def add_allowed_address(self, context, port_id=None, ip_address=None):
         """Add allowed addresss."""
         if port_id and ip_address:
@@ -687,7 +1110,7 @@ class LBaaSv2PluginCallbacksRPC(object):
                 LOG.error('could not add allowed address pair: %s'
                           % exc.message)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def remove_allowed_address(self, context, port_id=None, ip_address=None):
         """Remove allowed addresss."""
         if port_id and ip_address:
@@ -14,19 +14,109 @@ u"""Service Module for F5® LBaaSv2."""
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import datetime
-import json
+import uuid
 
-from oslo_log import helpers as log_helpers
+from oslo_config import cfg
 from oslo_log import log as logging
 
+from neutron.callbacks import events
+from neutron.callbacks import registry
+from neutron.callbacks import resources
+from neutron_lbaas.db.loadbalancer import models
+from neutron_lbaas.services.loadbalancer import data_models
+from sqlalchemy import engine
+from sqlalchemy import event as sa_event
+from sqlalchemy import orm
+
+from f5lbaasdriver.v2.bigip import agent_config
+from f5lbaasdriver.v2.bigip import cache
 from f5lbaasdriver.v2.bigip import constants_v2
 from f5lbaasdriver.v2.bigip.disconnected_service import DisconnectedService
 from f5lbaasdriver.v2.bigip import exceptions as f5_exc
 from f5lbaasdriver.v2.bigip import neutron_client as q_client
+from f5lbaasdriver.v2.bigip import tracing
 
 LOG = logging.getLogger(__name__)
 
+OPTS = [
+    cfg.IntOpt(
+        'f5_service_cache_seconds',
+        default=0,
+        help=('Seconds to keep built service definitions in memory. '
+              'Cached services are invalidated by the driver CRUD and '
+              'status update paths of the same neutron-server process, '
+              'so with separate API and RPC workers this is also the '
+              'longest a service may be stale. 0 disables the cache.')
+    ),
+    cfg.BoolOpt(
+        'f5_service_eager_loading',
+        default=False,
+        help=('Load the listeners, pools, members, health monitors and '
+              'L7 policies and rules of a loadbalancer with a fixed '
+              'number of eager queries when building its service.')
+    ),
+    cfg.BoolOpt(
+        'f5_service_delta_mode',
+        default=False,
+        help=('Send only the loadbalancer with listener, pool, member, '
+              'health monitor and L7 policy/rule messages, instead of '
+              'building and sending the full service. The messages carry '
+              'the service version they apply to and the version after '
+              'the change; agents whose stored version differs request '
+              'the full service. Versions are counted by each '
+              'neutron-server process. Agents must support delta service '
+              'definitions.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
+
+class StatementCounter(object):
+    """Count the SQL statements issued on a session's connection.
+
+    Used as a context manager around a block of database work. Nothing
+    is counted when the session is not bound to a SQLAlchemy connection.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.count = 0
+        self._connection = None
+
+    def _before_cursor_execute(self, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        connection = self.session.connection()
+        if isinstance(connection, engine.Connection):
+            self._connection = connection
+            sa_event.listen(connection, 'before_cursor_execute',
+                            self._before_cursor_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._connection is not None:
+            sa_event.remove(self._connection, 'before_cursor_execute',
+                            self._before_cursor_execute)
+            self._connection = None
+
+
+class BuildState(object):
+    """Lookups shared by the services of one build or build_many call.
+
+    Tunnel endpoints, VIP ports, network segments and the ports on each
+    VIP network are looked up once per call. The state is passed down
+    the builder's call chain rather than kept on the shared builder, so
+    concurrent builds in other greenthreads do not reset it.
+    """
+
+    def __init__(self, vip_ports=None):
+        self.vtep_index = None
+        self.vip_ports = vip_ports or {}
+        self.network_ports = {}
+        self.network_segments = {}
+
 
 class LBaaSv2ServiceBuilder(object):
     """The class creates a service definition from neutron database.
@@ -45,21 +135,183 @@ class LBaaSv2ServiceBuilder(object):
         """Get full service definition from loadbalancer id."""
         self.driver = driver
 
-        self.net_cache = {}
-        self.subnet_cache = {}
-        self.last_cache_update = datetime.datetime.fromtimestamp(0)
+        self.net_cache = cache.TTLCache(
+            constants_v2.NET_CACHE_MAX_ENTRIES,
+            constants_v2.NET_CACHE_SECONDS)
+        self.subnet_cache = cache.TTLCache(
+            constants_v2.NET_CACHE_MAX_ENTRIES,
+            constants_v2.NET_CACHE_SECONDS)
+
+        # Built services by loadbalancer id. Every entry is stored with
+        # the (epoch, generation) it was built at; invalidation bumps the
+        # generation, so services built concurrently with a change are
+        # never served.
+        self.service_cache = cache.TTLCache(
+            constants_v2.SERVICE_CACHE_MAX_ENTRIES,
+            cfg.CONF.f5_service_cache_seconds)
+        self._service_generations = {}
+        self._service_epoch = 0
+
+        # Delta mode service versions by loadbalancer id, counted by the
+        # entity messages sent. The prefix tells versions counted by
+        # other processes apart.
+        self._service_versions = {}
+        self._service_version_prefix = uuid.uuid4().hex[:8]
+
         self.plugin = self.driver.plugin
         self.disconnected_service = DisconnectedService()
         self.q_client = q_client.F5NetworksNeutronClient(self.plugin)
 
+        # Drop cached networks and subnets as soon as Neutron reports a
+        # change, rather than waiting for them to expire.
+        cache_callback = self._bindCacheCallback()
+        for resource in (resources.NETWORK, resources.SUBNET):
+            for event in (events.AFTER_UPDATE, events.AFTER_DELETE):
+                registry.subscribe(cache_callback, resource, event)
+
+    def _bindCacheCallback(self):
+        # The registry callback manager references callback functions by
+        # name, so tie the name to the driver env as F5DriverV2 does.
+        def cache_invalidation_callback(resource, event, trigger, **kwargs):
+            self.invalidate_cache(resource, **kwargs)
+
+        cache_invalidation_callback.__name__ += '_' + str(self.driver.env)
+        return cache_invalidation_callback
+
+    def invalidate_cache(self, resource, **kwargs):
+        """Remove the network or subnet named in a callback from the cache.
+
+        :param resource: neutron.callbacks.resources NETWORK or SUBNET.
+        :param kwargs: callback arguments, holding either the updated
+        object (network/subnet) or its id (network_id/subnet_id).
+        """
+        if resource == resources.NETWORK:
+            network = kwargs.get('network') or {}
+            network_id = network.get('id', kwargs.get('network_id'))
+            if network_id:
+                LOG.debug('Invalidating cached network %s' % network_id)
+                self.net_cache.invalidate(network_id)
+        elif resource == resources.SUBNET:
+            subnet = kwargs.get('subnet') or {}
+            subnet_id = subnet.get('id', kwargs.get('subnet_id'))
+            if subnet_id:
+                LOG.debug('Invalidating cached subnet %s' % subnet_id)
+                self.subnet_cache.invalidate(subnet_id)
+            # The cached network lists its subnets.
+            if subnet.get('network_id'):
+                self.net_cache.invalidate(subnet['network_id'])
+
+        # Cached services embed network data of any number of
+        # loadbalancers.
+        self.invalidate_all_services()
+
+    def invalidate_service(self, loadbalancer_id):
+        """Drop the cached service definition of a loadbalancer."""
+        if not self.service_cache.ttl:
+            return
+        self._service_generations[loadbalancer_id] = \
+            self._service_generations.get(loadbalancer_id, 0) + 1
+        self.service_cache.invalidate(loadbalancer_id)
+
+    def drop_service(self, loadbalancer_id):
+        """Forget a destroyed loadbalancer's service and version."""
+        self.service_cache.invalidate(loadbalancer_id)
+        self._service_generations.pop(loadbalancer_id, None)
+        self._service_versions.pop(loadbalancer_id, None)
+
+    def get_service_version(self, loadbalancer_id):
+        """Return the delta mode service version of a loadbalancer."""
+        return '%s:%d' % (self._service_version_prefix,
+                          self._service_versions.get(loadbalancer_id, 0))
+
+    def next_service_version(self, loadbalancer_id):
+        """Count an entity message sent for a loadbalancer.
+
+        :returns: tuple -- (version the message applies to, version after
+        the message)
+        """
+        base = self.get_service_version(loadbalancer_id)
+        self._service_versions[loadbalancer_id] = \
+            self._service_versions.get(loadbalancer_id, 0) + 1
+        return base, self.get_service_version(loadbalancer_id)
+
+    def invalidate_all_services(self):
+        """Drop every cached service definition."""
+        self._service_epoch += 1
+        self.service_cache.clear()
+
+    def _get_service_cache_key(self, loadbalancer_id, agent):
+        agent_id = agent['id'] if agent else None
+        return (self._service_epoch,
+                self._service_generations.get(loadbalancer_id, 0),
+                agent_id)
+
     def build(self, context, loadbalancer, agent):
-        """Get full service definition from loadbalancer ID."""
-        # Invalidate cache if it is too old
-        if ((datetime.datetime.now() - self.last_cache_update).seconds >
-                constants_v2.NET_CACHE_SECONDS):
-            self.net_cache = {}
-            self.subnet_cache = {}
+        """Get full service definition from loadbalancer ID.
+
+        Services are served from the service cache when it is enabled and
+        the loadbalancer has not been invalidated since it was built.
+        Callers must not modify the returned service.
+        """
+        return self._get_service(context, loadbalancer, agent, BuildState())
+
+    def build_many(self, context, loadbalancers, agents):
+        """Get full service definitions of several loadbalancers.
+
+        Tunnel endpoints and the ports on each VIP network are looked up
+        once for all of the loadbalancers, and their VIP ports with a
+        single query. Networks and subnets are shared through the
+        network caches.
 
+        :param loadbalancers: neutron loadbalancer data models.
+        :param agents: dict of the agent hosting each loadbalancer, by
+        loadbalancer id.
+        :returns: dict -- service definitions by loadbalancer id. The
+        loadbalancers whose service fails to build are left out.
+        """
+        services = {}
+        with context.session.begin(subtransactions=True):
+            state = BuildState(
+                vip_ports=self._get_vip_ports(context, loadbalancers))
+            for loadbalancer in loadbalancers:
+                try:
+                    services[loadbalancer.id] = self._get_service(
+                        context, loadbalancer, agents.get(loadbalancer.id),
+                        state)
+                except Exception as e:
+                    LOG.error("Exception: build_many: loadbalancer %s: %s"
+                              % (loadbalancer.id, e.message))
+        return services
+
+    def _get_service(self, context, loadbalancer, agent, state):
+        if not self.service_cache.ttl:
+            return self._build(context, loadbalancer, agent, state)
+
+        cache_key = self._get_service_cache_key(loadbalancer.id, agent)
+        cached = self.service_cache.get(loadbalancer.id)
+        if cached and cached[0] == cache_key:
+            LOG.debug('Using cached service definition for %s'
+                      % loadbalancer.id)
+            return cached[1]
+
+        service = self._build(context, loadbalancer, agent, state)
+        self.service_cache.set(loadbalancer.id, (cache_key, service))
+        return service
+
+    def _build(self, context, loadbalancer, agent, state):
+        with context.session.begin(subtransactions=True):
+            if not LOG.isEnabledFor(logging.DEBUG):
+                return self._build_service(context, loadbalancer, agent,
+                                           state)
+
+            with StatementCounter(context.session) as counter:
+                service = self._build_service(context, loadbalancer, agent,
+                                              state)
+            LOG.debug('Built service definition for %s with %d SQL '
+                      'statements' % (loadbalancer.id, counter.count))
+            return service
+
+    def _build_service(self, context, loadbalancer, agent, state):
         service = {}
         with context.session.begin(subtransactions=True):
             LOG.debug('Building service definition entry for %s'
@@ -68,7 +320,8 @@ class LBaaSv2ServiceBuilder(object):
             # Start with the neutron loadbalancer definition
             service['loadbalancer'] = self._get_extended_loadbalancer(
                 context,
-                loadbalancer
+                loadbalancer,
+                state=state
             )
 
             # Get the subnet network associated with the VIP.
@@ -92,9 +345,9 @@ class LBaaSv2ServiceBuilder(object):
             # Override the segmentation ID and network type for this network
             # if we are running in disconnected service mode
             agent_config = self.deserialize_agent_configurations(
-                agent['configurations'])
-            segment_data = self.disconnected_service.get_network_segment(
-                context, agent_config, network)
+                agent['configurations'], agent_id=agent.get('id'))
+            segment_data = self._get_network_segment(
+                context, agent_config, network, state=state)
             if segment_data:
                 network['provider:segmentation_id'] = \
                     segment_data.get('segmentation_id', None)
@@ -123,31 +376,91 @@ class LBaaSv2ServiceBuilder(object):
                     self._populate_loadbalancer_network_vteps(
                         context,
                         service['loadbalancer'],
-                        net_type
+                        net_type,
+                        state=state
                     )
 
+            # Either load the whole loadbalancer graph up front or let
+            # each of the getters below query its own objects.
+            graph = {}
+            if cfg.CONF.f5_service_eager_loading:
+                graph = self._get_loadbalancer_graph(context, loadbalancer)
+
             # Get listeners and pools.
-            service['listeners'] = self._get_listeners(context, loadbalancer)
+            service['listeners'] = self._get_listeners(
+                context, loadbalancer, db_listeners=graph.get('listeners'))
 
             service['pools'], service['healthmonitors'] = \
-                self._get_pools_and_healthmonitors(context, loadbalancer)
+                self._get_pools_and_healthmonitors(
+                    context, loadbalancer, db_pools=graph.get('pools'),
+                    db_healthmonitors=graph.get('healthmonitors'))
 
             service['members'] = self._get_members(
-                context, service['pools'], subnet_map, network_map)
+                context, service['pools'], subnet_map, network_map,
+                members=graph.get('members'), state=state)
 
             service['subnets'] = subnet_map
             service['networks'] = network_map
 
             service['l7policies'] = self._get_l7policies(
-                context, service['listeners'])
+                context, service['listeners'],
+                policies=graph.get('l7policies'))
             service['l7policy_rules'] = self._get_l7policy_rules(
-                context, service['l7policies'])
+                context, service['l7policies'],
+                rules=graph.get('l7policy_rules'))
 
         return service
 
-    @log_helpers.log_method_call
-    def _get_extended_member(self, context, member):
-        """Get extended member attributes and member networking."""
+    def _get_loadbalancer_graph(self, context, loadbalancer):
+        """Load the objects of a loadbalancer with eager queries.
+
+        The loadbalancer and its children are read with a fixed number
+        of queries, whatever their count, and converted to data models
+        in one pass.
+
+        :returns: dict of listeners, pools, healthmonitors, members,
+        l7policies and l7policy_rules data model lists.
+        """
+        query = self.plugin.db._model_query(context, models.LoadBalancer)
+        query = query.filter(models.LoadBalancer.id == loadbalancer.id)
+        query = query.options(
+            orm.joinedload('stats'),
+            orm.joinedload('provider'),
+            orm.subqueryload('listeners').subqueryload('sni_containers'),
+            orm.subqueryload('listeners').subqueryload(
+                'l7_policies').subqueryload('rules'),
+            orm.subqueryload('pools').subqueryload('members'),
+            orm.subqueryload('pools').joinedload(
+                'healthmonitor').joinedload('pool'),
+            orm.subqueryload('pools').joinedload('session_persistence'),
+            orm.subqueryload('pools').subqueryload('listeners'),
+            orm.subqueryload('pools').subqueryload('l7_policies'))
+        lb = data_models.LoadBalancer.from_sqlalchemy_model(query.one())
+
+        graph = {'listeners': lb.listeners,
+                 'pools': lb.pools,
+                 'healthmonitors': [],
+                 'members': [],
+                 'l7policies': [],
+                 'l7policy_rules': []}
+        for pool in lb.pools:
+            if pool.healthmonitor:
+                graph['healthmonitors'].append(pool.healthmonitor)
+            graph['members'].extend(pool.members)
+        for listener in lb.listeners:
+            graph['l7policies'].extend(listener.l7_policies)
+            for l7policy in listener.l7_policies:
+                graph['l7policy_rules'].extend(l7policy.rules)
+        return graph
+
+    @tracing.trace
+    def _get_extended_member(self, context, member, ports=None, state=None):
+        """Get extended member attributes and member networking.
+
+        The member ports can be passed in when they have already been
+        looked up (see _get_member_ports); otherwise they are queried
+        from Neutron by the member's subnet and address.
+        """
         member_dict = member.to_dict(pool=False)
         subnet_id = member.subnet_id
         subnet = self._get_subnet_cached(
@@ -162,18 +475,20 @@ class LBaaSv2ServiceBuilder(object):
 
         member_dict['network_id'] = network_id
 
-        # Use the fixed ip.
-        filter = {'fixed_ips': {'subnet_id': [subnet_id],
-                                'ip_address': [member.address]}}
-        ports = self.plugin.db._core_plugin.get_ports(
-            context,
-            filter
-        )
+        if ports is None:
+            # Use the fixed ip.
+            filter = {'fixed_ips': {'subnet_id': [subnet_id],
+                                    'ip_address': [member.address]}}
+            ports = self.plugin.db._core_plugin.get_ports(
+                context,
+                filter
+            )
 
         # we no longer support member port creation
         if len(ports) == 1:
             member_dict['port'] = ports[0]
-            self._populate_member_network(context, member_dict, network)
+            self._populate_member_network(context, member_dict, network,
+                                          state=state)
         elif len(ports) == 0:
             LOG.warning("Lbaas member %s has no associated neutron port"
                         % member.address)
@@ -182,33 +497,50 @@ class LBaaSv2ServiceBuilder(object):
 
         return (member_dict, subnet, network)
 
-    @log_helpers.log_method_call
-    def _get_extended_loadbalancer(self, context, loadbalancer):
+    @tracing.trace
+    def _get_extended_loadbalancer(self, context, loadbalancer, state=None):
         """Get loadbalancer dictionary and add extended data(e.g. VIP)."""
+        state = state or BuildState()
         loadbalancer_dict = loadbalancer.to_api_dict()
-        vip_port = self.plugin.db._core_plugin.get_port(
-            context,
-            loadbalancer.vip_port_id
-        )
+        vip_port = state.vip_ports.get(loadbalancer.vip_port_id)
+        if vip_port is None:
+            vip_port = self.plugin.db._core_plugin.get_port(
+                context,
+                loadbalancer.vip_port_id
+            )
         loadbalancer_dict['vip_port'] = vip_port
 
         return loadbalancer_dict
 
-    @log_helpers.log_method_call
+    def _get_vip_ports(self, context, loadbalancers):
+        """Get the VIP ports of loadbalancers by port id."""
+        vip_port_ids = [lb.vip_port_id for lb in loadbalancers
+                        if lb.vip_port_id]
+        if not vip_port_ids:
+            return {}
+        ports = self.plugin.db._core_plugin.get_ports(
+            context,
+            filters={'id': vip_port_ids}
+        )
+        return dict((port['id'], port) for port in ports)
+
+    @tracing.trace
     def _get_subnet_cached(self, context, subnet_id):
         """Retrieve subnet from cache if available; otherwise, from Neutron."""
-        if subnet_id not in self.subnet_cache:
+        subnet = self.subnet_cache.get(subnet_id)
+        if subnet is None:
             subnet = self.plugin.db._core_plugin.get_subnet(
                 context,
                 subnet_id
             )
-            self.subnet_cache[subnet_id] = subnet
-        return self.subnet_cache[subnet_id]
+            self.subnet_cache.set(subnet_id, subnet)
+        return subnet
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def _get_network_cached(self, context, network_id):
         """Retrieve network from cache or from Neutron."""
-        if network_id not in self.net_cache:
+        network = self.net_cache.get(network_id)
+        if network is None:
             network = self.plugin.db._core_plugin.get_network(
                 context,
                 network_id
@@ -217,18 +549,20 @@ class LBaaSv2ServiceBuilder(object):
                 network['provider:network_type'] = 'undefined'
             if 'provider:segmentation_id' not in network:
                 network['provider:segmentation_id'] = 0
-            self.net_cache[network_id] = network
+            self.net_cache.set(network_id, network)
 
-        return self.net_cache[network_id]
+        return network
 
-    def _populate_member_network(self, context, member, network):
+    def _populate_member_network(self, context, member, network,
+                                 state=None):
         """Add vtep networking info to pool member and update the network."""
+        state = state or BuildState()
         member['vxlan_vteps'] = []
         member['gre_vteps'] = []
 
         agent_config = {}
-        segment_data = self.disconnected_service.get_network_segment(
-            context, agent_config, network)
+        segment_data = self._get_network_segment(
+            context, agent_config, network, state=state)
         if segment_data:
             network['provider:segmentation_id'] = \
                 segment_data.get('segmentation_id', None)
@@ -242,101 +576,152 @@ class LBaaSv2ServiceBuilder(object):
             if 'binding:host_id' in member['port']:
                 host = member['port']['binding:host_id']
                 member['vxlan_vteps'] = self._get_endpoints(
-                    context, 'vxlan', host)
+                    context, 'vxlan', host, state=state)
         if net_type == 'gre':
             if 'binding:host_id' in member['port']:
                 host = member['port']['binding:host_id']
                 member['gre_vteps'] = self._get_endpoints(
-                    context, 'gre', host)
+                    context, 'gre', host, state=state)
         if 'provider:network_type' not in network:
             network['provider:network_type'] = 'undefined'
         if 'provider:segmentation_id' not in network:
             network['provider:segmentation_id'] = 0
 
-    @log_helpers.log_method_call
+    def _get_network_segment(self, context, agent_config, network,
+                             state=None):
+        """Get the network segment matching the agent configuration."""
+        segments = self._get_network_segments(context, [network['id']],
+                                              state=state)
+        return self.disconnected_service.get_network_segment(
+            context, agent_config, network,
+            segments=segments[network['id']])
+
+    def _get_network_segments(self, context, network_ids, state=None):
+        """Get network segments by network id, kept for the build.
+
+        Networks not seen yet in this build are looked up together with
+        a single query.
+        """
+        state = state or BuildState()
+        missing = [network_id for network_id in set(network_ids)
+                   if network_id not in state.network_segments]
+        if missing:
+            segments = (self.disconnected_service.
+                        get_network_segments_by_network_ids(
+                            context.session, missing))
+            for network_id in missing:
+                state.network_segments[network_id] = segments.get(
+                    network_id, [])
+        return dict((network_id, state.network_segments[network_id])
+                    for network_id in network_ids)
+
+    @tracing.trace
     def _populate_loadbalancer_network_vteps(
             self,
             context,
             loadbalancer,
-            net_type):
+            net_type,
+            state=None):
         """Put related tunnel endpoints in loadbalancer definiton."""
+        state = state or BuildState()
         loadbalancer['vxlan_vteps'] = []
         loadbalancer['gre_vteps'] = []
         network_id = loadbalancer['vip_port']['network_id']
 
-        ports = self._get_ports_on_network(
-            context,
-            network_id=network_id
-        )
+        ports = state.network_ports.get(network_id)
+        if ports is None:
+            ports = self._get_ports_on_network(
+                context,
+                network_id=network_id
+            )
+            state.network_ports[network_id] = ports
 
-        vtep_hosts = []
+        vtep_hosts = set()
         for port in ports:
-            if ('binding:host_id' in port and
-                    port['binding:host_id'] not in vtep_hosts):
-                vtep_hosts.append(port['binding:host_id'])
-
-        for vtep_host in vtep_hosts:
-            if net_type == 'vxlan':
-                endpoints = self._get_endpoints(context, 'vxlan')
-                for ep in endpoints:
-                    if ep not in loadbalancer['vxlan_vteps']:
-                        loadbalancer['vxlan_vteps'].append(ep)
-            elif net_type == 'gre':
-                endpoints = self._get_endpoints(context, 'gre')
-                for ep in endpoints:
-                    if ep not in loadbalancer['gre_vteps']:
-                        loadbalancer['gre_vteps'].append(ep)
-
-    def _get_endpoints(self, context, net_type, host=None):
+            if 'binding:host_id' in port:
+                vtep_hosts.add(port['binding:host_id'])
+
+        # Every endpoint of the tunnel type is added once any host is
+        # bound on the network.
+        if not vtep_hosts:
+            return
+
+        if net_type == 'vxlan':
+            vteps = loadbalancer['vxlan_vteps']
+        elif net_type == 'gre':
+            vteps = loadbalancer['gre_vteps']
+        else:
+            return
+
+        for ep in self._get_endpoints(context, net_type, state=state):
+            if ep not in vteps:
+                vteps.append(ep)
+
+    def _get_endpoints(self, context, net_type, host=None, state=None):
         """Get vxlan or gre tunneling endpoints from all agents."""
-        endpoints = []
+        vtep_index = self._get_vtep_index(context, state=state).get(
+            net_type, {})
+        if host:
+            return list(vtep_index.get('hosts', {}).get(host, []))
+        return list(vtep_index.get('all', []))
+
+    def _get_vtep_index(self, context, state=None):
+        """Index agent tunneling endpoints by tunnel type and host.
+
+        Returns a dictionary of the form
+        {net_type: {'all': [ip, ...], 'hosts': {host: [ip, ...]}}}
+        built from a single get_agents call and kept for the build.
+        """
+        state = state or BuildState()
+        if state.vtep_index is not None:
+            return state.vtep_index
 
+        vtep_index = {}
         agents = self.plugin.db._core_plugin.get_agents(context)
         for agent in agents:
-            if ('configurations' in agent and (
-                    'tunnel_types' in agent['configurations'])):
-
-                if net_type in agent['configurations']['tunnel_types']:
-                    if 'tunneling_ip' in agent['configurations']:
-                        if not host or (agent['host'] == host):
-                            endpoints.append(
-                                agent['configurations']['tunneling_ip']
-                            )
-                    if 'tunneling_ips' in agent['configurations']:
-                        for ip_addr in (
-                                agent['configurations']['tunneling_ips']):
-                            if not host or (agent['host'] == host):
-                                endpoints.append(ip_addr)
-
-        return endpoints
-
-    def deserialize_agent_configurations(self, configurations):
+            if ('configurations' not in agent or
+                    'tunnel_types' not in agent['configurations']):
+                continue
+
+            configurations = agent['configurations']
+            endpoints = []
+            if 'tunneling_ip' in configurations:
+                endpoints.append(configurations['tunneling_ip'])
+            if 'tunneling_ips' in configurations:
+                endpoints.extend(configurations['tunneling_ips'])
+
+            for net_type in configurations['tunnel_types']:
+                vteps = vtep_index.setdefault(
+                    net_type, {'all': [], 'hosts': {}})
+                vteps['all'].extend(endpoints)
+                vteps['hosts'].setdefault(
+                    agent['host'], []).extend(endpoints)
+
+        state.vtep_index = vtep_index
+        return vtep_index
+
+    def deserialize_agent_configurations(self, configurations,
+                                         agent_id=None):
         """Return a dictionary for the agent configuration."""
-        agent_conf = configurations
-        if not isinstance(agent_conf, dict):
-            try:
-                agent_conf = json.loads(configurations)
-            except ValueError as ve:
-                LOG.error('can not JSON decode %s : %s'
-                          % (agent_conf, ve.message))
-                agent_conf = {}
-        return agent_conf
-
-    @log_helpers.log_method_call
+        try:
+            return agent_config.parse_agent_configurations(
+                configurations, agent_id=agent_id)
+        except ValueError as ve:
+            LOG.error('can not JSON decode %s : %s'
+                      % (configurations, ve.message))
+            return agent_config.AgentConfiguration()
+
+    @tracing.trace
     def _is_common_network(self, network, agent):
         common_external_networks = False
         common_networks = {}
 
         if agent and "configurations" in agent:
             agent_configs = self.deserialize_agent_configurations(
-                agent['configurations'])
-
-            if 'common_networks' in agent_configs:
-                common_networks = agent_configs['common_networks']
-
-            if 'f5_common_external_networks' in agent_configs:
-                common_external_networks = (
-                    agent_configs['f5_common_external_networks'])
+                agent['configurations'], agent_id=agent.get('id'))
+            common_networks = agent_configs.common_networks
+            common_external_networks = (
+                agent_configs.f5_common_external_networks)
 
         return (network['shared'] or
                 (network['id'] in common_networks) or
@@ -350,7 +735,7 @@ class LBaaSv2ServiceBuilder(object):
         else:
             return self._is_common_network(network, agent)
 
-    @log_helpers.log_method_call
+    @tracing.trace
     def _get_ports_on_network(self, context, network_id=None):
         """Get ports for network."""
         if not isinstance(network_id, list):
@@ -361,14 +746,15 @@ class LBaaSv2ServiceBuilder(object):
             filters=filters
         )
 
-    @log_helpers.log_method_call
-    def _get_l7policies(self, context, listeners):
+    @tracing.trace
+    def _get_l7policies(self, context, listeners, policies=None):
         """Get l7 policies filtered by listeners."""
         l7policies = []
         if listeners:
-            listener_ids = [l['id'] for l in listeners]
-            policies = self.plugin.db.get_l7policies(
-                context, filters={'listener_id': listener_ids})
+            if policies is None:
+                listener_ids = [l['id'] for l in listeners]
+                policies = self.plugin.db.get_l7policies(
+                    context, filters={'listener_id': listener_ids})
             l7policies.extend(self._l7policy_to_dict(p) for p in policies)
 
         for index, pol in enumerate(l7policies):
@@ -385,16 +771,22 @@ class LBaaSv2ServiceBuilder(object):
 
         return l7policies
 
-    @log_helpers.log_method_call
-    def _get_l7policy_rules(self, context, l7policies):
+    @tracing.trace
+    def _get_l7policy_rules(self, context, l7policies, rules=None):
         """Get l7 policy rules filtered by l7 policies."""
         l7policy_rules = []
+        policy_order = {}
         if l7policies:
             policy_ids = [p['id'] for p in l7policies]
-            for pol_id in policy_ids:
-                rules = self.plugin.db.get_l7policy_rules(context, pol_id)
-                l7policy_rules.extend(
-                    self._l7rule_to_dict(rule) for rule in rules)
+            policy_order = dict(
+                (pol_id, index) for index, pol_id in enumerate(policy_ids))
+            if rules is None:
+                # Get the rules of all policies in one query; the policy
+                # id argument is ignored when filters are given.
+                rules = self.plugin.db.get_l7policy_rules(
+                    context, None, filters={'l7policy_id': policy_ids})
+            l7policy_rules.extend(
+                self._l7rule_to_dict(rule) for rule in rules)
 
         for index, rule in enumerate(l7policy_rules):
             try:
@@ -408,15 +800,21 @@ class LBaaSv2ServiceBuilder(object):
                 pol = rule['policies'][0]
                 l7policy_rules[index]['policy_id'] = pol['id']
 
+        # Keep the rules grouped in policy order, as when they were
+        # fetched policy by policy.
+        l7policy_rules.sort(
+            key=lambda rule: policy_order.get(rule['policy_id'], 0))
+
         return l7policy_rules
 
-    @log_helpers.log_method_call
-    def _get_listeners(self, context, loadbalancer):
+    @tracing.trace
+    def _get_listeners(self, context, loadbalancer, db_listeners=None):
         listeners = []
-        db_listeners = self.plugin.db.get_listeners(
-            context,
-            filters={'loadbalancer_id': [loadbalancer.id]}
-        )
+        if db_listeners is None:
+            db_listeners = self.plugin.db.get_listeners(
+                context,
+                filters={'loadbalancer_id': [loadbalancer.id]}
+            )
 
         for listener in db_listeners:
             listener_dict = listener.to_dict(
@@ -433,26 +831,38 @@ class LBaaSv2ServiceBuilder(object):
 
         return listeners
 
-    @log_helpers.log_method_call
-    def _get_pools_and_healthmonitors(self, context, loadbalancer):
+    @tracing.trace
+    def _get_pools_and_healthmonitors(self, context, loadbalancer,
+                                      db_pools=None, db_healthmonitors=None):
         """Return list of pools and list of healthmonitors as dicts."""
         healthmonitors = []
         pools = []
 
         if loadbalancer and loadbalancer.id:
-            db_pools = self.plugin.db.get_pools(
-                context,
-                filters={'loadbalancer_id': [loadbalancer.id]}
-            )
+            if db_pools is None:
+                db_pools = self.plugin.db.get_pools(
+                    context,
+                    filters={'loadbalancer_id': [loadbalancer.id]}
+                )
+
+            # Get the health monitors of all pools in one query rather
+            # than one query per pool.
+            healthmonitor_ids = [pool.healthmonitor_id for pool in db_pools
+                                 if pool.healthmonitor_id]
+            if db_healthmonitors is None and healthmonitor_ids:
+                db_healthmonitors = self.plugin.db.get_healthmonitors(
+                    context,
+                    filters={'id': healthmonitor_ids})
+            healthmonitors_by_id = dict(
+                (healthmonitor.id, healthmonitor)
+                for healthmonitor in db_healthmonitors or [])
 
             for pool in db_pools:
                 pools.append(self._pool_to_dict(pool))
                 pool_id = pool.id
                 healthmonitor_id = pool.healthmonitor_id
                 if healthmonitor_id:
-                    healthmonitor = self.plugin.db.get_healthmonitor(
-                        context,
-                        healthmonitor_id)
+                    healthmonitor = healthmonitors_by_id.get(healthmonitor_id)
                     if healthmonitor:
                         healthmonitor_dict = healthmonitor.to_dict(pool=False)
                         healthmonitor_dict['pool_id'] = pool_id
@@ -460,19 +870,37 @@ class LBaaSv2ServiceBuilder(object):
 
         return pools, healthmonitors
 
-    @log_helpers.log_method_call
-    def _get_members(self, context, pools, subnet_map, network_map):
+    @tracing.trace
+    def _get_members(self, context, pools, subnet_map, network_map,
+                     members=None, state=None):
+        state = state or BuildState()
         pool_members = []
         if pools:
-            members = self.plugin.db.get_pool_members(
+            if members is None:
+                members = self.plugin.db.get_pool_members(
+                    context,
+                    filters={'pool_id': [p['id'] for p in pools]}
+                )
+
+            # Get the ports of all members in one query rather than
+            # one query per member.
+            member_ports = self._get_member_ports(context, members)
+
+            # Likewise resolve the segments of all member networks.
+            subnet_ids = set(member.subnet_id for member in members)
+            self._get_network_segments(
                 context,
-                filters={'pool_id': [p['id'] for p in pools]}
-            )
+                [self._get_subnet_cached(context, subnet_id)['network_id']
+                 for subnet_id in subnet_ids],
+                state=state)
 
             for member in members:
                 # Get extended member attributes, network, and subnet.
+                ports = member_ports.get(
+                    (member.subnet_id, member.address), [])
                 member_dict, subnet, network = (
-                    self._get_extended_member(context, member)
+                    self._get_extended_member(context, member, ports=ports,
+                                              state=state)
                 )
 
                 subnet_map[subnet['id']] = subnet
@@ -481,7 +909,37 @@ class LBaaSv2ServiceBuilder(object):
 
         return pool_members
 
-    @log_helpers.log_method_call
+    def _get_member_ports(self, context, members):
+        """Get member ports keyed by (subnet_id, ip_address).
+
+        The fixed_ips filter matches any port with an address on one of
+        the member subnets and one of the member addresses, so the result
+        is narrowed here to the exact subnet/address pair of each port.
+        """
+        member_ports = {}
+        subnet_ids = set()
+        addresses = set()
+        for member in members:
+            subnet_ids.add(member.subnet_id)
+            addresses.add(member.address)
+
+        if not subnet_ids:
+            return member_ports
+
+        filters = {'fixed_ips': {'subnet_id': list(subnet_ids),
+                                 'ip_address': list(addresses)}}
+        ports = self.plugin.db._core_plugin.get_ports(
+            context,
+            filters
+        )
+        for port in ports:
+            for fixed_ip in port.get('fixed_ips', []):
+                key = (fixed_ip.get('subnet_id'), fixed_ip.get('ip_address'))
+                member_ports.setdefault(key, []).append(port)
+
+        return member_ports
+
+    @tracing.trace
     def _pool_to_dict(self, pool):
         """Convert Pool data model to dict.
 
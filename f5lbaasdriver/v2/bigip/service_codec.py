@@ -0,0 +1,87 @@
+# coding=utf-8
+u"""Compact wire encoding of F5® LBaaSv2 service definitions."""
+# Copyright 2017 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import base64
+import zlib
+
+from oslo_serialization import jsonutils
+
+from f5lbaasdriver.v2.bigip import constants_v2
+
+ENCODING = 'zlib'
+
+
+def compact_port(port):
+    """Return a copy of a neutron port with only the fields agents use."""
+    return dict((field, value) for field, value in port.items()
+                if field in constants_v2.SERVICE_PORT_FIELDS)
+
+
+def compact_service(service):
+    """Return a copy of a service with compacted VIP and member ports.
+
+    The service itself is not modified; it may be shared with the
+    service cache.
+    """
+    service = dict(service)
+
+    loadbalancer = service.get('loadbalancer')
+    if loadbalancer and loadbalancer.get('vip_port'):
+        loadbalancer = dict(loadbalancer)
+        loadbalancer['vip_port'] = compact_port(loadbalancer['vip_port'])
+        service['loadbalancer'] = loadbalancer
+
+    if service.get('members'):
+        members = []
+        for member in service['members']:
+            if member.get('port'):
+                member = dict(member)
+                member['port'] = compact_port(member['port'])
+            members.append(member)
+        service['members'] = members
+
+    return service
+
+
+def encode_service(service):
+    """Encode a service as compressed, compact JSON.
+
+    :returns: dict -- {'encoding': 'zlib', 'data': <base64 text>}
+    """
+    content = jsonutils.dumps(compact_service(service),
+                              separators=(',', ':'))
+    data = zlib.compress(content, constants_v2.SERVICE_COMPRESSION_LEVEL)
+    return {'encoding': ENCODING, 'data': base64.b64encode(data)}
+
+
+def is_encoded(service):
+    """Whether a service is encoded with encode_service."""
+    return (isinstance(service, dict) and
+            service.get('encoding') == ENCODING and 'data' in service)
+
+
+def decode_service(service):
+    """Return the service definition of an encoded or plain service.
+
+    :raises ValueError: if an encoded service can not be decoded.
+    """
+    if not is_encoded(service):
+        return service
+    try:
+        content = zlib.decompress(base64.b64decode(service['data']))
+    except (TypeError, zlib.error) as e:
+        raise ValueError('Can not decode service: %s' % e)
+    return jsonutils.loads(content)
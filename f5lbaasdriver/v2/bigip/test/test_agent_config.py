@@ -0,0 +1,77 @@
+# Copyright 2017 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import pytest
+
+from f5lbaasdriver.v2.bigip import agent_config
+
+
+def test_parse_agent_configurations_cached():
+    conf = '{"environment_prefix": "Cached", "tunnel_types": ["vxlan"]}'
+    with mock.patch.object(agent_config.json, 'loads',
+                           wraps=agent_config.json.loads) as mock_loads:
+        res = agent_config.parse_agent_configurations(conf)
+        assert agent_config.parse_agent_configurations(conf) is res
+        assert mock_loads.call_count == 1
+
+    assert res == {'environment_prefix': 'Cached',
+                   'tunnel_types': ['vxlan']}
+    assert res.environment_prefix == 'Cached'
+    assert res.tunnel_types == ['vxlan']
+
+
+def test_parse_agent_configurations_by_agent():
+    size = len(agent_config._parsed_configurations)
+    with mock.patch.object(agent_config.json, 'loads',
+                           wraps=agent_config.json.loads) as mock_loads:
+        for score in range(10):
+            conf = '{"environment_capacity_score": %d}' % score
+            res = agent_config.parse_agent_configurations(
+                conf, agent_id='agent-1')
+            assert agent_config.parse_agent_configurations(
+                conf, agent_id='agent-1') is res
+            assert res.environment_capacity_score == score
+        assert mock_loads.call_count == 10
+
+    # Each report replaced the agent's entry.
+    assert len(agent_config._parsed_configurations) == size + 1
+
+
+def test_parse_agent_configurations_dict():
+    conf = {'environment_group_number': 2,
+            'environment_capacity_score': 0.5,
+            'common_networks': {'net-1': 'vlan-1'}}
+    res = agent_config.parse_agent_configurations(conf)
+    assert res == conf
+    assert res.environment_group_number == 2
+    assert res.environment_capacity_score == 0.5
+    assert res.common_networks == {'net-1': 'vlan-1'}
+    assert agent_config.parse_agent_configurations(res) is res
+
+
+def test_agent_configuration_defaults():
+    res = agent_config.AgentConfiguration()
+    assert res.environment_prefix is None
+    assert res.environment_group_number is None
+    assert res.environment_capacity_score == 0.0
+    assert res.common_networks == {}
+    assert res.f5_common_external_networks is False
+    assert res.tunnel_types == []
+
+
+@pytest.mark.parametrize('conf', ['{', '[1, 2]'])
+def test_parse_agent_configurations_error(conf):
+    with pytest.raises(ValueError):
+        agent_config.parse_agent_configurations(conf)
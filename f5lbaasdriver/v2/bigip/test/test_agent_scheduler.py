@@ -15,8 +15,12 @@
 import json
 import mock
 import pytest
+import sqlalchemy
+from sqlalchemy import orm
 
 from neutron_lbaas.extensions.lbaas_agentschedulerv2 import NoActiveLbaasAgent
+from neutron_lbaas.extensions.lbaas_agentschedulerv2 import \
+    NoEligibleLbaasAgent
 from neutron_lbaas.services.loadbalancer import data_models
 
 from f5lbaasdriver.v2.bigip import agent_scheduler
@@ -183,6 +187,19 @@ def test_get_agents_in_env_with_env_group_number():
     assert agents == [agent_conf, agent_conf]
 
 
+def test_get_agents_in_env_with_host():
+    mock_plugin = mock.MagicMock(name='plugin')
+    agent_conf = {'configurations': '{"environment_prefix": "Project"}'}
+    mock_plugin.db.get_lbaas_agents.return_value = [agent_conf]
+    mock_ctx = mock.MagicMock(name='context')
+    sched = agent_scheduler.TenantScheduler()
+    agents = sched.get_agents_in_env(
+        mock_ctx, mock_plugin, 'Project', active=True, host='host-1')
+    assert agents == [agent_conf]
+    mock_plugin.db.get_lbaas_agents.assert_called_once_with(
+        mock_ctx, active=True, filters={'host': ['host-1']})
+
+
 @mock.patch('f5lbaasdriver.v2.bigip.agent_scheduler.LOG')
 def test_get_agents_in_env_error(mock_log):
     mock_plugin = mock.MagicMock(name='plugin')
@@ -253,7 +270,6 @@ def test_schedule_already_assigned_agent():
     mock_lb = mock.MagicMock(name='lb')
     mock_lb.tenant_id = 'test_tenant'
     mock_plugin.db.get_loadbalancer.return_value = mock_lb
-    mock_plugin.db.list_loadbalancers_on_lbaas_agent.return_value = [mock_lb]
     agent1_conf = {'id': 34, 'configurations':
                    '{"environment_prefix": "Project", \
                     "environment_group_number": 4, \
@@ -267,5 +283,169 @@ def test_schedule_already_assigned_agent():
     sched = agent_scheduler.TenantScheduler()
     sched.get_lbaas_agent_hosting_loadbalancer = mock.MagicMock(
         name='get_lbaas_agent_hosting_loadbalancer', return_value=None)
+    sched.get_tenant_agent_ids = mock.MagicMock(
+        name='get_tenant_agent_ids', return_value=set([34]))
     res = sched.schedule(mock_plugin, mock_ctx, 'test_lb_id', 'Project')
     assert res == agent2_conf
+    sched.get_tenant_agent_ids.assert_called_once_with(
+        mock_ctx, 'test_tenant', [34, 34])
+
+
+def test_get_tenant_agent_ids_no_agents():
+    mock_ctx = mock.MagicMock(name='context')
+    sched = agent_scheduler.TenantScheduler()
+    assert sched.get_tenant_agent_ids(mock_ctx, 'test_tenant', []) == set()
+    assert mock_ctx.session.query.call_count == 0
+
+
+def test_get_tenant_agent_ids():
+    # Load every model, so the foreign keys of the tables resolve.
+    from neutron.db.migration.models import head  # noqa
+    from neutron_lbaas.agent_scheduler import LoadbalancerAgentBinding
+    from neutron_lbaas.db.loadbalancer import models
+
+    engine = sqlalchemy.create_engine('sqlite://')
+    models.LoadBalancer.metadata.create_all(engine, tables=[
+        LoadbalancerAgentBinding.__table__,
+        models.LoadBalancer.__table__])
+    session = orm.Session(bind=engine)
+    session.execute(models.LoadBalancer.__table__.insert(), [
+        {'id': lb_id, 'project_id': tenant_id, 'vip_subnet_id': 'subnet',
+         'admin_state_up': True, 'provisioning_status': 'ACTIVE',
+         'operating_status': 'ONLINE'}
+        for lb_id, tenant_id in (('lb1', 't1'), ('lb2', 't1'), ('lb3', 't1'),
+                                 ('lb4', 't1'), ('lb5', 't2'))])
+    # a1 hosts two loadbalancers of t1, a3 is not a candidate and a4
+    # only hosts a loadbalancer of another tenant.
+    session.execute(LoadbalancerAgentBinding.__table__.insert(), [
+        {'loadbalancer_id': 'lb1', 'agent_id': 'a1'},
+        {'loadbalancer_id': 'lb2', 'agent_id': 'a1'},
+        {'loadbalancer_id': 'lb3', 'agent_id': 'a2'},
+        {'loadbalancer_id': 'lb4', 'agent_id': 'a3'},
+        {'loadbalancer_id': 'lb5', 'agent_id': 'a4'}])
+    mock_ctx = mock.MagicMock(name='context')
+    mock_ctx.session = session
+    statements = []
+    sqlalchemy.event.listen(
+        engine, 'before_cursor_execute',
+        lambda conn, cursor, statement, *args: statements.append(statement))
+
+    sched = agent_scheduler.TenantScheduler()
+    agent_ids = sched.get_tenant_agent_ids(
+        mock_ctx, 't1', ['a1', 'a2', 'a4', 'a5'])
+    assert agent_ids == set(['a1', 'a2'])
+    assert len(statements) == 1
+    assert 'DISTINCT' in statements[0]
+    assert sched.get_tenant_agent_ids(mock_ctx, 't2', ['a1', 'a4']) == \
+        set(['a4'])
+    assert sched.get_tenant_agent_ids(mock_ctx, 't3', ['a1']) == set()
+
+
+def _weighted_agent(agent_id, group, capacity=0.0):
+    return {'id': agent_id, 'configurations': json.dumps(
+        {'environment_prefix': 'Project',
+         'environment_group_number': group,
+         'environment_capacity_score': capacity})}
+
+
+def _weighted_scheduler(loads, tenant_agent_ids=()):
+    sched = agent_scheduler.CapacityWeightedScheduler()
+    sched.count_agent_loads = mock.MagicMock(
+        name='count_agent_loads', return_value=loads)
+    sched.get_tenant_agent_ids = mock.MagicMock(
+        name='get_tenant_agent_ids', return_value=set(tenant_agent_ids))
+    return sched
+
+
+def test_capacity_weighted_least_loaded_group():
+    agents = [_weighted_agent('a1', 1), _weighted_agent('a2', 1),
+              _weighted_agent('b1', 2), _weighted_agent('b2', 2)]
+    # Group 1 carries 10 loadbalancers, group 2 carries 4 with 30 members.
+    sched = _weighted_scheduler({'a1': [5, 0], 'a2': [5, 0],
+                                 'b1': [1, 30], 'b2': [3, 0]})
+    lb = data_models.LoadBalancer(id='lb', tenant_id='tenant')
+    res = sched.choose_agent(mock.MagicMock(), lb, agents, 'Project')
+    assert res['id'] == 'b2'
+
+
+def test_capacity_weighted_capacity_score():
+    agents = [_weighted_agent('a1', 1, capacity=0.9),
+              _weighted_agent('b1', 2, capacity=0.1)]
+    sched = _weighted_scheduler({'a1': [4, 0], 'b1': [5, 0]})
+    lb = data_models.LoadBalancer(id='lb', tenant_id='tenant')
+    res = sched.choose_agent(mock.MagicMock(), lb, agents, 'Project')
+    assert res['id'] == 'b1'
+
+
+def test_capacity_weighted_tenant_affinity():
+    agents = [_weighted_agent('a1', 1), _weighted_agent('a2', 1),
+              _weighted_agent('b1', 2, capacity=1.0)]
+    sched = _weighted_scheduler({'a1': [9, 0], 'b1': [0, 0]},
+                                tenant_agent_ids=['a1'])
+    lb = data_models.LoadBalancer(id='lb', tenant_id='tenant')
+    res = sched.choose_agent(mock.MagicMock(), lb, agents, 'Project')
+    assert res['id'] == 'a1'
+    # Agents in groups without capacity are not considered for affinity.
+    sched.get_tenant_agent_ids.assert_called_once_with(
+        mock.ANY, 'tenant', ['a1', 'a2'])
+
+
+@mock.patch('f5lbaasdriver.v2.bigip.agent_scheduler.LOG')
+def test_capacity_weighted_no_capacity(mock_log):
+    agents = [_weighted_agent('a1', 1, capacity=1.0)]
+    sched = _weighted_scheduler({})
+    lb = data_models.LoadBalancer(id='lb', tenant_id='tenant')
+    with pytest.raises(NoEligibleLbaasAgent):
+        sched.choose_agent(mock.MagicMock(), lb, agents, 'Project')
+    assert sched.count_agent_loads.call_count == 0
+
+
+def test_capacity_weighted_cached_loads():
+    agents = [_weighted_agent('a1', 1), _weighted_agent('b1', 2)]
+    sched = _weighted_scheduler({'a1': [1, 0]})
+    ctx = mock.MagicMock(name='context')
+    lb = data_models.LoadBalancer(id='lb', tenant_id='tenant')
+
+    assert sched.choose_agent(ctx, lb, agents, 'Project')['id'] == 'b1'
+    # Both agents carry one loadbalancer now, either may be chosen.
+    second = sched.choose_agent(ctx, lb, agents, 'Project')['id']
+    sched.count_agent_loads.assert_called_once_with(ctx, mock.ANY)
+    assert sorted(sched.count_agent_loads.call_args[0][1]) == ['a1', 'b1']
+    # Loadbalancers scheduled here are counted until the next query.
+    loads = sched.get_agent_loads(ctx, ['a1', 'b1'])
+    assert loads[second] == [2, 0]
+    assert sorted(loads.values()) == [[1, 0], [2, 0]]
+
+
+def test_count_agent_loads():
+    # Load every model, so the foreign keys of the tables resolve.
+    from neutron.db.migration.models import head  # noqa
+    from neutron_lbaas.agent_scheduler import LoadbalancerAgentBinding
+    from neutron_lbaas.db.loadbalancer import models
+
+    engine = sqlalchemy.create_engine('sqlite://')
+    models.PoolV2.metadata.create_all(engine, tables=[
+        LoadbalancerAgentBinding.__table__,
+        models.PoolV2.__table__,
+        models.MemberV2.__table__])
+    session = orm.Session(bind=engine)
+    session.execute(LoadbalancerAgentBinding.__table__.insert(), [
+        {'loadbalancer_id': 'lb1', 'agent_id': 'a1'},
+        {'loadbalancer_id': 'lb2', 'agent_id': 'a1'},
+        {'loadbalancer_id': 'lb3', 'agent_id': 'a3'}])
+    session.execute(models.PoolV2.__table__.insert(), [
+        {'id': pool_id, 'loadbalancer_id': 'lb1', 'protocol': 'HTTP',
+         'lb_algorithm': 'ROUND_ROBIN', 'admin_state_up': True,
+         'provisioning_status': 'ACTIVE', 'operating_status': 'ONLINE'}
+        for pool_id in ('p1', 'p2')])
+    session.execute(models.MemberV2.__table__.insert(), [
+        {'id': 'm%d' % index, 'pool_id': 'p%d' % (index % 2 + 1),
+         'subnet_id': 'subnet', 'address': '10.0.0.%d' % index,
+         'protocol_port': 80, 'weight': 1, 'admin_state_up': True,
+         'provisioning_status': 'ACTIVE', 'operating_status': 'ONLINE'}
+        for index in range(3)])
+    mock_ctx = mock.MagicMock(name='context')
+    mock_ctx.session = session
+
+    sched = agent_scheduler.CapacityWeightedScheduler()
+    assert sched.count_agent_loads(mock_ctx, ['a1', 'a2']) == {'a1': [2, 3]}
@@ -0,0 +1,82 @@
+# Copyright 2017 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from f5lbaasdriver.v2.bigip.cache import TTLCache
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def timer():
+    return FakeTimer()
+
+
+def test_get_set(timer):
+    cache = TTLCache(10, 60, timer=timer)
+    assert cache.get('net-1') is None
+    cache.set('net-1', {'id': 'net-1'})
+    assert cache.get('net-1') == {'id': 'net-1'}
+    assert 'net-1' in cache
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 1,
+                             'expirations': 0, 'evictions': 0}
+
+
+def test_entry_expires(timer):
+    cache = TTLCache(10, 60, timer=timer)
+    cache.set('net-1', 'a')
+    cache.set('net-2', 'b', ttl=120)
+
+    timer.now += 60
+    assert 'net-1' not in cache
+    assert cache.get('net-1') is None
+    assert cache.get('net-2') == 'b'
+    assert cache.expirations == 1
+    assert len(cache) == 1
+
+
+def test_lru_eviction(timer):
+    cache = TTLCache(2, 60, timer=timer)
+    cache.set('net-1', 'a')
+    cache.set('net-2', 'b')
+
+    # Touch net-1 so that net-2 is the least recently used entry.
+    assert cache.get('net-1') == 'a'
+    cache.set('net-3', 'c')
+
+    assert 'net-2' not in cache
+    assert cache.get('net-1') == 'a'
+    assert cache.get('net-3') == 'c'
+    assert cache.evictions == 1
+
+
+def test_invalidate_and_clear(timer):
+    cache = TTLCache(10, 60, timer=timer)
+    cache.set('net-1', 'a')
+    cache.set('net-2', 'b')
+
+    cache.invalidate('net-1')
+    cache.invalidate('not-cached')
+    assert 'net-1' not in cache
+    assert 'net-2' in cache
+
+    cache.clear()
+    assert len(cache) == 0
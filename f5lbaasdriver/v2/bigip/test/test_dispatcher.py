@@ -0,0 +1,204 @@
+# Copyright 2017 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import pytest
+
+from neutron.plugins.common import constants as plugin_constants
+from neutron_lbaas.db.loadbalancer import models
+from neutron_lbaas.extensions import lbaas_agentschedulerv2
+
+from f5lbaasdriver.v2.bigip import dispatcher
+
+
+@pytest.fixture
+def mock_driver():
+    driver = mock.MagicMock(name='driver')
+    driver.scheduler.schedule.return_value = {'host': 'test_agent'}
+    driver.service_builder.build.side_effect = \
+        lambda context, lb, agent: {'loadbalancer': lb}
+    return driver
+
+
+@pytest.fixture
+def admin_context():
+    with mock.patch.object(dispatcher.n_context, 'get_admin_context') as ctx:
+        yield ctx.return_value
+
+
+def test_dispatch_coalesces_operations(mock_driver, admin_context):
+    disp = dispatcher.ServiceDispatcher(mock_driver, workers=2)
+    operations = [mock.MagicMock(name='op%d' % index) for index in range(3)]
+    for operation in operations:
+        disp.dispatch(mock.MagicMock(), 'lb1', operation)
+    disp.wait()
+
+    lb = mock_driver.plugin.db.get_loadbalancer.return_value
+    mock_driver.plugin.db.get_loadbalancer.assert_called_once_with(
+        admin_context, 'lb1')
+    mock_driver.service_builder.invalidate_service.assert_called_once_with(
+        'lb1')
+    assert mock_driver.service_builder.build.call_count == 1
+    for operation in operations:
+        operation.assert_called_once_with(
+            admin_context, 'test_agent', {'loadbalancer': lb})
+    assert (disp.dispatched, disp.coalesced, disp.builds) == (3, 2, 1)
+
+
+def test_dispatch_loadbalancers(mock_driver, admin_context):
+    disp = dispatcher.ServiceDispatcher(mock_driver, workers=2)
+    disp.dispatch(mock.MagicMock(), 'lb1', mock.MagicMock())
+    disp.dispatch(mock.MagicMock(), 'lb2', mock.MagicMock())
+    disp.wait()
+    assert mock_driver.service_builder.build.call_count == 2
+    assert disp.coalesced == 0
+
+
+def test_dispatch_during_build(mock_driver, admin_context):
+    """Operations queued while building run after, with a new build."""
+    disp = dispatcher.ServiceDispatcher(mock_driver, workers=2)
+    late = mock.MagicMock(name='late')
+
+    def early(context, agent_host, service):
+        disp.dispatch(mock.MagicMock(), 'lb1', late)
+
+    disp.dispatch(mock.MagicMock(), 'lb1', early)
+    disp.wait()
+    assert mock_driver.service_builder.build.call_count == 2
+    assert late.call_count == 1
+    assert disp._running == set()
+
+
+@mock.patch('f5lbaasdriver.v2.bigip.dispatcher.LOG')
+def test_dispatch_no_agent(mock_log, mock_driver, admin_context):
+    mock_driver.scheduler.schedule.side_effect = \
+        lbaas_agentschedulerv2.NoActiveLbaasAgent(loadbalancer_id='lb1')
+    operation = mock.MagicMock(name='operation')
+    disp = dispatcher.ServiceDispatcher(mock_driver, workers=2)
+    disp.dispatch(mock.MagicMock(), 'lb1', operation,
+                  entity=(models.MemberV2, 'member1'))
+    disp.dispatch(mock.MagicMock(), 'lb1', operation)
+    disp.wait()
+    assert operation.call_count == 0
+    assert mock_log.error.call_count == 1
+
+    # The request has returned, so the failure is recorded as status.
+    assert mock_driver.plugin.db.update_status.call_args_list == [
+        mock.call(admin_context, models.MemberV2, 'member1',
+                  plugin_constants.ERROR),
+        mock.call(admin_context, models.LoadBalancer, 'lb1',
+                  plugin_constants.ERROR)]
+
+
+@mock.patch('f5lbaasdriver.v2.bigip.dispatcher.LOG')
+def test_dispatch_operation_exception(mock_log, mock_driver, admin_context):
+    failing = mock.MagicMock(name='failing', side_effect=Exception('test'))
+    operation = mock.MagicMock(name='operation')
+    disp = dispatcher.ServiceDispatcher(mock_driver, workers=2)
+    disp.dispatch(mock.MagicMock(), 'lb1', failing,
+                  entity=(models.PoolV2, 'pool1'))
+    disp.dispatch(mock.MagicMock(), 'lb1', operation,
+                  entity=(models.MemberV2, 'member1'))
+    disp.wait()
+    assert operation.call_count == 1
+    assert mock_log.exception.call_count == 1
+    assert mock_driver.plugin.db.update_status.call_args_list == [
+        mock.call(admin_context, models.PoolV2, 'pool1',
+                  plugin_constants.ERROR),
+        mock.call(admin_context, models.LoadBalancer, 'lb1',
+                  plugin_constants.ERROR)]
+
+
+@mock.patch('f5lbaasdriver.v2.bigip.dispatcher.LOG')
+def test_dispatch_set_error_exception(mock_log, mock_driver, admin_context):
+    mock_driver.service_builder.build.side_effect = Exception('build')
+    mock_driver.plugin.db.update_status.side_effect = [
+        Exception('update'), None]
+    disp = dispatcher.ServiceDispatcher(mock_driver, workers=2)
+    disp.dispatch(mock.MagicMock(), 'lb1', mock.MagicMock(),
+                  entity=(models.Listener, 'listener1'))
+    disp.wait()
+
+    # A failed update does not keep the loadbalancer from ERROR.
+    mock_driver.plugin.db.update_status.assert_called_with(
+        admin_context, models.LoadBalancer, 'lb1', plugin_constants.ERROR)
+    assert mock_log.error.call_count == 1
+
+
+@mock.patch('f5lbaasdriver.v2.bigip.dispatcher.LOG')
+def test_dispatch_queue_full(mock_log, mock_driver, admin_context):
+    disp = dispatcher.ServiceDispatcher(mock_driver, workers=2, queue_size=1)
+    context = mock.MagicMock(name='context')
+    queued = mock.MagicMock(name='queued')
+    inline = mock.MagicMock(name='inline', side_effect=Exception('test'))
+    disp.dispatch(context, 'lb1', queued)
+    disp.dispatch(context, 'lb2', inline, entity=(models.MemberV2, 'm2'))
+
+    # The second loadbalancer is processed within the request.
+    assert inline.call_args[0][0] == context
+    assert queued.call_count == 0
+    assert mock_driver.plugin.db.update_status.call_args_list == [
+        mock.call(context, models.MemberV2, 'm2', plugin_constants.ERROR),
+        mock.call(context, models.LoadBalancer, 'lb2',
+                  plugin_constants.ERROR)]
+    disp.wait()
+    assert queued.call_count == 1
+
+
+@mock.patch('f5lbaasdriver.v2.bigip.dispatcher.LOG')
+def test_dispatch_pool_full(mock_log, mock_driver, admin_context):
+    disp = dispatcher.ServiceDispatcher(mock_driver, workers=1)
+    context = mock.MagicMock(name='context')
+    queued = mock.MagicMock(name='queued')
+    inline = mock.MagicMock(name='inline')
+    coalesced = mock.MagicMock(name='coalesced')
+    disp.dispatch(context, 'lb1', queued)
+    disp.dispatch(context, 'lb2', inline)
+    disp.dispatch(context, 'lb1', coalesced)
+
+    # The only worker is taken by the first loadbalancer, so the second
+    # one is processed within the request rather than waiting for it.
+    assert inline.call_args[0][0] == context
+    assert queued.call_count == 0
+    assert mock_log.warning.call_count == 1
+    disp.wait()
+    assert queued.call_count == 1
+    assert coalesced.call_count == 1
+
+
+def test_entity_operation():
+    agent_rpc = mock.MagicMock(name='agent_rpc')
+    operation = dispatcher.EntityOperation(
+        agent_rpc, 'update_health_monitor', ({'id': 'old'}, {'id': 'new'}),
+        lambda service: {'version': 1})
+
+    context = mock.MagicMock(name='context')
+    operation(context, 'test_agent', {'loadbalancer': {}})
+    agent_rpc.update_health_monitor.assert_called_once_with(
+        context, {'id': 'old'}, {'id': 'new'}, {'version': 1}, 'test_agent')
+
+
+def test_dispatch_delta_mode(mock_driver, admin_context, request):
+    dispatcher.cfg.CONF.set_override('f5_service_delta_mode', True)
+    request.addfinalizer(lambda: dispatcher.cfg.CONF.clear_override(
+        'f5_service_delta_mode'))
+    operation = mock.MagicMock(name='operation')
+    disp = dispatcher.ServiceDispatcher(mock_driver, workers=2)
+    disp.dispatch(mock.MagicMock(), 'lb1', operation)
+    disp.wait()
+
+    lb = mock_driver.plugin.db.get_loadbalancer.return_value
+    assert mock_driver.service_builder.build.call_count == 0
+    operation.assert_called_once_with(
+        admin_context, 'test_agent', {'loadbalancer': lb.to_api_dict()})
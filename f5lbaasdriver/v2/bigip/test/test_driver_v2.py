@@ -597,3 +597,169 @@ def test_membermgr_delete_no_lb_attached(happy_path_driver):
     with pytest.raises(dv2.F5NoAttachedLoadbalancerException) as ex:
         member_mgr.delete(mock_ctx, fake_member)
     assert 'Entity has no associated loadbalancer' == ex.value.message
+
+
+@pytest.fixture
+def delta_mode():
+    dv2.cfg.CONF.set_override('f5_service_delta_mode', True)
+    yield
+    dv2.cfg.CONF.clear_override('f5_service_delta_mode')
+
+
+def test_membermgr_create_delta_mode(happy_path_driver, delta_mode):
+    mock_driver, mock_ctx = happy_path_driver
+    mock_driver.service_builder.next_service_version.return_value = \
+        ('p:1', 'p:2')
+    member_mgr = dv2.MemberManager(mock_driver)
+    fake_member = FakeMember()
+    member_mgr.create(mock_ctx, fake_member)
+
+    # The full service is neither built nor sent.
+    assert mock_driver.service_builder.build.call_count == 0
+    mock_driver.service_builder.next_service_version.assert_called_once_with(
+        'test_lb_id')
+    assert mock_driver.agent_rpc.create_member.call_args == \
+        mock.call(mock_ctx, fake_member.to_dict(),
+                  {'loadbalancer': FakeLB().to_api_dict(),
+                   'base_service_version': 'p:1',
+                   'service_version': 'p:2',
+                   'delta': True},
+                  'test_agent')
+
+
+def test_membermgr_delete_delta_mode(happy_path_driver, delta_mode):
+    mock_driver, mock_ctx = happy_path_driver
+    mock_driver.service_builder.next_service_version.return_value = \
+        ('p:1', 'p:2')
+    port = {'id': 'port_id', 'device_owner': 'network:f5lbaasv2'}
+    core_plugin = mock_driver.plugin.db._core_plugin
+    core_plugin.get_ports.return_value = [port]
+    fake_member = FakeMember()
+    fake_member.subnet_id = 'subnet_id'
+    fake_member.address = '10.2.2.10'
+    dv2.MemberManager(mock_driver).delete(mock_ctx, fake_member)
+
+    # The driver owned port is found without the members of the service.
+    assert mock_driver.service_builder.build.call_count == 0
+    core_plugin.get_ports.assert_called_once_with(
+        mock_ctx, {'fixed_ips': {'subnet_id': ['subnet_id'],
+                                 'ip_address': ['10.2.2.10']}})
+    mock_driver.q_client.delete_port.assert_called_once_with(
+        mock_ctx, port_id='port_id')
+
+
+def test_lbmgr_update_delta_mode(happy_path_driver, delta_mode):
+    mock_driver, mock_ctx = happy_path_driver
+    service = {'loadbalancer': {'id': 'new_lb'}, 'members': []}
+    mock_driver.service_builder.build.return_value = service
+    lb_mgr = dv2.LoadBalancerManager(mock_driver)
+    old_lb = FakeLB(id='old_lb')
+    new_lb = FakeLB(id='new_lb')
+    lb_mgr.update(mock_ctx, old_lb, new_lb)
+    assert mock_driver.agent_rpc.update_loadbalancer.call_args == \
+        mock.call(mock_ctx, old_lb.to_api_dict(), new_lb.to_api_dict(),
+                  service, 'test_agent')
+
+
+@pytest.fixture
+def async_dispatch(request):
+    dv2.cfg.CONF.set_override('f5_async_dispatch', True)
+    request.addfinalizer(
+        lambda: dv2.cfg.CONF.clear_override('f5_async_dispatch'))
+
+
+def test_membermgr_create_async_dispatch(happy_path_driver, async_dispatch):
+    mock_driver, mock_ctx = happy_path_driver
+    member_mgr = dv2.MemberManager(mock_driver)
+    fake_member = FakeMember()
+    member_mgr.create(mock_ctx, fake_member)
+
+    assert mock_driver.service_builder.build.call_count == 0
+    assert mock_driver.agent_rpc.create_member.call_count == 0
+    dispatch = mock_driver.dispatcher.dispatch
+    dispatch.assert_called_once_with(
+        mock_ctx, 'test_lb_id', mock.ANY,
+        entity=(dv2.models.MemberV2, fake_member.id))
+
+    # The dispatcher runs the operation with the service it builds.
+    operation = dispatch.call_args[0][2]
+    operation(mock_ctx, 'test_agent', {'loadbalancer': {}})
+    mock_driver.agent_rpc.create_member.assert_called_once_with(
+        mock_ctx, fake_member.to_dict(), {'loadbalancer': {}}, 'test_agent')
+
+
+def test_membermgr_delete_async_dispatch(happy_path_driver, async_dispatch):
+    mock_driver, mock_ctx = happy_path_driver
+    member_mgr = dv2.MemberManager(mock_driver)
+    fake_member = FakeMember()
+    member_mgr.delete(mock_ctx, fake_member)
+
+    operation = mock_driver.dispatcher.dispatch.call_args[0][2]
+    port = {'id': 'port_id', 'device_owner': 'network:f5lbaasv2'}
+    operation(mock_ctx, 'test_agent',
+              {'members': [{'id': fake_member.id, 'port': port}]})
+    assert mock_driver.agent_rpc.delete_member.call_count == 1
+    mock_driver.q_client.delete_port.assert_called_once_with(
+        mock_ctx, port_id='port_id')
+
+
+def test_membermgr_async_dispatch_no_lb_attached(happy_path_driver,
+                                                 async_dispatch):
+    mock_driver, mock_ctx = happy_path_driver
+    member_mgr = dv2.MemberManager(mock_driver)
+    with pytest.raises(dv2.F5NoAttachedLoadbalancerException):
+        member_mgr.create(mock_ctx, FakeMember(attached_to_lb=False))
+    assert mock_driver.dispatcher.dispatch.call_count == 0
+
+
+def test_membermgr_create_invalidates_status(happy_path_driver):
+    mock_driver, mock_ctx = happy_path_driver
+    member_mgr = dv2.MemberManager(mock_driver)
+    member_mgr.create(mock_ctx, FakeMember())
+
+    invalidated = [call[0][0] for call in
+                   mock_driver.plugin_rpc.invalidate_status.call_args_list]
+    assert 'test_obj_id' in invalidated
+    assert 'test_lb_id' in invalidated
+
+
+def test_lbmgr_stats(happy_path_driver):
+    mock_driver, mock_ctx = happy_path_driver
+    mock_driver.scheduler.get_lbaas_agent_hosting_loadbalancer.return_value \
+        = {'agent': {'host': 'test_agent'}}
+    fake_lb = FakeLB()
+    fake_lb.listeners = [FakeLB(id='test_listener_id')]
+    lb_mgr = dv2.LoadBalancerManager(mock_driver)
+    lb_mgr.stats(mock_ctx, fake_lb)
+
+    assert mock_driver.scheduler.schedule.call_count == 0
+    assert mock_driver.service_builder.build.call_count == 0
+    mock_driver.agent_rpc.update_loadbalancer_stats.assert_called_once_with(
+        mock_ctx, fake_lb.to_api_dict(),
+        {'loadbalancer': fake_lb.to_api_dict(),
+         'listeners': [{'id': 'test_listener_id',
+                        'vip_port_id': 'test_vip_port_id'}]},
+        'test_agent')
+
+
+@mock.patch('f5lbaasdriver.v2.bigip.driver_v2.LOG')
+def test_lbmgr_stats_no_agent(mock_log, happy_path_driver):
+    mock_driver, mock_ctx = happy_path_driver
+    mock_driver.scheduler.get_lbaas_agent_hosting_loadbalancer.return_value \
+        = None
+    lb_mgr = dv2.LoadBalancerManager(mock_driver)
+    lb_mgr.stats(mock_ctx, FakeLB())
+    assert mock_driver.agent_rpc.update_loadbalancer_stats.call_count == 0
+    assert mock_log.warning.call_count == 1
+
+
+def test_lbmgr_stats_agent_push(happy_path_driver, request):
+    dv2.cfg.CONF.set_override('f5_agent_stats_push', True)
+    request.addfinalizer(
+        lambda: dv2.cfg.CONF.clear_override('f5_agent_stats_push'))
+    mock_driver, mock_ctx = happy_path_driver
+    lb_mgr = dv2.LoadBalancerManager(mock_driver)
+    lb_mgr.stats(mock_ctx, FakeLB())
+    assert mock_driver.scheduler.get_lbaas_agent_hosting_loadbalancer.\
+        call_count == 0
+    assert mock_driver.agent_rpc.update_loadbalancer_stats.call_count == 0
@@ -0,0 +1,473 @@
+# Copyright 2017 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import pytest
+import sqlalchemy
+from sqlalchemy import orm
+
+# Load every model, so the foreign keys of the tables resolve.
+from neutron.db.migration.models import head  # noqa
+from neutron_lbaas.db.loadbalancer import models
+
+from f5lbaasdriver.v2.bigip import agent_scheduler
+from f5lbaasdriver.v2.bigip import plugin_rpc
+from f5lbaasdriver.v2.bigip import service_builder
+
+
+@pytest.fixture
+def db_context():
+    engine = sqlalchemy.create_engine('sqlite://')
+    models.LoadBalancer.metadata.create_all(engine, tables=[
+        models.LoadBalancer.__table__,
+        models.LoadBalancerStatistics.__table__])
+    session = orm.Session(bind=engine, autocommit=True)
+    session.execute(models.LoadBalancer.__table__.insert(), [
+        {'id': loadbalancer_id, 'tenant_id': 'tenant',
+         'vip_subnet_id': 'subnet', 'admin_state_up': True,
+         'provisioning_status': 'ACTIVE', 'operating_status': 'ONLINE'}
+        for loadbalancer_id in ('lb1', 'lb2', 'lb3')])
+    session.execute(models.LoadBalancerStatistics.__table__.insert(), [
+        {'loadbalancer_id': 'lb1', 'bytes_in': 1, 'bytes_out': 1,
+         'active_connections': 1, 'total_connections': 1}])
+    mock_ctx = mock.MagicMock(name='context')
+    mock_ctx.session = session
+    return mock_ctx
+
+
+def _stored_stats(context):
+    table = models.LoadBalancerStatistics.__table__
+    return dict((row['loadbalancer_id'], dict(row))
+                for row in context.session.execute(table.select()))
+
+
+def test_update_loadbalancers_stats(db_context):
+    rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(mock.MagicMock())
+    stats = {'bytes_in': 10, 'bytes_out': 20, 'active_connections': 3,
+             'total_connections': 4}
+
+    failures = rpc.update_loadbalancers_stats(
+        db_context, stats={'lb1': stats, 'lb2': {'bytes_in': '5'}})
+
+    assert failures == {}
+    stored = _stored_stats(db_context)
+    assert stored['lb1'] == dict(stats, loadbalancer_id='lb1')
+    assert stored['lb2'] == {'loadbalancer_id': 'lb2', 'bytes_in': 5,
+                             'bytes_out': 0, 'active_connections': 0,
+                             'total_connections': 0}
+    assert 'lb3' not in stored
+
+
+def test_update_loadbalancers_stats_failures(db_context):
+    rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(mock.MagicMock())
+
+    failures = rpc.update_loadbalancers_stats(db_context, stats={
+        'lb1': {'bytes_in': -1},
+        'lb2': {'bytes_out': 'many'},
+        'lb3': {'bytes_in': 7},
+        'missing': {'bytes_in': 1}})
+
+    assert sorted(failures) == ['lb1', 'lb2', 'missing']
+    assert failures['missing'] == 'Loadbalancer not found'
+    stored = _stored_stats(db_context)
+    assert stored['lb1']['bytes_in'] == 1
+    assert stored['lb3']['bytes_in'] == 7
+    assert 'lb2' not in stored
+
+
+def test_update_loadbalancers_stats_db_error():
+    rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(mock.MagicMock())
+    mock_ctx = mock.MagicMock(name='context')
+    mock_ctx.session.query.side_effect = Exception('database is gone')
+
+    failures = rpc.update_loadbalancers_stats(
+        mock_ctx, stats={'lb1': {'bytes_in': 1}, 'lb2': {'bytes_in': -1}})
+
+    assert failures['lb1'] == 'database is gone'
+    assert 'negative' in failures['lb2']
+    assert rpc.update_loadbalancers_stats(mock_ctx) == {}
+
+
+@pytest.fixture
+def status_context():
+    engine = sqlalchemy.create_engine('sqlite://')
+    models.LoadBalancer.metadata.create_all(engine, tables=[
+        models.LoadBalancer.__table__,
+        models.Listener.__table__,
+        models.HealthMonitorV2.__table__,
+        models.PoolV2.__table__,
+        models.MemberV2.__table__,
+        models.L7Policy.__table__,
+        models.L7Rule.__table__])
+    session = orm.Session(bind=engine, autocommit=True)
+    status = {'admin_state_up': True, 'provisioning_status': 'ACTIVE',
+              'operating_status': 'ONLINE'}
+    session.execute(models.LoadBalancer.__table__.insert(), [
+        dict(status, id=loadbalancer_id, vip_subnet_id='subnet')
+        for loadbalancer_id in ('lb1', 'lb2')])
+    session.execute(models.Listener.__table__.insert(), [
+        dict(status, id='l1', loadbalancer_id='lb1', protocol='HTTP',
+             protocol_port=80),
+        dict(status, id='l2', loadbalancer_id='lb2', protocol='HTTP',
+             protocol_port=80, provisioning_status='PENDING_DELETE')])
+    session.execute(models.HealthMonitorV2.__table__.insert(), [
+        {'id': 'h1', 'type': 'HTTP', 'delay': 1, 'timeout': 1,
+         'max_retries': 1, 'admin_state_up': True,
+         'provisioning_status': 'ACTIVE'}])
+    session.execute(models.PoolV2.__table__.insert(), [
+        dict(status, id='p1', loadbalancer_id='lb1', healthmonitor_id='h1',
+             protocol='HTTP', lb_algorithm='ROUND_ROBIN')])
+    session.execute(models.MemberV2.__table__.insert(), [
+        dict(status, id='m%d' % index, pool_id='p1', subnet_id='subnet',
+             address='10.0.0.%d' % index, protocol_port=80, weight=1)
+        for index in range(50)])
+    session.execute(
+        models.MemberV2.__table__.update().where(
+            models.MemberV2.__table__.c.id == 'm1'),
+        {'provisioning_status': 'PENDING_DELETE'})
+    session.execute(models.L7Policy.__table__.insert(), [
+        {'id': 'r1', 'listener_id': 'l1', 'action': 'REJECT',
+         'position': 1, 'admin_state_up': True,
+         'provisioning_status': 'ACTIVE'}])
+    session.execute(models.L7Rule.__table__.insert(), [
+        {'id': 'rule1', 'l7policy_id': 'r1', 'type': 'PATH',
+         'compare_type': 'EQUAL_TO', 'invert': False, 'value': '/',
+         'admin_state_up': True, 'provisioning_status': 'ACTIVE'}])
+    mock_ctx = mock.MagicMock(name='context')
+    mock_ctx.session = session
+    return mock_ctx
+
+
+def _status(context, model, entity_id):
+    row = context.session.execute(model.__table__.select().where(
+        model.__table__.c.id == entity_id)).first()
+    return (row['provisioning_status'], row['operating_status']
+            if 'operating_status' in row else None)
+
+
+def test_update_statuses(status_context):
+    mock_driver = mock.MagicMock()
+    rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(mock_driver)
+
+    rpc.update_statuses(status_context, statuses=[
+        ['member', 'm0', 'ERROR', 'OFFLINE'],
+        ['member', 'm0', 'ACTIVE', 'OFFLINE'],
+        ['member', 'm1', 'ACTIVE', 'OFFLINE'],
+        ['listener', 'l2', 'ACTIVE', 'OFFLINE'],
+        ['healthmonitor', 'h1', 'ERROR', 'OFFLINE'],
+        ['l7rule', 'rule1', 'ERROR', None],
+        ['pool', 'p1', None, 'DEGRADED'],
+        ['member', 'missing', 'ACTIVE', 'ONLINE'],
+        ['vip', 'v1', 'ACTIVE', 'ONLINE'],
+        ['invalid']])
+
+    assert _status(status_context, models.MemberV2, 'm0') == \
+        ('ACTIVE', 'OFFLINE')
+    assert _status(status_context, models.MemberV2, 'm1') == \
+        ('PENDING_DELETE', 'ONLINE')
+    assert _status(status_context, models.MemberV2, 'm2') == \
+        ('ACTIVE', 'ONLINE')
+    assert _status(status_context, models.Listener, 'l2') == \
+        ('PENDING_DELETE', 'OFFLINE')
+    assert _status(status_context, models.HealthMonitorV2, 'h1') == \
+        ('ERROR', None)
+    assert _status(status_context, models.L7Rule, 'rule1') == \
+        ('ERROR', None)
+    assert _status(status_context, models.PoolV2, 'p1') == \
+        ('ACTIVE', 'DEGRADED')
+    invalidated = set(call[0][0] for call in mock_driver.service_builder.
+                      invalidate_service.call_args_list)
+    assert invalidated == set(['lb1', 'lb2'])
+
+
+def test_update_statuses_batches_statements(status_context):
+    rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(mock.MagicMock())
+    statements = []
+    sqlalchemy.event.listen(
+        status_context.session.bind, 'before_cursor_execute',
+        lambda conn, cursor, statement, *args: statements.append(statement))
+
+    rpc.update_statuses(status_context, statuses=[
+        ('member', 'm%d' % index, 'ACTIVE', 'OFFLINE')
+        for index in range(50)])
+
+    # One read and one write for all members, whatever their number.
+    assert [statement.split()[0] for statement in statements] == \
+        ['SELECT', 'UPDATE']
+    assert _status(status_context, models.MemberV2, 'm49') == \
+        ('ACTIVE', 'OFFLINE')
+
+
+def test_update_statuses_db_error():
+    rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(mock.MagicMock())
+    mock_ctx = mock.MagicMock(name='context')
+    mock_ctx.session.query.side_effect = Exception('database is gone')
+
+    rpc.update_statuses(mock_ctx, statuses=[('pool', 'p1', 'ACTIVE', None)])
+    rpc.update_statuses(mock_ctx)
+
+    assert rpc.driver.service_builder.invalidate_service.called is False
+
+
+@pytest.fixture
+def status_cache(request):
+    plugin_rpc.cfg.CONF.set_override('f5_status_cache_seconds', 60)
+    request.addfinalizer(lambda: plugin_rpc.cfg.CONF.clear_override(
+        'f5_status_cache_seconds'))
+
+
+def _member(provisioning_status='ACTIVE', operating_status='ONLINE'):
+    member = mock.MagicMock(name='member', spec=models.MemberV2)
+    member.id = 'm1'
+    member.provisioning_status = provisioning_status
+    member.operating_status = operating_status
+    return member
+
+
+def test_update_member_status_unchanged():
+    mock_driver = mock.MagicMock()
+    mock_driver.plugin.db.get_pool_member.return_value = _member()
+    rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(mock_driver)
+
+    rpc.update_member_status(mock.MagicMock(), 'm1', 'ACTIVE', 'ONLINE')
+    rpc.update_member_status(mock.MagicMock(), 'm1', None, 'ONLINE')
+    assert mock_driver.plugin.db.update_status.call_count == 0
+    assert mock_driver.service_builder.invalidate_service.call_count == 0
+
+    rpc.update_member_status(mock.MagicMock(), 'm1', 'ACTIVE', 'OFFLINE')
+    mock_driver.plugin.db.update_status.assert_called_once_with(
+        mock.ANY, models.MemberV2, 'm1', 'ACTIVE', 'OFFLINE')
+    # Without the status cache every report reads the database.
+    assert mock_driver.plugin.db.get_pool_member.call_count == 3
+
+
+def test_update_health_monitor_status_unchanged():
+    mock_driver = mock.MagicMock()
+    health_monitor = mock.MagicMock(name='health_monitor',
+                                    spec=models.HealthMonitorV2)
+    health_monitor.id = 'h1'
+    health_monitor.provisioning_status = 'ACTIVE'
+    mock_driver.plugin.db.get_healthmonitor.return_value = health_monitor
+    rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(mock_driver)
+
+    rpc.update_health_monitor_status(mock.MagicMock(), 'h1', 'ACTIVE',
+                                     'ONLINE')
+    assert mock_driver.plugin.db.update_status.call_count == 0
+
+
+def test_update_member_status_cached(status_cache):
+    mock_driver = mock.MagicMock()
+    mock_driver.plugin.db.get_pool_member.return_value = _member(
+        operating_status='OFFLINE')
+    rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(mock_driver)
+
+    for _ in range(3):
+        rpc.update_member_status(mock.MagicMock(), 'm1', None, 'ONLINE')
+    assert mock_driver.plugin.db.get_pool_member.call_count == 1
+    assert mock_driver.plugin.db.update_status.call_count == 1
+
+    # A new status, or one set outside the callbacks, reads the database.
+    rpc.update_member_status(mock.MagicMock(), 'm1', None, 'OFFLINE')
+    assert mock_driver.plugin.db.get_pool_member.call_count == 2
+    rpc.invalidate_status('m1')
+    rpc.update_member_status(mock.MagicMock(), 'm1', None, 'OFFLINE')
+    assert mock_driver.plugin.db.get_pool_member.call_count == 3
+
+
+def test_update_member_provisioning_status_not_cached(status_cache):
+    mock_driver = mock.MagicMock()
+    mock_driver.plugin.db.get_pool_member.return_value = _member()
+    rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(mock_driver)
+    rpc.update_member_status(mock.MagicMock(), 'm1', 'ACTIVE', 'ONLINE')
+    assert mock_driver.plugin.db.update_status.call_count == 0
+
+    # An API request in another process sets the member pending, which
+    # the cache of this process does not see.
+    mock_driver.plugin.db.get_pool_member.return_value = _member(
+        provisioning_status='PENDING_UPDATE')
+    rpc.update_member_status(mock.MagicMock(), 'm1', 'ACTIVE', 'ONLINE')
+    mock_driver.plugin.db.update_status.assert_called_once_with(
+        mock.ANY, models.MemberV2, 'm1', 'ACTIVE', 'ONLINE')
+    assert mock_driver.plugin.db.get_pool_member.call_count == 2
+
+
+def test_update_statuses_unchanged(status_context, status_cache):
+    mock_driver = mock.MagicMock()
+    rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(mock_driver)
+    statements = []
+    sqlalchemy.event.listen(
+        status_context.session.bind, 'before_cursor_execute',
+        lambda conn, cursor, statement, *args: statements.append(statement))
+    statuses = [('member', 'm%d' % index, None, 'ONLINE')
+                for index in range(50)] + [('l7rule', 'rule1', None,
+                                            'ONLINE')]
+
+    rpc.update_statuses(status_context, statuses=statuses)
+    assert [statement.split()[0] for statement in statements] == \
+        ['SELECT', 'SELECT']
+    assert mock_driver.service_builder.invalidate_service.call_count == 0
+
+    # Every status but the pending delete member's is now cached.
+    del statements[:]
+    rpc.update_statuses(status_context, statuses=statuses)
+    assert len(statements) == 1
+
+    # Provisioning statuses are always read.
+    del statements[:]
+    rpc.update_statuses(status_context,
+                        statuses=[('l7rule', 'rule1', 'ACTIVE', 'ONLINE')])
+    assert len(statements) == 1
+
+
+def test_get_services_by_loadbalancer_ids():
+    mock_driver = mock.MagicMock()
+    lbs = [mock.MagicMock(id=lb_id, vip_port_id='port-' + lb_id)
+           for lb_id in ('lb1', 'lb2', 'lb3', 'lb4')]
+    mock_driver.plugin.db.get_loadbalancers.return_value = lbs
+    builder = service_builder.LBaaSv2ServiceBuilder(mock_driver)
+    mock_driver.service_builder = builder
+
+    def build(context, loadbalancer, agent, state):
+        if loadbalancer.id == 'lb4':
+            raise Exception('loadbalancer deleted')
+        return {'loadbalancer': {'id': loadbalancer.id}, 'agent': agent}
+
+    builder._build = mock.MagicMock(side_effect=build)
+    rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(mock_driver)
+    agents = {'lb1': {'host': 'host-1'}, 'lb2': {'host': 'host-2'},
+              'lb4': {'host': 'host-1'}}
+    rpc._get_agents_hosting_loadbalancers = mock.MagicMock(
+        return_value=agents)
+
+    ids = ['lb1', 'lb2', 'lb3', 'lb4']
+    services = rpc.get_services_by_loadbalancer_ids(
+        mock.MagicMock(), loadbalancer_ids=ids, host='host-1')
+    # lb2 is hosted elsewhere, lb3 is not bound and lb4 fails to build.
+    assert services == {'lb1': {'loadbalancer': {'id': 'lb1'},
+                                'agent': agents['lb1']}}
+
+    services = rpc.get_services_by_loadbalancer_ids(
+        mock.MagicMock(), loadbalancer_ids=ids)
+    assert sorted(services) == ['lb1', 'lb2']
+    assert rpc.get_services_by_loadbalancer_ids(mock.MagicMock()) == {}
+
+
+def test_get_service_by_loadbalancer_id_delta_mode(request):
+    plugin_rpc.cfg.CONF.set_override('f5_service_delta_mode', True)
+    request.addfinalizer(lambda: plugin_rpc.cfg.CONF.clear_override(
+        'f5_service_delta_mode'))
+    mock_driver = mock.MagicMock()
+    builder = service_builder.LBaaSv2ServiceBuilder(mock_driver)
+    mock_driver.service_builder = builder
+    service = {'loadbalancer': {'id': 'lb1'}}
+    builder.next_service_version('lb1')
+    version = builder.get_service_version('lb1')
+
+    def build(context, loadbalancer, agent, state):
+        # a message sent during the build does not version the service
+        builder.next_service_version('lb1')
+        return service
+
+    builder._build = mock.MagicMock(side_effect=build)
+    rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(mock_driver)
+    pulled = rpc.get_service_by_loadbalancer_id(
+        mock.MagicMock(), loadbalancer_id='lb1')
+    assert pulled == {'loadbalancer': {'id': 'lb1'},
+                      'service_version': version}
+    assert 'service_version' not in service
+
+
+@pytest.fixture
+def inventory_driver():
+    from neutron_lbaas.agent_scheduler import LoadbalancerAgentBinding
+
+    engine = sqlalchemy.create_engine('sqlite://')
+    models.LoadBalancer.metadata.create_all(engine, tables=[
+        models.LoadBalancer.__table__,
+        LoadbalancerAgentBinding.__table__])
+    session = orm.Session(bind=engine, autocommit=True)
+    session.execute(models.LoadBalancer.__table__.insert(), [
+        {'id': loadbalancer_id, 'project_id': 'tenant-' + loadbalancer_id,
+         'vip_subnet_id': 'subnet', 'admin_state_up': True,
+         'provisioning_status': status, 'operating_status': 'ONLINE'}
+        for loadbalancer_id, status in (('lb1', 'ACTIVE'),
+                                        ('lb2', 'PENDING_CREATE'),
+                                        ('lb3', 'ERROR'),
+                                        ('lb4', 'ACTIVE'),
+                                        ('lb5', 'ACTIVE'))])
+    # lb5 has no agent binding.
+    session.execute(LoadbalancerAgentBinding.__table__.insert(), [
+        {'loadbalancer_id': 'lb1', 'agent_id': 'a1'},
+        {'loadbalancer_id': 'lb2', 'agent_id': 'a1'},
+        {'loadbalancer_id': 'lb3', 'agent_id': 'a2'},
+        {'loadbalancer_id': 'lb4', 'agent_id': 'a3'}])
+    mock_ctx = mock.MagicMock(name='context')
+    mock_ctx.session = session
+
+    agents = [
+        {'id': 'a1', 'host': 'host-1', 'alive': True,
+         'configurations': {'environment_prefix': 'env1',
+                            'environment_group_number': 1}},
+        {'id': 'a2', 'host': 'host-2', 'alive': False,
+         'configurations': {'environment_prefix': 'env1',
+                            'environment_group_number': 2}},
+        {'id': 'a3', 'host': 'host-3', 'alive': True,
+         'configurations': {'environment_prefix': 'env2',
+                            'environment_group_number': 1}}]
+
+    def get_lbaas_agents(context, active=None, filters=None):
+        hosts = (filters or {}).get('host')
+        return [agent for agent in agents
+                if (not active or agent['alive']) and
+                (not hosts or agent['host'] in hosts)]
+
+    mock_driver = mock.MagicMock()
+    mock_driver.plugin.db.get_lbaas_agents.side_effect = get_lbaas_agents
+    mock_driver.scheduler = agent_scheduler.TenantScheduler()
+    return mock_driver, mock_ctx
+
+
+def _lb_ids(loadbalancers):
+    return sorted(loadbalancer['lb_id'] for loadbalancer in loadbalancers)
+
+
+def test_get_all_loadbalancers(inventory_driver):
+    mock_driver, mock_ctx = inventory_driver
+    rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(mock_driver)
+
+    loadbalancers = rpc.get_all_loadbalancers(mock_ctx, 'env1')
+    assert sorted(loadbalancers) == sorted([
+        {'agent_host': 'host-1', 'lb_id': 'lb1', 'tenant_id': 'tenant-lb1'},
+        {'agent_host': 'host-1', 'lb_id': 'lb2', 'tenant_id': 'tenant-lb2'},
+        {'agent_host': 'host-2', 'lb_id': 'lb3', 'tenant_id': 'tenant-lb3'}])
+    assert _lb_ids(rpc.get_all_loadbalancers(
+        mock_ctx, 'env1', group=2)) == ['lb3']
+    assert _lb_ids(rpc.get_all_loadbalancers(
+        mock_ctx, 'env1', host='host-1')) == ['lb1', 'lb2']
+    assert _lb_ids(rpc.get_all_loadbalancers(mock_ctx, 'env2')) == ['lb4']
+    assert rpc.get_all_loadbalancers(mock_ctx, 'env3') == []
+
+
+def test_get_active_and_pending_loadbalancers(inventory_driver):
+    mock_driver, mock_ctx = inventory_driver
+    rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(mock_driver)
+
+    # Only the loadbalancers of live agents are active ones.
+    assert _lb_ids(rpc.get_active_loadbalancers(mock_ctx, 'env1')) == \
+        ['lb1']
+    assert rpc.get_active_loadbalancers(mock_ctx, 'env1', group=2) == []
+    assert _lb_ids(rpc.get_pending_loadbalancers(mock_ctx, 'env1')) == \
+        ['lb2']
+    assert _lb_ids(rpc.get_pending_loadbalancers(
+        mock_ctx, 'env1', host='host-2')) == []
@@ -14,9 +14,16 @@
 
 import mock
 import pytest
+import sqlalchemy
+from sqlalchemy import orm
 from uuid import uuid4
 
+from neutron.callbacks import events
+from neutron.callbacks import resources
+
 from f5lbaasdriver.v2.bigip import exceptions as f5_exc
+from f5lbaasdriver.v2.bigip import service_builder
+from f5lbaasdriver.v2.bigip.service_builder import BuildState
 from f5lbaasdriver.v2.bigip.service_builder import LBaaSv2ServiceBuilder
 
 
@@ -180,8 +187,28 @@ def test_get_l7policy_rules_filter(l7policies):
     service_builder._get_l7policy_rules(context, l7policies)
 
     assert service_builder.driver.plugin.db.get_l7policy_rules.call_args_list \
-        == [mock.call(context, l7policies[0]['id']),
-            mock.call(context, l7policies[1]['id'])]
+        == [mock.call(context, None, filters={
+            'l7policy_id': [l7policies[0]['id'], l7policies[1]['id']]})]
+
+
+def test_get_l7policy_rules_policy_order(l7policies):
+    """Rules fetched together are grouped in policy order."""
+    context = mock.MagicMock()
+    driver = mock.MagicMock()
+    first, second = l7policies
+    l7rules = [FakeDict(policies=[FakeDict(id=second['id'])]),
+               FakeDict(policies=[FakeDict(id=first['id'])]),
+               FakeDict(policies=[FakeDict(id=second['id'])])]
+
+    service_builder = LBaaSv2ServiceBuilder(driver)
+    service_builder.driver.plugin.db.get_l7policy_rules.return_value = \
+        l7rules
+    rules = service_builder._get_l7policy_rules(context, l7policies)
+
+    assert [rule['id'] for rule in rules] == \
+        [l7rules[1]['id'], l7rules[0]['id'], l7rules[2]['id']]
+    assert [rule['policy_id'] for rule in rules] == \
+        [first['id'], second['id'], second['id']]
 
 
 def test_get_l7policy_rules_no_policies():
@@ -247,16 +274,27 @@ def test_get_pools(loadbalancer, pools, monitors):
     driver = mock.MagicMock()
 
     service_builder = LBaaSv2ServiceBuilder(driver)
-    service_builder.driver.plugin.db.get_pools_and_healthmonitors = \
-        mock.MagicMock(return_value=(pools, monitors))
+    service_builder._pool_to_dict = lambda pool: pool
+    service_builder.plugin.db.get_pools.return_value = \
+        pools + [FakeDict(healthmonitor_id=None)]
+    # Monitors are joined to pools by id, whatever order they come in.
+    service_builder.plugin.db.get_healthmonitors.return_value = \
+        list(reversed(monitors))
 
     test_pools, test_monitors = \
         service_builder._get_pools_and_healthmonitors(
             context, loadbalancer)
 
-    for pool, test_pool, monitor in zip(pools, test_pools, monitors):
+    service_builder.plugin.db.get_healthmonitors.assert_called_once_with(
+        context, filters={'id': [monitor['id'] for monitor in monitors]})
+    assert service_builder.plugin.db.get_healthmonitor.call_count == 0
+    assert len(test_pools) == 3
+    assert len(test_monitors) == 2
+    for pool, test_pool, test_monitor in zip(pools, test_pools,
+                                             test_monitors):
         assert test_pool is pool
-        assert test_pool['healthmonitor_id'] == monitor['id']
+        assert test_monitor['id'] == pool['healthmonitor_id']
+        assert test_monitor['pool_id'] == pool['id']
 
 
 def test_get_members(pools, members):
@@ -287,3 +325,381 @@ def test__pool_to_dict():
     pool_dict = sb._pool_to_dict(fake_pool)
     assert 'listener_id' not in pool_dict
     assert 'listeners' not in pool_dict
+
+
+def test_get_members_bulk_port_lookup(pools):
+    """Member ports are fetched with one query and matched per member."""
+    context = mock.MagicMock()
+    driver = mock.MagicMock()
+    subnet_id = _uuid()
+    members = [FakeDict(subnet_id=subnet_id, address='10.2.2.10'),
+               FakeDict(subnet_id=subnet_id, address='10.2.2.11'),
+               FakeDict(subnet_id=subnet_id, address='10.2.2.12')]
+    ports = [FakeDict(fixed_ips=[{'subnet_id': subnet_id,
+                                  'ip_address': '10.2.2.11'}]),
+             FakeDict(fixed_ips=[{'subnet_id': subnet_id,
+                                  'ip_address': '10.2.2.10'}])]
+
+    service_builder = LBaaSv2ServiceBuilder(driver)
+    service_builder.disconnected_service = mock.MagicMock()
+    service_builder.plugin.db.get_pool_members.return_value = members
+    service_builder.plugin.db._core_plugin.get_ports.return_value = ports
+    service_builder.plugin.db._core_plugin.get_subnet.return_value = \
+        FakeDict(id=subnet_id, network_id=_uuid())
+    service_builder.plugin.db._core_plugin.get_network.return_value = \
+        FakeDict()
+
+    test_members = service_builder._get_members(context, pools, {}, {})
+
+    assert service_builder.plugin.db._core_plugin.get_ports.call_count == 1
+    assert test_members[0]['port'] is ports[1]
+    assert test_members[1]['port'] is ports[0]
+    assert 'port' not in test_members[2]
+
+
+def test_get_endpoints_indexed():
+    """Tunnel endpoints come from one get_agents call per build."""
+    context = mock.MagicMock()
+    driver = mock.MagicMock()
+    agents = [
+        {'host': 'host-1',
+         'configurations': {'tunnel_types': ['vxlan'],
+                            'tunneling_ip': '192.168.1.1'}},
+        {'host': 'host-2',
+         'configurations': {'tunnel_types': ['vxlan', 'gre'],
+                            'tunneling_ips': ['192.168.1.2',
+                                              '192.168.1.3']}},
+        {'host': 'host-3', 'configurations': {}}]
+
+    service_builder = LBaaSv2ServiceBuilder(driver)
+    service_builder.plugin.db._core_plugin.get_agents.return_value = agents
+    state = BuildState()
+
+    def get_endpoints(*args):
+        return service_builder._get_endpoints(context, *args, state=state)
+
+    assert get_endpoints('vxlan') == \
+        ['192.168.1.1', '192.168.1.2', '192.168.1.3']
+    assert get_endpoints('vxlan', 'host-1') == ['192.168.1.1']
+    assert get_endpoints('gre') == ['192.168.1.2', '192.168.1.3']
+    assert get_endpoints('gre', 'host-1') == []
+    assert get_endpoints('geneve') == []
+    assert service_builder.plugin.db._core_plugin.get_agents.call_count == 1
+
+
+@mock.patch('f5lbaasdriver.v2.bigip.service_builder.registry')
+def test_cache_callbacks_subscribed(mock_registry):
+    """Network and subnet update/delete events are subscribed to."""
+    driver = mock.MagicMock()
+    driver.env = 'dmz'
+
+    LBaaSv2ServiceBuilder(driver)
+
+    subscriptions = mock_registry.subscribe.call_args_list
+    assert len(subscriptions) == 4
+    assert set((c[0][1], c[0][2]) for c in subscriptions) == set([
+        (resources.NETWORK, events.AFTER_UPDATE),
+        (resources.NETWORK, events.AFTER_DELETE),
+        (resources.SUBNET, events.AFTER_UPDATE),
+        (resources.SUBNET, events.AFTER_DELETE)])
+    callback = subscriptions[0][0][0]
+    assert callback.__name__ == 'cache_invalidation_callback_dmz'
+
+
+def test_invalidate_cache():
+    """Only the network or subnet named in the event is invalidated."""
+    driver = mock.MagicMock()
+    service_builder = LBaaSv2ServiceBuilder(driver)
+    service_builder.net_cache.set('net-1', FakeDict(id='net-1'))
+    service_builder.net_cache.set('net-2', FakeDict(id='net-2'))
+    service_builder.subnet_cache.set('subnet-1', FakeDict(id='subnet-1'))
+    service_builder.subnet_cache.set('subnet-2', FakeDict(id='subnet-2'))
+
+    service_builder.invalidate_cache(resources.NETWORK,
+                                     network={'id': 'net-1'})
+    assert 'net-1' not in service_builder.net_cache
+    assert 'net-2' in service_builder.net_cache
+
+    service_builder.invalidate_cache(
+        resources.SUBNET,
+        subnet={'id': 'subnet-1', 'network_id': 'net-2'})
+    assert 'subnet-1' not in service_builder.subnet_cache
+    assert 'subnet-2' in service_builder.subnet_cache
+    assert 'net-2' not in service_builder.net_cache
+
+
+def test_service_versions():
+    builder = LBaaSv2ServiceBuilder(mock.MagicMock())
+    version = builder.get_service_version('lb-1')
+    assert builder.next_service_version('lb-1') == (
+        version, builder.get_service_version('lb-1'))
+    base, new = builder.next_service_version('lb-1')
+    assert base != version and base != new
+    assert builder.get_service_version('lb-2') == version
+
+    # Versions counted by another process never match.
+    assert LBaaSv2ServiceBuilder(mock.MagicMock()).get_service_version(
+        'lb-1') != version
+
+    builder.drop_service('lb-1')
+    assert builder.get_service_version('lb-1') == version
+    assert builder._service_versions == {}
+
+
+@pytest.fixture
+def service_cache_seconds(request):
+    service_builder.cfg.CONF.set_override('f5_service_cache_seconds', 60)
+    request.addfinalizer(lambda: service_builder.cfg.CONF.clear_override(
+        'f5_service_cache_seconds'))
+
+
+def test_build_service_cache(service_cache_seconds):
+    """Services are rebuilt only after their loadbalancer is invalidated."""
+    driver = mock.MagicMock()
+    builder = LBaaSv2ServiceBuilder(driver)
+    builder._build = mock.MagicMock(
+        side_effect=lambda context, lb, agent, state: {
+            'loadbalancer': lb.id})
+    context = mock.MagicMock()
+    lb1 = FakeDict(id='lb-1')
+    lb2 = FakeDict(id='lb-2')
+    agent = {'id': 'agent-1'}
+
+    service = builder.build(context, lb1, agent)
+    assert builder.build(context, lb1, agent) is service
+    assert builder._build.call_count == 1
+
+    # A different agent gets its own service.
+    builder.build(context, lb1, {'id': 'agent-2'})
+    assert builder._build.call_count == 2
+
+    builder.build(context, lb2, agent)
+    builder.invalidate_service('lb-1')
+    builder.build(context, lb1, agent)
+    builder.build(context, lb2, agent)
+    assert builder._build.call_count == 4
+
+    builder.invalidate_cache(resources.NETWORK, network={'id': 'net-1'})
+    builder.build(context, lb2, agent)
+    assert builder._build.call_count == 5
+
+    # Destroyed loadbalancers leave no generations behind.
+    builder.drop_service('lb-1')
+    builder.drop_service('lb-2')
+    assert builder._service_generations == {}
+    assert 'lb-2' not in builder.service_cache
+
+
+def test_build_service_cache_disabled():
+    driver = mock.MagicMock()
+    builder = LBaaSv2ServiceBuilder(driver)
+    builder._build = mock.MagicMock(return_value={})
+    lb = FakeDict(id='lb-1')
+
+    builder.build(mock.MagicMock(), lb, None)
+    builder.build(mock.MagicMock(), lb, None)
+    assert builder._build.call_count == 2
+    assert len(builder.service_cache) == 0
+
+    builder.invalidate_service('lb-1')
+    assert builder._service_generations == {}
+
+
+def test_build_many():
+    """VIP ports are fetched once and each service gets its own agent."""
+    context = mock.MagicMock()
+    driver = mock.MagicMock()
+    lbs = [FakeDict(id='lb-1', vip_port_id='port-1'),
+           FakeDict(id='lb-2', vip_port_id='port-2')]
+    agents = {'lb-1': {'id': 'agent-1'}, 'lb-2': {'id': 'agent-2'}}
+    vip_ports = [FakeDict(id='port-1'), FakeDict(id='port-2')]
+
+    builder = LBaaSv2ServiceBuilder(driver)
+    core_plugin = builder.plugin.db._core_plugin
+    core_plugin.get_ports.return_value = vip_ports
+
+    def build(context, lb, agent, state):
+        return {'loadbalancer': builder._get_extended_loadbalancer(
+            context, lb, state=state), 'agent': agent}
+
+    builder._build = mock.MagicMock(side_effect=build)
+    services = builder.build_many(context, lbs, agents)
+
+    assert sorted(services.keys()) == ['lb-1', 'lb-2']
+    assert services['lb-1']['loadbalancer']['vip_port'] is vip_ports[0]
+    assert services['lb-2']['loadbalancer']['vip_port'] is vip_ports[1]
+    assert services['lb-2']['agent'] == agents['lb-2']
+    core_plugin.get_ports.assert_called_once_with(
+        context, filters={'id': ['port-1', 'port-2']})
+    assert core_plugin.get_port.call_count == 0
+
+
+def test_get_network_segments_memo():
+    """Segments are looked up in bulk once per network and build."""
+    context = mock.MagicMock()
+    driver = mock.MagicMock()
+    builder = LBaaSv2ServiceBuilder(driver)
+    builder.disconnected_service = mock.MagicMock()
+    bulk = builder.disconnected_service.get_network_segments_by_network_ids
+    bulk.return_value = {'net-1': [{'segmentation_id': 10}]}
+
+    state = BuildState()
+
+    segments = builder._get_network_segments(
+        context, ['net-1', 'net-2'], state=state)
+    assert segments == {'net-1': [{'segmentation_id': 10}], 'net-2': []}
+
+    network = FakeDict(id='net-1')
+    builder._get_network_segment(context, {}, network, state=state)
+    bulk.assert_called_once_with(context.session, mock.ANY)
+    assert sorted(bulk.call_args[0][1]) == ['net-1', 'net-2']
+    builder.disconnected_service.get_network_segment.assert_called_once_with(
+        context, {}, network, segments=[{'segmentation_id': 10}])
+
+    builder._get_network_segments(context, ['net-1'], state=BuildState())
+    assert bulk.call_count == 2
+
+
+def test_get_network_segments_concurrent_build():
+    """A build started while segments are queried keeps its own state."""
+    context = mock.MagicMock()
+    driver = mock.MagicMock()
+    builder = LBaaSv2ServiceBuilder(driver)
+    builder._build = mock.MagicMock(return_value={})
+    builder.disconnected_service = mock.MagicMock()
+    state = BuildState()
+    state.network_segments['net-1'] = [{'segmentation_id': 10}]
+
+    def bulk(session, network_ids):
+        # another greenthread builds while this one waits on the query
+        builder.build(context, FakeDict(id='lb-2'), None)
+        return {'net-2': [{'segmentation_id': 20}]}
+
+    builder.disconnected_service.get_network_segments_by_network_ids.\
+        side_effect = bulk
+    segments = builder._get_network_segments(
+        context, ['net-1', 'net-2'], state=state)
+    assert segments == {'net-1': [{'segmentation_id': 10}],
+                        'net-2': [{'segmentation_id': 20}]}
+
+
+def test_statement_counter():
+    engine = sqlalchemy.create_engine('sqlite://')
+    session = orm.Session(bind=engine)
+
+    with service_builder.StatementCounter(session) as counter:
+        session.execute('SELECT 1')
+        session.execute('SELECT 2')
+    session.execute('SELECT 3')
+    assert counter.count == 2
+
+
+def test_statement_counter_unbound():
+    session = mock.MagicMock()
+    with service_builder.StatementCounter(session) as counter:
+        pass
+    assert counter.count == 0
+
+
+def _populate_loadbalancer_graph(session, count):
+    """Add a loadbalancer with count listeners and pools to a database."""
+    from neutron_lbaas.db.loadbalancer import models
+
+    status = {'admin_state_up': True, 'provisioning_status': 'ACTIVE'}
+    operating = dict(status, operating_status='ONLINE')
+    session.execute(models.LoadBalancer.__table__.insert(), [
+        dict(operating, id='lb', vip_subnet_id='subnet')])
+    session.execute(models.HealthMonitorV2.__table__.insert(), [
+        dict(status, id='hm-%d' % index, type='HTTP', delay=1, timeout=1,
+             max_retries=1)
+        for index in range(count)])
+    session.execute(models.PoolV2.__table__.insert(), [
+        dict(operating, id='pool-%d' % index, loadbalancer_id='lb',
+             healthmonitor_id='hm-%d' % index, protocol='HTTP',
+             lb_algorithm='ROUND_ROBIN')
+        for index in range(count)])
+    session.execute(models.MemberV2.__table__.insert(), [
+        dict(operating, id='member-%d' % index,
+             pool_id='pool-%d' % (index % count), subnet_id='subnet',
+             address='10.0.0.%d' % index, protocol_port=80, weight=1)
+        for index in range(3 * count)])
+    session.execute(models.Listener.__table__.insert(), [
+        dict(operating, id='listener-%d' % index, loadbalancer_id='lb',
+             default_pool_id='pool-%d' % index, protocol='HTTP',
+             protocol_port=80 + index)
+        for index in range(count)])
+    session.execute(models.L7Policy.__table__.insert(), [
+        dict(status, id='policy-%d' % index,
+             listener_id='listener-%d' % (index % count), action='REJECT',
+             position=index)
+        for index in range(2 * count)])
+    session.execute(models.L7Rule.__table__.insert(), [
+        dict(status, id='rule-%d' % index,
+             l7policy_id='policy-%d' % (index % (2 * count)), type='PATH',
+             compare_type='EQUAL_TO', invert=False, value='/')
+        for index in range(4 * count)])
+
+
+@pytest.mark.parametrize('count', [1, 5])
+def test_get_loadbalancer_graph(count):
+    """The graph is read with the same statements whatever its size."""
+    # Load every model, so the foreign keys of the tables resolve.
+    from neutron.db.migration.models import head  # noqa
+    from neutron_lbaas.db.loadbalancer import models
+
+    engine = sqlalchemy.create_engine('sqlite://')
+    models.LoadBalancer.metadata.create_all(engine, tables=[
+        table for table in models.LoadBalancer.metadata.sorted_tables
+        if table.name.startswith('lbaas_') or
+        table.name == 'providerresourceassociations'])
+    session = orm.Session(bind=engine, autocommit=True)
+    _populate_loadbalancer_graph(session, count)
+    context = mock.MagicMock()
+    context.session = session
+
+    builder = LBaaSv2ServiceBuilder(mock.MagicMock())
+    builder.plugin.db._model_query.side_effect = (
+        lambda context, model: context.session.query(model))
+    statements = []
+    sqlalchemy.event.listen(
+        engine, 'before_cursor_execute',
+        lambda conn, cursor, statement, *args: statements.append(statement))
+    graph = builder._get_loadbalancer_graph(context, FakeDict(id='lb'))
+
+    assert len(statements) == 9
+    sizes = dict((name, len(items)) for name, items in graph.items())
+    assert sizes == {'listeners': count,
+                     'pools': count,
+                     'healthmonitors': count,
+                     'members': 3 * count,
+                     'l7policies': 2 * count,
+                     'l7policy_rules': 4 * count}
+    assert sorted(rule.id for rule in graph['l7policy_rules']) == \
+        sorted('rule-%d' % index for index in range(4 * count))
+
+
+@pytest.fixture
+def eager_loading(request):
+    service_builder.cfg.CONF.set_override('f5_service_eager_loading', True)
+    request.addfinalizer(lambda: service_builder.cfg.CONF.clear_override(
+        'f5_service_eager_loading'))
+
+
+def test_build_eager_loading(eager_loading):
+    """The eager graph replaces the per-object plugin queries."""
+    context = mock.MagicMock()
+    driver = mock.MagicMock()
+    builder = LBaaSv2ServiceBuilder(driver)
+    builder.disconnected_service = mock.MagicMock()
+    builder._get_loadbalancer_graph = mock.MagicMock(return_value={
+        'listeners': [], 'pools': [], 'healthmonitors': [],
+        'members': [], 'l7policies': [], 'l7policy_rules': []})
+    builder.plugin.db._core_plugin.get_network.return_value = FakeDict(
+        id='net', tenant_id='tenant')
+
+    builder.build(context, FakeDict(tenant_id='tenant'),
+                  {'id': 'agent', 'configurations': {}})
+
+    assert builder._get_loadbalancer_graph.call_count == 1
+    assert builder.plugin.db.get_listeners.call_count == 0
+    assert builder.plugin.db.get_pools.call_count == 0
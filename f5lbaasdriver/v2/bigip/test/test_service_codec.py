@@ -0,0 +1,136 @@
+# Copyright 2017 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import mock
+import pytest
+
+from f5lbaasdriver.v2.bigip import agent_rpc
+from f5lbaasdriver.v2.bigip import service_codec
+
+
+def _port(port_id):
+    return {'id': port_id,
+            'network_id': 'net',
+            'mac_address': 'fa:16:3e:00:00:01',
+            'fixed_ips': [{'subnet_id': 'subnet', 'ip_address': '10.0.0.1'}],
+            'binding:host_id': 'host',
+            'security_groups': ['sg'],
+            'allowed_address_pairs': [],
+            'extra_dhcp_opts': [],
+            'binding:profile': {}}
+
+
+@pytest.fixture
+def service():
+    return {'loadbalancer': {'id': 'lb', 'vip_port': _port('vip')},
+            'members': [{'id': 'm1', 'port': _port('p1')},
+                        {'id': 'm2'}],
+            'networks': {'net': {'id': 'net'}}}
+
+
+def test_compact_service(service):
+    original = copy.deepcopy(service)
+    compact = service_codec.compact_service(service)
+
+    assert service == original
+    for port in (compact['loadbalancer']['vip_port'],
+                 compact['members'][0]['port']):
+        assert sorted(port) == ['binding:host_id', 'fixed_ips', 'id',
+                                'mac_address', 'network_id']
+    assert compact['members'][1] == {'id': 'm2'}
+    assert compact['networks'] == service['networks']
+
+
+def test_encode_decode_service(service):
+    encoded = service_codec.encode_service(service)
+    assert service_codec.is_encoded(encoded)
+    assert sorted(encoded) == ['data', 'encoding']
+    assert service_codec.decode_service(encoded) == \
+        service_codec.compact_service(service)
+
+
+def test_decode_plain_service(service):
+    assert not service_codec.is_encoded(service)
+    assert service_codec.decode_service(service) is service
+
+
+def test_decode_service_error():
+    with pytest.raises(ValueError):
+        service_codec.decode_service({'encoding': 'zlib', 'data': 'YWJj'})
+
+
+@pytest.fixture
+def service_compression(request):
+    agent_rpc.cfg.CONF.set_override('f5_service_compression', True)
+    request.addfinalizer(lambda: agent_rpc.cfg.CONF.clear_override(
+        'f5_service_compression'))
+
+
+@mock.patch('f5lbaasdriver.v2.bigip.agent_rpc.rpc')
+def test_cast_encoded_service(mock_rpc, service, service_compression):
+    driver = mock.MagicMock(name='driver', env=None)
+    driver.plugin.db.get_lbaas_agents.return_value = [
+        {'id': 'a1', 'configurations': {'rpc_api_version': '1.1'}}]
+    rpc_api = agent_rpc.LBaaSv2AgentRPC(driver)
+    context = mock.MagicMock(name='context')
+    rpc_api.create_member(context, {'id': 'm1'}, service, 'host')
+
+    assert driver.plugin.db.get_lbaas_agents.call_args == mock.call(
+        context, filters={'host': ['host']})
+    client = mock_rpc.get_client.return_value
+    assert client.prepare.call_args == mock.call(
+        topic='f5-lbaasv2-process-on-agent.host', version='1.1')
+    callee = client.prepare.return_value
+    args = callee.cast.call_args[1]
+    assert callee.cast.call_args[0] == (context, 'create_member')
+    assert args['member'] == {'id': 'm1'}
+    assert service_codec.decode_service(args['service']) == \
+        service_codec.compact_service(service)
+
+
+@mock.patch('f5lbaasdriver.v2.bigip.agent_rpc.rpc')
+def test_cast_plain_service(mock_rpc, service):
+    driver = mock.MagicMock(name='driver', env=None)
+    rpc_api = agent_rpc.LBaaSv2AgentRPC(driver)
+    rpc_api.create_member(mock.MagicMock(), {'id': 'm1'}, service, 'host')
+
+    client = mock_rpc.get_client.return_value
+    assert client.prepare.call_args == mock.call(
+        topic='f5-lbaasv2-process-on-agent.host')
+    assert client.prepare.return_value.cast.call_args[1]['service'] is \
+        service
+
+
+@pytest.mark.parametrize('configurations', [
+    {},
+    {'rpc_api_version': '1.0'},
+    {'rpc_api_version': 1.1},
+    'not json',
+])
+@mock.patch('f5lbaasdriver.v2.bigip.agent_rpc.rpc')
+def test_cast_plain_service_to_older_agent(
+        mock_rpc, service, service_compression, configurations):
+    driver = mock.MagicMock(name='driver', env=None)
+    driver.plugin.db.get_lbaas_agents.return_value = [
+        {'id': 'a1', 'configurations': {'rpc_api_version': '1.1'}},
+        {'id': 'a2', 'configurations': configurations}]
+    rpc_api = agent_rpc.LBaaSv2AgentRPC(driver)
+    rpc_api.create_member(mock.MagicMock(), {'id': 'm1'}, service, 'host')
+
+    client = mock_rpc.get_client.return_value
+    assert client.prepare.call_args == mock.call(
+        topic='f5-lbaasv2-process-on-agent.host')
+    assert client.prepare.return_value.cast.call_args[1]['service'] is \
+        service
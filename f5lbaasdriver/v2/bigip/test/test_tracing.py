@@ -0,0 +1,181 @@
+# Copyright 2017 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import pytest
+
+from f5lbaasdriver.v2.bigip import tracing
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        self.now += 0.5
+        return self.now
+
+
+@pytest.fixture
+def tracer():
+    return tracing.Tracer(buffer_size=3, timer=FakeTimer())
+
+
+def _traced_builder(tracer):
+    class Builder(object):
+        @tracer.trace
+        def build(self, context, service, agent=None):
+            if service is None:
+                raise ValueError('no service')
+            return 'built'
+
+    return Builder()
+
+
+def test_get_size():
+    assert tracing.get_size(None) == 0
+    assert tracing.get_size(42) == 0
+    assert tracing.get_size('abc') == 3
+    assert tracing.get_size([1, 2]) == 2
+    service = {'loadbalancer': {'id': 'lb'},
+               'members': [{}, {}, {}],
+               'healthmonitors': []}
+    assert tracing.get_size(service) == 3 + 1 + 3
+
+
+def test_trace(tracer):
+    builder = _traced_builder(tracer)
+
+    assert builder.build('context', {'members': [{}, {}]}) == 'built'
+    assert builder.build.__name__ == 'build'
+    with pytest.raises(ValueError):
+        builder.build('context', None, agent={'id': 'agent'})
+
+    stats = tracer.stats()['Builder.build']
+    assert stats == {'calls': 2, 'errors': 1, 'seconds': 1.0,
+                     'max_seconds': 0.5, 'max_arg_size': 7 + 3}
+    assert tracer.records() == [
+        (100.5, 'Builder.build', 0.5, 7 + 3, False),
+        (101.5, 'Builder.build', 0.5, 7 + 1, True)]
+
+
+def test_trace_ring_buffer(tracer):
+    builder = _traced_builder(tracer)
+    for _ in range(5):
+        builder.build('context', {})
+
+    assert len(tracer.records()) == 3
+    assert tracer.stats()['Builder.build']['calls'] == 5
+
+    tracer.reset()
+    assert tracer.records() == []
+    assert tracer.stats() == {}
+
+
+def test_trace_disabled(tracer):
+    builder = _traced_builder(tracer)
+    tracer.disable()
+    assert builder.build('context', {}) == 'built'
+    assert tracer.stats() == {}
+
+    tracer.enable()
+    builder.build('context', {})
+    assert tracer.stats()['Builder.build']['calls'] == 1
+
+
+@mock.patch('f5lbaasdriver.v2.bigip.tracing.logging')
+def test_trace_log_arguments(mock_logging):
+    tracer = tracing.Tracer()
+    builder = _traced_builder(tracer)
+    mock_log = mock_logging.getLogger.return_value
+
+    builder.build('context', {})
+    assert mock_log.debug.call_count == 0
+
+    tracer.set_log_arguments('Builder.build')
+    builder.build('context', {}, agent='agent')
+    mock_log.debug.assert_called_once_with(
+        mock.ANY, {'name': 'Builder.build', 'args': ('context', {}),
+                   'kwargs': {'agent': 'agent'}})
+
+    tracer.set_log_arguments('Builder.build', enabled=False)
+    builder.build('context', {})
+    assert mock_log.debug.call_count == 1
+
+
+def test_configure(request):
+    overrides = {'f5_trace_calls': False,
+                 'f5_trace_buffer_size': 10,
+                 'f5_trace_log_arguments': ['Builder.build']}
+    for name, value in overrides.items():
+        tracing.cfg.CONF.set_override(name, value)
+        request.addfinalizer(
+            lambda name=name: tracing.cfg.CONF.clear_override(name))
+
+    tracer = tracing.Tracer(buffer_size=2)
+    tracer.configure()
+    assert tracer.enabled is False
+    assert tracer.log_arguments == set(['Builder.build'])
+    assert tracer._records.maxlen == 10
+
+
+def test_mutate_config(request):
+    tracing.cfg.CONF.set_override('f5_trace_calls', False)
+    request.addfinalizer(
+        lambda: tracing.cfg.CONF.clear_override('f5_trace_calls'))
+
+    tracer = tracing.Tracer()
+    tracer.mutate_config(tracing.cfg.CONF, {(None, 'debug'): (False, True)})
+    assert tracer.enabled is True
+    tracer.mutate_config(tracing.cfg.CONF,
+                         {(None, 'f5_trace_calls'): (True, False)})
+    assert tracer.enabled is False
+
+
+@mock.patch('f5lbaasdriver.v2.bigip.tracing.LOG')
+def test_log_stats(mock_log, tracer):
+    builder = _traced_builder(tracer)
+    builder.build('context', {})
+    with pytest.raises(ValueError):
+        builder.build('context', None)
+
+    tracer.log_stats()
+    mock_log.info.assert_called_once_with(
+        mock.ANY, {'name': 'Builder.build', 'calls': 2, 'errors': 1,
+                   'seconds': 1.0, 'max_seconds': 0.5, 'max_arg_size': 7})
+
+
+@mock.patch('f5lbaasdriver.v2.bigip.tracing.eventlet')
+def test_log_stats_periodically(mock_eventlet, request):
+    tracing.cfg.CONF.set_override('f5_trace_stats_interval', 60)
+    request.addfinalizer(
+        lambda: tracing.cfg.CONF.clear_override('f5_trace_stats_interval'))
+
+    tracer = tracing.Tracer()
+    tracer.configure()
+    mock_eventlet.spawn.assert_called_once_with(
+        tracer._log_stats_periodically)
+    tracer.configure()
+    assert mock_eventlet.spawn.call_count == 1
+
+    def disable(seconds):
+        assert seconds == 60
+        if tracer.log_stats.call_count:
+            tracer.stats_interval = 0
+
+    mock_eventlet.sleep.side_effect = disable
+    tracer.log_stats = mock.MagicMock(name='log_stats')
+    tracer._log_stats_periodically()
+    assert tracer.log_stats.call_count == 1
+    assert tracer._stats_thread is None
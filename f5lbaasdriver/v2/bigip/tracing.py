@@ -0,0 +1,241 @@
+# coding=utf-8
+u"""Lightweight call tracing for the F5® LBaaSv2 Driver."""
+# Copyright 2017 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from collections import deque
+import functools
+import time
+
+import eventlet
+from oslo_config import cfg
+from oslo_log import log as logging
+import six
+
+LOG = logging.getLogger(__name__)
+
+OPTS = [
+    cfg.BoolOpt(
+        'f5_trace_calls',
+        default=True,
+        mutable=True,
+        help=('Count the calls, errors, duration and argument sizes of '
+              'the driver, service builder and RPC methods, and keep the '
+              'most recent calls in memory.')
+    ),
+    cfg.IntOpt(
+        'f5_trace_buffer_size',
+        default=1000,
+        mutable=True,
+        help='Most recent traced calls kept in memory.'
+    ),
+    cfg.ListOpt(
+        'f5_trace_log_arguments',
+        default=[],
+        mutable=True,
+        help=('Traced methods, as Class.method, whose arguments are '
+              'logged at debug level when called. Formatting arguments '
+              'such as service definitions is costly, so it is only done '
+              'for the methods listed.')
+    ),
+    cfg.IntOpt(
+        'f5_trace_stats_interval',
+        default=0,
+        mutable=True,
+        help=('Seconds between logging the counters of the traced '
+              'methods at info level. 0 disables logging them.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
+
+def get_size(value):
+    """Get the number of items of a value and of the values it holds.
+
+    Only the value and its immediate values are counted, so the size of
+    a service is found without walking every member.
+    """
+    try:
+        size = len(value)
+    except TypeError:
+        return 0
+    if isinstance(value, six.string_types):
+        return size
+    if isinstance(value, dict):
+        value = value.values()
+    for item in value:
+        if isinstance(item, (dict, list, tuple)):
+            size += len(item)
+    return size
+
+
+class CallStats(object):
+    """Counters of the calls of a traced method."""
+
+    __slots__ = ('calls', 'errors', 'seconds', 'max_seconds',
+                 'max_arg_size')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.max_arg_size = 0
+
+    def to_dict(self):
+        return {'calls': self.calls,
+                'errors': self.errors,
+                'seconds': self.seconds,
+                'max_seconds': self.max_seconds,
+                'max_arg_size': self.max_arg_size}
+
+
+class Tracer(object):
+    """Counts traced calls and keeps the most recent ones.
+
+    Every call updates the counters of its method and is appended to a
+    ring buffer as a (start time, method, seconds, argument size, error)
+    tuple. Arguments are formatted only for the methods whose argument
+    logging is enabled. Tracing and argument logging can be changed at
+    runtime, and follow the f5_trace options when the configuration
+    files are reloaded. The counters can be logged periodically.
+    """
+
+    def __init__(self, buffer_size=1000, enabled=True, log_arguments=None,
+                 timer=time.time):
+        self.enabled = enabled
+        self.log_arguments = set(log_arguments or [])
+        self._timer = timer
+        self._stats = {}
+        self._records = deque(maxlen=buffer_size)
+        self.stats_interval = 0
+        self._stats_thread = None
+
+    def configure(self, conf=None):
+        """Set up the tracer from the f5_trace options."""
+        conf = conf or cfg.CONF
+        self.enabled = conf.f5_trace_calls
+        self.log_arguments = set(conf.f5_trace_log_arguments)
+        if self._records.maxlen != conf.f5_trace_buffer_size:
+            self._records = deque(self._records,
+                                  maxlen=conf.f5_trace_buffer_size)
+        self.stats_interval = conf.f5_trace_stats_interval
+        if self.stats_interval > 0 and self._stats_thread is None:
+            self._stats_thread = eventlet.spawn(self._log_stats_periodically)
+
+    def mutate_config(self, conf, fresh):
+        """Configuration mutate hook applying changed f5_trace options."""
+        if any(name.startswith('f5_trace_') for _group, name in fresh):
+            LOG.info('Reconfiguring call tracing.')
+            self.configure(conf)
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def set_log_arguments(self, name, enabled=True):
+        """Enable or disable argument logging of a Class.method."""
+        if enabled:
+            self.log_arguments.add(name)
+        else:
+            self.log_arguments.discard(name)
+
+    def record(self, name, start, seconds, arg_size, error=False):
+        """Count a call and append it to the ring buffer."""
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = self._stats[name] = CallStats()
+        stats.calls += 1
+        stats.seconds += seconds
+        if seconds > stats.max_seconds:
+            stats.max_seconds = seconds
+        if arg_size > stats.max_arg_size:
+            stats.max_arg_size = arg_size
+        if error:
+            stats.errors += 1
+        self._records.append((start, name, seconds, arg_size, error))
+
+    def stats(self):
+        """Return the counters of every traced method by name."""
+        return dict((name, stats.to_dict())
+                    for name, stats in self._stats.items())
+
+    def log_stats(self):
+        """Log the counters of every traced method."""
+        for name, stats in sorted(self.stats().items()):
+            LOG.info('%(name)s: %(calls)d calls, %(errors)d errors, '
+                     '%(seconds).3f seconds, %(max_seconds).3f max seconds, '
+                     '%(max_arg_size)d max argument size',
+                     dict(stats, name=name))
+
+    def _log_stats_periodically(self):
+        try:
+            while self.stats_interval > 0:
+                eventlet.sleep(self.stats_interval)
+                if self.stats_interval > 0:
+                    self.log_stats()
+        finally:
+            self._stats_thread = None
+
+    def records(self):
+        """Return the most recent calls, oldest first."""
+        return list(self._records)
+
+    def reset(self):
+        """Drop every counter and recorded call."""
+        self._stats.clear()
+        self._records.clear()
+
+    def trace(self, method):
+        """Decorator tracing the calls of a method."""
+        log = logging.getLogger(method.__module__)
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return method(*args, **kwargs)
+
+            if args and hasattr(args[0], method.__name__):
+                name = '%s.%s' % (args[0].__class__.__name__,
+                                  method.__name__)
+                call_args = args[1:]
+            else:
+                name = method.__name__
+                call_args = args
+            if name in self.log_arguments:
+                log.debug('%(name)s called with arguments %(args)s '
+                          '%(kwargs)s',
+                          {'name': name, 'args': call_args,
+                           'kwargs': kwargs})
+            arg_size = sum(get_size(arg) for arg in call_args)
+            arg_size += sum(get_size(arg) for arg in kwargs.values())
+
+            start = self._timer()
+            try:
+                result = method(*args, **kwargs)
+            except Exception:
+                self.record(name, start, self._timer() - start, arg_size,
+                            error=True)
+                raise
+            self.record(name, start, self._timer() - start, arg_size)
+            return result
+        return wrapper
+
+
+TRACER = Tracer(buffer_size=cfg.CONF.f5_trace_buffer_size)
+
+trace = TRACER.trace
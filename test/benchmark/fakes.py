@@ -0,0 +1,485 @@
+# Copyright 2017 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-memory stand-ins for Neutron and the LBaaSv2 database.
+
+The fakes answer the plugin calls made by the driver from dictionaries
+and count every call, so benchmarks can report how many database round
+trips an operation would have made against a real neutron-server.
+"""
+
+from collections import Counter
+import json
+import resource
+import time
+
+from neutron_lbaas.services.loadbalancer import data_models
+
+from f5lbaasdriver.v2.bigip.disconnected_service import DisconnectedService
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+TENANT_ID = 'benchmark-tenant'
+
+
+def _filter_matches(obj, filters):
+    for key, values in (filters or {}).items():
+        if obj.get(key) not in values:
+            return False
+    return True
+
+
+def _model_filter_matches(model, filters):
+    for key, values in (filters or {}).items():
+        if getattr(model, key) not in values:
+            return False
+    return True
+
+
+class FakeSession(object):
+    """Session whose transactions do nothing."""
+
+    class _Transaction(object):
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            return False
+
+    def __init__(self):
+        self.added = []
+
+    def begin(self, subtransactions=False):
+        return self._Transaction()
+
+    def add(self, instance):
+        self.added.append(instance)
+
+    def connection(self):
+        return None
+
+
+class FakeContext(object):
+    def __init__(self):
+        self.session = FakeSession()
+        self.is_admin = True
+        self.tenant_id = TENANT_ID
+
+
+class FakeCorePlugin(object):
+    """Neutron core plugin serving networks, subnets, ports and agents."""
+
+    def __init__(self, calls):
+        self.calls = calls
+        self.networks = {}
+        self.subnets = {}
+        self.ports = {}
+        self.agents = []
+        self._ports_by_fixed_ip = {}
+
+    def add_port(self, port):
+        self.ports[port['id']] = port
+        for fixed_ip in port['fixed_ips']:
+            key = (fixed_ip['subnet_id'], fixed_ip['ip_address'])
+            self._ports_by_fixed_ip.setdefault(key, []).append(port)
+
+    def get_network(self, context, id, fields=None):
+        self.calls['get_network'] += 1
+        return dict(self.networks[id])
+
+    def get_subnet(self, context, id, fields=None):
+        self.calls['get_subnet'] += 1
+        return dict(self.subnets[id])
+
+    def get_port(self, context, id, fields=None):
+        self.calls['get_port'] += 1
+        return dict(self.ports[id])
+
+    def get_ports(self, context, filters=None, fields=None):
+        self.calls['get_ports'] += 1
+        filters = dict(filters or {})
+        fixed_ips = filters.pop('fixed_ips', None)
+        if fixed_ips:
+            ports = []
+            for subnet_id in fixed_ips.get('subnet_id', []):
+                for ip_address in fixed_ips.get('ip_address', []):
+                    ports.extend(self._ports_by_fixed_ip.get(
+                        (subnet_id, ip_address), []))
+        elif 'id' in filters:
+            ports = [self.ports[port_id] for port_id in filters.pop('id')
+                     if port_id in self.ports]
+        else:
+            ports = self.ports.values()
+        return [dict(port) for port in ports
+                if _filter_matches(port, filters)]
+
+    def get_agents(self, context, filters=None, fields=None):
+        self.calls['get_agents'] += 1
+        return [agent for agent in self.agents
+                if _filter_matches(agent, filters)]
+
+
+class FakeLBaaSDb(object):
+    """LBaaSv2 plugin database serving data models."""
+
+    def __init__(self, calls, core_plugin):
+        self.calls = calls
+        self._core_plugin = core_plugin
+        self.loadbalancers = {}
+        self.listeners = []
+        self.pools = []
+        self.healthmonitors = []
+        self.members = []
+        self.l7policies = []
+        self.l7rules = []
+        self.agents = {}
+        self.bindings = {}
+        self._tenant_agent_ids = {}
+        self.member_counts = {}
+
+    def get_loadbalancer(self, context, id):
+        self.calls['get_loadbalancer'] += 1
+        return self.loadbalancers[id]
+
+    def get_listeners(self, context, filters=None):
+        self.calls['get_listeners'] += 1
+        return [listener for listener in self.listeners
+                if _model_filter_matches(listener, filters)]
+
+    def get_pools(self, context, filters=None):
+        self.calls['get_pools'] += 1
+        return [pool for pool in self.pools
+                if _model_filter_matches(pool, filters)]
+
+    def get_healthmonitor(self, context, id):
+        self.calls['get_healthmonitor'] += 1
+        for healthmonitor in self.healthmonitors:
+            if healthmonitor.id == id:
+                return healthmonitor
+
+    def get_healthmonitors(self, context, filters=None):
+        self.calls['get_healthmonitors'] += 1
+        return [healthmonitor for healthmonitor in self.healthmonitors
+                if _model_filter_matches(healthmonitor, filters)]
+
+    def get_pool_members(self, context, filters=None):
+        self.calls['get_pool_members'] += 1
+        return [member for member in self.members
+                if _model_filter_matches(member, filters)]
+
+    def get_l7policies(self, context, filters=None):
+        self.calls['get_l7policies'] += 1
+        return [l7policy for l7policy in self.l7policies
+                if _model_filter_matches(l7policy, filters)]
+
+    def get_l7policy_rules(self, context, l7policy_id, filters=None):
+        self.calls['get_l7policy_rules'] += 1
+        if not filters:
+            filters = {'l7policy_id': [l7policy_id]}
+        return [l7rule for l7rule in self.l7rules
+                if _model_filter_matches(l7rule, filters)]
+
+    def get_lbaas_agents(self, context, active=None, filters=None):
+        self.calls['get_lbaas_agents'] += 1
+        return [agent for agent in self.agents.values()
+                if (active is None or
+                    (agent['admin_state_up'] == active and agent['alive']))
+                and _filter_matches(agent, filters)]
+
+    def get_agent_hosting_loadbalancer(self, context, loadbalancer_id,
+                                       active=None):
+        self.calls['get_agent_hosting_loadbalancer'] += 1
+        agent_id = self.bindings.get(loadbalancer_id)
+        if agent_id is not None:
+            return {'agent': dict(self.agents[agent_id])}
+
+    def get_tenant_agent_ids(self, context, tenant_id, agent_ids):
+        """Serve TenantScheduler.get_tenant_agent_ids as one query."""
+        self.calls['get_tenant_agent_ids'] += 1
+        return self._tenant_agent_ids.get(tenant_id, set()) & set(agent_ids)
+
+    def count_agent_loads(self, context, agent_ids):
+        """Serve CapacityWeightedScheduler.count_agent_loads as one query."""
+        self.calls['count_agent_loads'] += 1
+        agent_ids = set(agent_ids)
+        loads = {}
+        for loadbalancer_id, agent_id in self.bindings.items():
+            if agent_id in agent_ids:
+                load = loads.setdefault(agent_id, [0, 0])
+                load[0] += 1
+                load[1] += self.member_counts.get(loadbalancer_id, 0)
+        return loads
+
+    def add_binding(self, loadbalancer_id, agent_id):
+        self.bindings[loadbalancer_id] = agent_id
+        tenant_id = self.loadbalancers[loadbalancer_id].tenant_id
+        self._tenant_agent_ids.setdefault(tenant_id, set()).add(agent_id)
+
+
+class FakeDisconnectedService(DisconnectedService):
+    """Disconnected service without ML2 segments."""
+
+    def __init__(self, calls):
+        super(FakeDisconnectedService, self).__init__()
+        self.calls = calls
+
+    def get_network_segments_by_network_ids(self, session, network_ids):
+        self.calls['get_network_segments_by_network_ids'] += 1
+        return dict((network_id, []) for network_id in network_ids)
+
+
+class FakePlugin(object):
+    def __init__(self):
+        self.calls = Counter()
+        self.db = FakeLBaaSDb(self.calls, FakeCorePlugin(self.calls))
+
+
+class FakeDriver(object):
+    def __init__(self, env='benchmark'):
+        self.env = env
+        self.plugin = FakePlugin()
+
+
+def populate_loadbalancer(plugin, members=10, listeners=1, pools=1,
+                          l7policies=0, l7rules=1, networks=1, agents=1,
+                          vtep_hosts=1, network_type='vxlan'):
+    """Create a loadbalancer and its objects in the fake plugin.
+
+    Members are spread evenly over the pools and member networks and
+    bound to vtep_hosts of the L2 agents. L7 policies are spread over
+    the listeners and carry l7rules rules each. Back references only
+    hold ids, as in data models converted from the database, so the
+    objects serialize without cycles.
+
+    :returns: the loadbalancer data model.
+    """
+    core = plugin.db._core_plugin
+
+    for index in range(networks + 1):
+        network_id = 'network-%d' % index
+        subnet_id = 'subnet-%d' % index
+        core.networks[network_id] = {
+            'id': network_id,
+            'tenant_id': TENANT_ID,
+            'shared': False,
+            'subnets': [subnet_id],
+            'provider:network_type': network_type,
+            'provider:segmentation_id': 1000 + index}
+        core.subnets[subnet_id] = {
+            'id': subnet_id,
+            'network_id': network_id,
+            'tenant_id': TENANT_ID,
+            'cidr': '10.%d.0.0/16' % index}
+
+    for index in range(agents):
+        core.agents.append({
+            'id': 'l2-agent-%d' % index,
+            'host': 'host-%d' % index,
+            'agent_type': 'Open vSwitch agent',
+            'configurations': {
+                'tunnel_types': [network_type],
+                'tunneling_ip': '192.168.%d.%d' % (index // 250,
+                                                   index % 250 + 1)}})
+
+    # network-0 carries the VIP.
+    vip_port = {'id': 'vip-port', 'network_id': 'network-0',
+                'mac_address': 'fa:16:3e:00:00:01',
+                'binding:host_id': 'host-0',
+                'fixed_ips': [{'subnet_id': 'subnet-0',
+                               'ip_address': '10.0.0.10'}]}
+    core.add_port(vip_port)
+    loadbalancer = data_models.LoadBalancer(
+        id='loadbalancer', tenant_id=TENANT_ID, name='benchmark',
+        vip_subnet_id='subnet-0', vip_port_id='vip-port',
+        vip_address='10.0.0.10', provisioning_status='ACTIVE',
+        operating_status='ONLINE', admin_state_up=True)
+    plugin.db.loadbalancers[loadbalancer.id] = loadbalancer
+
+    pool_models = []
+    for index in range(pools):
+        healthmonitor = data_models.HealthMonitor(
+            id='healthmonitor-%d' % index, tenant_id=TENANT_ID,
+            type='HTTP', delay=5, timeout=5, max_retries=3,
+            http_method='GET', url_path='/', expected_codes='200',
+            provisioning_status='ACTIVE', admin_state_up=True)
+        pool = data_models.Pool(
+            id='pool-%d' % index, tenant_id=TENANT_ID,
+            healthmonitor_id=healthmonitor.id, protocol='HTTP',
+            lb_algorithm='ROUND_ROBIN', admin_state_up=True,
+            operating_status='ONLINE', provisioning_status='ACTIVE',
+            loadbalancer_id=loadbalancer.id, healthmonitor=healthmonitor)
+        plugin.db.healthmonitors.append(healthmonitor)
+        plugin.db.pools.append(pool)
+        pool_models.append(pool)
+
+    for index in range(members):
+        pool = pool_models[index % pools]
+        network_index = index % networks + 1
+        subnet_id = 'subnet-%d' % network_index
+        address = '10.%d.%d.%d' % (network_index, index // 250 % 250,
+                                   index % 250 + 1)
+        member = data_models.Member(
+            id='member-%d' % index, tenant_id=TENANT_ID, pool_id=pool.id,
+            address=address, protocol_port=80, weight=1,
+            admin_state_up=True, subnet_id=subnet_id,
+            operating_status='ONLINE', provisioning_status='ACTIVE')
+        pool.members.append(member)
+        plugin.db.members.append(member)
+        core.add_port({
+            'id': 'member-port-%d' % index,
+            'network_id': 'network-%d' % network_index,
+            'mac_address': 'fa:16:3e:%02x:%02x:%02x' % (
+                index >> 16 & 0xff, index >> 8 & 0xff, index & 0xff),
+            'binding:host_id': 'host-%d' % (index % vtep_hosts),
+            'fixed_ips': [{'subnet_id': subnet_id,
+                           'ip_address': address}]})
+
+    listener_models = []
+    for index in range(listeners):
+        default_pool = pool_models[index % pools]
+        listener = data_models.Listener(
+            id='listener-%d' % index, tenant_id=TENANT_ID,
+            default_pool_id=default_pool.id,
+            loadbalancer_id=loadbalancer.id, protocol='HTTP',
+            protocol_port=80 + index, admin_state_up=True,
+            provisioning_status='ACTIVE', operating_status='ONLINE',
+            default_pool=default_pool)
+        plugin.db.listeners.append(listener)
+        listener_models.append(listener)
+
+    for index in range(l7policies):
+        listener = listener_models[index % listeners]
+        l7policy = data_models.L7Policy(
+            id='l7policy-%d' % index, tenant_id=TENANT_ID,
+            listener_id=listener.id, action='REJECT',
+            position=len(listener.l7_policies) + 1, admin_state_up=True,
+            provisioning_status='ACTIVE',
+            listener=data_models.Listener(id=listener.id))
+        listener.l7_policies.append(l7policy)
+        plugin.db.l7policies.append(l7policy)
+        for rule_index in range(l7rules):
+            l7rule = data_models.L7Rule(
+                id='l7rule-%d-%d' % (index, rule_index),
+                tenant_id=TENANT_ID, l7policy_id=l7policy.id,
+                type='HOST_NAME', compare_type='EQUAL_TO',
+                value='host-%d.example.com' % rule_index, invert=False,
+                provisioning_status='ACTIVE', admin_state_up=True,
+                policy=data_models.L7Policy(id=l7policy.id))
+            l7policy.rules.append(l7rule)
+            plugin.db.l7rules.append(l7rule)
+
+    loadbalancer.listeners = listener_models
+    loadbalancer.pools = pool_models
+    return loadbalancer
+
+
+def lbaas_agent_configurations(environment, group, capacity_score=0.0):
+    """JSON configurations as reported by an F5 LBaaSv2 agent."""
+    return json.dumps({'environment_prefix': environment,
+                       'environment_group_number': group,
+                       'environment_capacity_score': capacity_score})
+
+
+def populate_lbaas_agents(plugin, environments=1, groups=1,
+                          agents_per_group=1):
+    """Create F5 LBaaSv2 agents in the fake plugin.
+
+    Agents are named agent-<environment>-<group>-<index>, environments
+    env-<index> and groups are numbered from 1.
+
+    :returns: the agents by id.
+    """
+    for env_index in range(environments):
+        environment = 'env-%d' % env_index
+        for group in range(1, groups + 1):
+            for index in range(agents_per_group):
+                agent_id = 'agent-%d-%d-%d' % (env_index, group, index)
+                plugin.db.agents[agent_id] = {
+                    'id': agent_id,
+                    'host': 'f5-host-%d-%d-%d' % (env_index, group, index),
+                    'agent_type': 'Loadbalancerv2 agent',
+                    'admin_state_up': True,
+                    'alive': True,
+                    'configurations': lbaas_agent_configurations(
+                        environment, group)}
+    return plugin.db.agents
+
+
+def populate_bound_loadbalancers(plugin, count, tenants, rng, members=0,
+                                 prefix='bound'):
+    """Create loadbalancers bound to random agents in the fake plugin.
+
+    Each loadbalancer is given a random tenant of tenants and a random
+    number of members up to members.
+
+    :returns: the loadbalancer ids.
+    """
+    agent_ids = sorted(plugin.db.agents)
+    loadbalancer_ids = []
+    for index in range(count):
+        loadbalancer = data_models.LoadBalancer(
+            id='%s-%d' % (prefix, index),
+            tenant_id='tenant-%d' % rng.randrange(tenants))
+        plugin.db.loadbalancers[loadbalancer.id] = loadbalancer
+        plugin.db.member_counts[loadbalancer.id] = rng.randint(0, members)
+        plugin.db.add_binding(loadbalancer.id, rng.choice(agent_ids))
+        loadbalancer_ids.append(loadbalancer.id)
+    return loadbalancer_ids
+
+
+class Measurement(object):
+    """Wall time, plugin calls and memory growth of a block of work."""
+
+    def __init__(self, calls):
+        self.calls = calls
+        self.seconds = 0.0
+        self.db_calls = 0
+        self.call_counts = Counter()
+        self.peak_kb = 0
+
+    def __enter__(self):
+        self._calls_before = Counter(self.calls)
+        if tracemalloc:
+            tracemalloc.start()
+        else:
+            self._rss_before = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.time() - self._start
+        if tracemalloc:
+            self.peak_kb = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+        else:
+            # Growth of the peak resident set; 0 when the work fits in
+            # memory the process had already touched.
+            self.peak_kb = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss - self._rss_before
+        self.call_counts = Counter(self.calls)
+        self.call_counts.subtract(self._calls_before)
+        self.call_counts = Counter(
+            dict((name, count) for name, count in self.call_counts.items()
+                 if count > 0))
+        self.db_calls = sum(self.call_counts.values())
+        return False
+
+
+def payload_size(payload):
+    """Size in bytes of a payload serialized as an RPC message would be."""
+    return len(json.dumps(payload, default=str))
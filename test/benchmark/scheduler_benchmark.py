@@ -0,0 +1,269 @@
+# Copyright 2017 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Simulate loadbalancer scheduling against an in-memory Neutron.
+
+For every number of existing bindings the simulation creates agents in
+environments and groups, binds that many loadbalancers to random agents
+and then schedules new loadbalancers, one decision at a time, over the
+environments. Agents report a capacity score proportional to the
+loadbalancers of their group every --report-every decisions, as the F5
+agents do on their periodic state report. Afterwards it looks up the
+agent hosting existing loadbalancers, some of them bound to dead
+agents. It reports per-decision latency, plugin (database) calls and
+how the loadbalancers ended up spread over groups and agents.
+
+    python -m test.benchmark.scheduler_benchmark \\
+        --bindings 1000,10000,50000 --groups 10 --agents-per-group 50
+
+--scheduler selects the scheduler class to simulate, so changes can be
+compared before they reach a neutron-server. With --check the run fails
+when a decision makes more plugin calls with the most bindings than
+with the fewest.
+"""
+
+from __future__ import print_function
+
+import argparse
+from collections import Counter
+from collections import defaultdict
+import random
+import sys
+import time
+
+from neutron_lbaas.services.loadbalancer import data_models
+from oslo_utils import importutils
+
+from test.benchmark import fakes
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scheduler',
+                        default='f5lbaasdriver.v2.bigip.agent_scheduler.'
+                                'TenantScheduler',
+                        help='scheduler class to simulate')
+    parser.add_argument('--bindings', type=_int_list,
+                        default=[1000, 10000, 50000],
+                        help='comma separated existing binding counts')
+    parser.add_argument('--environments', type=int, default=2)
+    parser.add_argument('--groups', type=int, default=10,
+                        help='groups per environment')
+    parser.add_argument('--agents-per-group', type=int, default=100)
+    parser.add_argument('--tenants', type=int, default=500)
+    parser.add_argument('--members', type=int, default=20,
+                        help='most members of a loadbalancer')
+    parser.add_argument('--schedule', type=int, default=500,
+                        help='new loadbalancers to schedule')
+    parser.add_argument('--lookups', type=int, default=500,
+                        help='hosting agent lookups of bound loadbalancers')
+    parser.add_argument('--dead-agents', type=float, default=0.05,
+                        help='fraction of agents that are not alive')
+    parser.add_argument('--group-capacity', type=int, default=10000,
+                        help='loadbalancers at which a group reports 1.0')
+    parser.add_argument('--report-every', type=int, default=50,
+                        help='decisions between agent capacity reports')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check', action='store_true',
+                        help='fail if plugin calls grow with bindings')
+    parser.add_argument('--verbose', action='store_true',
+                        help='print plugin calls by method and group loads')
+    return parser.parse_args(argv)
+
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = int(round(percent / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+class Simulation(object):
+    """Agents, bindings and capacity reports of one simulation run."""
+
+    def __init__(self, args, bindings):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.driver = fakes.FakeDriver()
+        self.db = self.driver.plugin.db
+        self.calls = self.driver.plugin.calls
+        self.context = fakes.FakeContext()
+
+        fakes.populate_lbaas_agents(
+            self.driver.plugin,
+            environments=args.environments,
+            groups=args.groups,
+            agents_per_group=args.agents_per_group)
+        self.group_by_agent = {}
+        for agent_id in self.db.agents:
+            env_index, group, _ = agent_id.split('-')[1:]
+            self.group_by_agent[agent_id] = ('env-%s' % env_index, int(group))
+
+        self.bound_ids = fakes.populate_bound_loadbalancers(
+            self.driver.plugin, bindings, args.tenants, self.rng,
+            members=args.members)
+
+        agent_ids = sorted(self.db.agents)
+        for agent_id in self.rng.sample(
+                agent_ids, int(len(agent_ids) * args.dead_agents)):
+            self.db.agents[agent_id]['alive'] = False
+
+        # The schedulers read the bindings with SQL; serve their queries
+        # from the fake bindings instead.
+        self.scheduler = importutils.import_object(args.scheduler)
+        for query in ('get_tenant_agent_ids', 'count_agent_loads'):
+            if hasattr(self.scheduler, query):
+                setattr(self.scheduler, query, getattr(self.db, query))
+        self.report_capacity()
+
+    def group_loads(self):
+        loads = Counter()
+        for agent_id in self.db.bindings.values():
+            loads[self.group_by_agent[agent_id]] += 1
+        return loads
+
+    def agent_loads(self):
+        loads = Counter(dict((agent_id, 0) for agent_id in self.db.agents))
+        loads.update(self.db.bindings.values())
+        return loads
+
+    def report_capacity(self):
+        """Have every agent report the capacity score of its group."""
+        loads = self.group_loads()
+        for agent_id, agent in self.db.agents.items():
+            env, group = self.group_by_agent[agent_id]
+            score = float(loads[(env, group)]) / self.args.group_capacity
+            agent['configurations'] = fakes.lbaas_agent_configurations(
+                env, group, round(score, 2))
+
+    def schedule(self):
+        """Schedule new loadbalancers, returning latencies and calls."""
+        latencies = []
+        calls = Counter()
+        for index in range(self.args.schedule):
+            env = 'env-%d' % (index % self.args.environments)
+            loadbalancer = data_models.LoadBalancer(
+                id='scheduled-%d' % index,
+                tenant_id='tenant-%d' % self.rng.randrange(self.args.tenants))
+            self.db.loadbalancers[loadbalancer.id] = loadbalancer
+            self.db.member_counts[loadbalancer.id] = self.rng.randint(
+                0, self.args.members)
+
+            before = Counter(self.calls)
+            start = time.time()
+            self.scheduler.schedule(
+                self.driver.plugin, self.context, loadbalancer.id, env)
+            latencies.append(time.time() - start)
+            calls.update(Counter(self.calls) - before)
+
+            for binding in self.context.session.added:
+                self.db.add_binding(binding.loadbalancer_id,
+                                    binding.agent['id'])
+            del self.context.session.added[:]
+
+            if (index + 1) % self.args.report_every == 0:
+                self.report_capacity()
+        return latencies, calls
+
+    def lookup(self):
+        """Look up hosting agents, returning latencies and calls."""
+        latencies = []
+        calls = Counter()
+        for loadbalancer_id in self.rng.sample(
+                self.bound_ids, min(self.args.lookups, len(self.bound_ids))):
+            env, _ = self.group_by_agent[self.db.bindings[loadbalancer_id]]
+
+            before = Counter(self.calls)
+            start = time.time()
+            self.scheduler.get_lbaas_agent_hosting_loadbalancer(
+                self.driver.plugin, self.context, loadbalancer_id, env)
+            latencies.append(time.time() - start)
+            calls.update(Counter(self.calls) - before)
+        return latencies, calls
+
+
+def run(args, bindings):
+    simulation = Simulation(args, bindings)
+    schedule_latencies, schedule_calls = simulation.schedule()
+    lookup_latencies, lookup_calls = simulation.lookup()
+
+    group_loads = simulation.group_loads()
+    agent_loads = simulation.agent_loads()
+    decisions = max(len(schedule_latencies), 1)
+    lookups = max(len(lookup_latencies), 1)
+    return {
+        'bindings': bindings,
+        'schedule_ms': sum(schedule_latencies) * 1000 / decisions,
+        'schedule_p95_ms': _percentile(schedule_latencies, 95) * 1000,
+        'schedule_calls': sum(schedule_calls.values()) / float(decisions),
+        'schedule_call_counts': schedule_calls,
+        'lookup_ms': sum(lookup_latencies) * 1000 / lookups,
+        'lookup_calls': sum(lookup_calls.values()) / float(lookups),
+        'lookup_call_counts': lookup_calls,
+        'group_min': min(group_loads.values()),
+        'group_max': max(group_loads.values()),
+        'agent_min': min(agent_loads.values()),
+        'agent_max': max(agent_loads.values()),
+        'group_loads': group_loads}
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    print('%s: %d environments x %d groups x %d agents' %
+          (args.scheduler.rsplit('.', 1)[-1], args.environments,
+           args.groups, args.agents_per_group))
+
+    header = ('%9s %8s %8s %8s %9s %8s %13s %13s' %
+              ('bindings', 'sched ms', 'p95 ms', 'calls', 'lookup ms',
+               'calls', 'group min/max', 'agent min/max'))
+    print(header)
+    print('-' * len(header))
+
+    results = []
+    for bindings in args.bindings:
+        result = run(args, bindings)
+        results.append(result)
+        print('%(bindings)9d %(schedule_ms)8.2f %(schedule_p95_ms)8.2f '
+              '%(schedule_calls)8.1f %(lookup_ms)9.2f %(lookup_calls)8.1f '
+              '%(group_min)6d/%(group_max)-6d %(agent_min)6d/%(agent_max)-6d'
+              % result)
+        if args.verbose:
+            for name, count in sorted(result['schedule_call_counts'].items()):
+                print('%38s %s' % ('schedule ' + name, count))
+            for name, count in sorted(result['lookup_call_counts'].items()):
+                print('%38s %s' % ('lookup ' + name, count))
+            loads = defaultdict(list)
+            for (env, group), count in sorted(result['group_loads'].items()):
+                loads[env].append('%d:%d' % (group, count))
+            for env in sorted(loads):
+                print('%38s %s' % (env, ' '.join(loads[env])))
+
+    if args.check and len(results) > 1:
+        fewest, most = results[0], results[-1]
+        if most['schedule_calls'] > fewest['schedule_calls']:
+            print('FAIL: %d bindings made %.1f plugin calls per decision, '
+                  '%d bindings %.1f' %
+                  (most['bindings'], most['schedule_calls'],
+                   fewest['bindings'], fewest['schedule_calls']))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+# Copyright 2017 F5 Networks Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark LBaaSv2ServiceBuilder.build against an in-memory Neutron.
+
+For every member count the benchmark builds the service of a synthetic
+loadbalancer twice: cold, with a new service builder, and warm, with the
+network caches filled. It reports wall time, plugin (database) calls,
+peak memory and the size of the serialized service, as JSON and as
+encoded by service_codec.
+
+    python -m test.benchmark.service_builder_benchmark \\
+        --members 10,100,1000,10000 --pools 10 --l7-policies 100
+
+With --check the run fails when the cold build of the largest
+loadbalancer makes more plugin calls than that of the smallest, which
+catches per-object (N+1) lookups creeping back into the builder.
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+
+from f5lbaasdriver.v2.bigip import service_codec
+from f5lbaasdriver.v2.bigip.service_builder import LBaaSv2ServiceBuilder
+
+from test.benchmark import fakes
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--members', type=_int_list,
+                        default=[10, 100, 1000, 10000],
+                        help='comma separated member counts to build')
+    parser.add_argument('--listeners', type=int, default=2)
+    parser.add_argument('--pools', type=int, default=2)
+    parser.add_argument('--l7-policies', type=int, default=10,
+                        help='L7 policies, spread over the listeners')
+    parser.add_argument('--l7-rules', type=int, default=2,
+                        help='L7 rules per policy')
+    parser.add_argument('--networks', type=int, default=4,
+                        help='member networks')
+    parser.add_argument('--agents', type=int, default=50,
+                        help='L2 agents reporting tunnel endpoints')
+    parser.add_argument('--vtep-hosts', type=int, default=20,
+                        help='hosts the member ports are bound to')
+    parser.add_argument('--network-type', default='vxlan',
+                        choices=['vxlan', 'gre', 'vlan'])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='warm builds to average')
+    parser.add_argument('--check', action='store_true',
+                        help='fail if plugin calls grow with members')
+    parser.add_argument('--verbose', action='store_true',
+                        help='print plugin calls by method')
+    return parser.parse_args(argv)
+
+
+def run(args, members):
+    """Benchmark cold and warm builds of a loadbalancer with members."""
+    driver = fakes.FakeDriver()
+    loadbalancer = fakes.populate_loadbalancer(
+        driver.plugin,
+        members=members,
+        listeners=args.listeners,
+        pools=args.pools,
+        l7policies=args.l7_policies,
+        l7rules=args.l7_rules,
+        networks=args.networks,
+        agents=args.agents,
+        vtep_hosts=min(args.vtep_hosts, args.agents),
+        network_type=args.network_type)
+    agent = {'id': 'f5-agent', 'host': 'f5-host', 'configurations': {}}
+    context = fakes.FakeContext()
+    calls = driver.plugin.calls
+
+    builder = LBaaSv2ServiceBuilder(driver)
+    builder.disconnected_service = fakes.FakeDisconnectedService(calls)
+    with fakes.Measurement(calls) as cold:
+        service = builder.build(context, loadbalancer, agent)
+
+    with fakes.Measurement(calls) as warm:
+        for _ in range(args.repeat):
+            builder.build(context, loadbalancer, agent)
+
+    return {'members': members,
+            'cold_ms': cold.seconds * 1000,
+            'cold_calls': cold.db_calls,
+            'cold_call_counts': cold.call_counts,
+            'warm_ms': warm.seconds * 1000 / max(args.repeat, 1),
+            'warm_calls': warm.db_calls // max(args.repeat, 1),
+            'peak_kb': cold.peak_kb,
+            'payload_bytes': fakes.payload_size(service),
+            'encoded_bytes': fakes.payload_size(
+                service_codec.encode_service(service))}
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    header = ('%8s %10s %10s %10s %10s %10s %12s %10s' %
+              ('members', 'cold ms', 'cold calls', 'warm ms', 'warm calls',
+               'peak KB', 'payload B', 'encoded B'))
+    print(header)
+    print('-' * len(header))
+
+    results = []
+    for members in args.members:
+        result = run(args, members)
+        results.append(result)
+        print('%(members)8d %(cold_ms)10.1f %(cold_calls)10d '
+              '%(warm_ms)10.1f %(warm_calls)10d %(peak_kb)10d '
+              '%(payload_bytes)12d %(encoded_bytes)10d' % result)
+        if args.verbose:
+            for name, count in sorted(result['cold_call_counts'].items()):
+                print('%38s %s' % (name, count))
+
+    if args.check and len(results) > 1:
+        smallest, largest = results[0], results[-1]
+        if largest['cold_calls'] > smallest['cold_calls']:
+            print('FAIL: %d members made %d plugin calls, %d members %d' %
+                  (largest['members'], largest['cold_calls'],
+                   smallest['members'], smallest['cold_calls']))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())